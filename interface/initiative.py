@@ -21,7 +21,7 @@ class InitiativeCommands(commands.Cog):
         """Show the current channel's initiative table."""
         await ctx.defer()
         try:
-            response = _init_parse(ctx)
+            response = await _init_parse(ctx)
             await ctx.respond(content=response.content, embed=response.embed)
         except ValueError as err:
             await ctx.respond(str(err))
@@ -49,7 +49,7 @@ class InitiativeCommands(commands.Cog):
 
             character = await storyteller.stringify_mentions(ctx, character)
 
-            response = _init_parse(ctx, mod, character)
+            response = await _init_parse(ctx, mod, character)
             await ctx.respond(content=response.content, embed=response.embed)
         except ValueError:
             await ctx.respond(
@@ -77,7 +77,7 @@ class InitiativeCommands(commands.Cog):
                 chars_and_mods.append((char, mod))
                 char_names.append(char)
 
-            storyteller.parse.initiative_bulk_add(ctx, chars_and_mods)
+            await storyteller.parse.initiative_bulk_add(ctx, chars_and_mods)
 
             last = char_names.pop(-1)
             if (num_chars := len(char_names)) == 0:
@@ -100,7 +100,7 @@ class InitiativeCommands(commands.Cog):
         """Remove a character from the channel's initiative table."""
         await ctx.defer()
         try:
-            response = storyteller.parse.initiative_removal(ctx, character)
+            response = await storyteller.parse.initiative_removal(ctx, character)
             await ctx.respond(content=response.content, embed=response.embed)
         except ValueError as err:
             await ctx.respond(err, ephemeral=True)
@@ -116,12 +116,14 @@ class InitiativeCommands(commands.Cog):
             # Reroll and store the new initiatives before displaying
             manager.reroll()
 
-            for character, init in manager.characters.items():
-                storyteller.initiative.set_initiative(
-                    ctx.guild.id, ctx.channel.id, character, init.mod, init.die
-                )
+            initiatives = [
+                (character, init.mod, init.die) for character, init in manager.characters.items()
+            ]
+            await storyteller.initiative.aio.set_initiatives(
+                ctx.guild.id, ctx.channel.id, initiatives
+            )
 
-            response = _init_parse(ctx, reroll=True)  # Print the new initiative table
+            response = await _init_parse(ctx, reroll=True)  # Print the new initiative table
             await ctx.respond(content=response.content, embed=response.embed)
         else:
             await ctx.respond("Initiative isn't set for this channel!", ephemeral=True)
@@ -136,7 +138,7 @@ class InitiativeCommands(commands.Cog):
         """Declare an initiative action."""
         await ctx.defer()
         try:
-            character = storyteller.parse.initiative_declare(ctx, declaration.split())
+            character = await storyteller.parse.initiative_declare(ctx, declaration.split())
             await ctx.respond(f"Declared {character}'s action!")
         except SyntaxError as error:
             await ctx.respond(error, ephemeral=True)
@@ -147,7 +149,7 @@ class InitiativeCommands(commands.Cog):
         """Clear this channel's initiative table."""
         await ctx.defer()
         try:
-            storyteller.initiative.remove_table(ctx.channel.id)
+            await storyteller.initiative.aio.remove_table(ctx.channel.id)
             await ctx.respond("Reset initiative in this channel!")
         except KeyError:
             await ctx.respond("This channel's initiative table is already empty!", ephemeral=True)
@@ -158,18 +160,18 @@ def setup(bot):
     bot.add_cog(InitiativeCommands(bot))
 
 
-def _init_parse(ctx, mod=None, character=None, reroll=False):
+async def _init_parse(ctx, mod=None, character=None, reroll=False):
     """Helper method that handles basic initiative stuff."""
-    use_embed = _use_embed(ctx.guild.id)
-    return storyteller.parse.initiative(ctx, mod, character, reroll, use_embed)
+    use_embed = await _use_embed(ctx.guild.id)
+    return await storyteller.parse.initiative(ctx, mod, character, reroll, use_embed)
 
 
-def _use_embed(guildid: int) -> bool:
+async def _use_embed(guildid: int) -> bool:
     """
     Determine whether a command should use compact mode.
     Args:
         guildid (int): The Discord ID of the guild where the bot was invoked
     Returns (bool): True if the bot should use compact mode
     """
-    guild_settings = storyteller.settings.settings_for_guild(guildid)
+    guild_settings = await storyteller.settings.aio.settings_for_guild(guildid)
     return not guild_settings["use_compact"]
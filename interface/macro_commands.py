@@ -23,7 +23,7 @@ class MacroCommands(commands.Cog):
     @commands.guild_only()
     async def purge(self, ctx):
         """Remove all macros you have on this server."""
-        macro_count, meta_count = storyteller.engine.macro_counts(ctx)
+        macro_count, meta_count = await storyteller.engine.macro_counts(ctx)
         prompt = "Are you sure you wish to delete your macros on this server?"
 
         # Correctly pluralize and display number of macros/metamacros to delete
@@ -46,10 +46,14 @@ class MiscCommands(commands.Cog):
         ctx: discord.ApplicationContext,
         syntax: Option(
             str,
-            "Format: POOL DIFFICULTY TARGET"
+            "Format: POOL DIFFICULTY TARGET (Chronicles: POOL [X-AGAIN] [TARGET])"
         ),
     ):
         """Calculate the probability of a given roll outcome."""
+        if ctx.guild and await storyteller.settings.aio.value(ctx.guild.id, "chronicles"):
+            await self._chronicles_stats(ctx, syntax)
+            return
+
         usage = "Expected arguments: <pool> <difficulty> <target>"
         try:
             args = syntax.split()
@@ -106,6 +110,63 @@ class MiscCommands(commands.Cog):
             storyteller.engine.statistics.increment_stats_calculated(ctx.guild)
 
 
+    async def _chronicles_stats(self, ctx, syntax: str):
+        """Calculate the probabilities of a Chronicles of Darkness roll, standard and rote."""
+        usage = "Expected arguments: <pool> [x-again] [target]"
+        difficulty = await storyteller.settings.aio.value(ctx.guild.id, "default_diff")
+        try:
+            args = syntax.split()
+            pool = int(args.pop(0))
+            xpl_target = int(args.pop(0)) if args else 10
+            target = int(args.pop(0)) if args else 1
+
+            # Check our constraints
+            if not 1 <= pool <= 30:
+                raise ValueError("Error! Pool must be between 1-30!")
+
+            if not difficulty <= xpl_target <= 10:
+                raise ValueError(f"Error! X-Again must be between {difficulty} and 10!")
+
+            if not 1 <= target <= (pool * 2):
+                raise ValueError("Error! Success target must be between 1 and twice your pool!")
+
+            prob = storyteller.distributions.get_chronicles_probabilities(
+                pool, difficulty, xpl_target, target
+            )
+
+            # Properly pluralize "successes", when applicable
+            success = "success"
+            if target > 1:
+                success += "es"
+
+            title = f"Statistics for {target} {success} at {pool} dice, {xpl_target}-again"
+            embed = discord.Embed(title=title)
+
+            standard = f"**Average successes:** {prob.avg:.3}\n"
+            standard += f"**{target}+ {success}:** {prob.prob:.3%}\n"
+            standard += f"**Using Willpower:** {prob.prob_wp:.3%}\n"
+            standard += f"**Exceptional success:** {prob.exceptional:.3%}\n"
+            standard += f"**Failure:** {prob.fail:.3%}"
+
+            rote = f"**Average successes:** {prob.avg_rote:.3}\n"
+            rote += f"**{target}+ {success}:** {prob.prob_rote:.3%}\n"
+            rote += f"**Using Willpower:** {prob.prob_rote_wp:.3%}\n"
+            rote += f"**Exceptional success:** {prob.exceptional_rote:.3%}\n"
+            rote += f"**Failure:** {prob.fail_rote:.3%}"
+
+            embed.add_field(name="Standard Roll", value=standard, inline=False)
+            embed.add_field(name="Rote Action", value=rote, inline=False)
+
+            await ctx.respond(embed=embed)
+        except IndexError:
+            await ctx.respond(usage, ephemeral=True)
+        except ValueError as error:
+            await ctx.respond(f"{error}\n{usage}", ephemeral=True)
+
+        # Log statistics
+        storyteller.engine.statistics.increment_stats_calculated(ctx.guild)
+
+
 def setup(bot):
     """Setup the command interface."""
     bot.add_cog(MiscCommands(bot))
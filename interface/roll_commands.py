@@ -31,7 +31,7 @@ class RollCommands(commands.Cog):
         command["syntax"] = " ".join(syntax.split())
         command["comment"] = " ".join(comment.split()) if comment else None
 
-        guild_settings = storyteller.settings.settings_for_guild(ctx.guild)
+        guild_settings = await storyteller.settings.aio.settings_for_guild(ctx.guild)
         command.update(guild_settings)
 
         # See what options the user has selected, if any. These options are all
@@ -160,7 +160,7 @@ class RollCommands(commands.Cog):
     async def chance(self, ctx):
         """Roll a chance die (primarily for CofD games)."""
         command = defaultdict(lambda: False)
-        command.update(storyteller.settings.settings_for_guild(ctx.guild))
+        command.update(await storyteller.settings.aio.settings_for_guild(ctx.guild))
 
         # A chance roll is 1d10, and you may only succeed on a 10. A 1 is a critical failure. We need to
         # override some/most server settings to make sure the roll is done correctly. As of now, the
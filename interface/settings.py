@@ -17,7 +17,7 @@ class SettingsCommands(commands.Cog):
         """View the server's settings."""
         msg = []
         for param in storyteller.settings.available_parameters:
-            value = storyteller.settings.value(ctx.guild.id, param)
+            value = await storyteller.settings.aio.value(ctx.guild.id, param)
             msg.append(f"**{param}**: `{value}`")
         msg = "\n".join(msg)
         details = "**Note:** The `prefix` parameter is deprecated and will soon be removed."
@@ -33,7 +33,7 @@ class SettingsCommands(commands.Cog):
         key: Option(str, "The key to inspect", choices=storyteller.settings.available_parameters)
     ):
         """Display detailed information on a server parameter."""
-        value = storyteller.settings.value(ctx.guild.id, key)
+        value = await storyteller.settings.aio.value(ctx.guild.id, key)
         info = storyteller.settings.parameter_information(key)
         await ctx.respond(f"{info} (Current: `{value}`)")
 
@@ -56,7 +56,7 @@ class SettingsCommands(commands.Cog):
             value = None
 
         try:
-            message = storyteller.settings.update(ctx.guild.id, key, value)
+            message = await storyteller.settings.aio.update(ctx.guild.id, key, value)
             await ctx.respond(message)
         except ValueError as err:
             await ctx.respond(err, ephemeral=True)
@@ -19,7 +19,7 @@ logging.basicConfig(level=logging.INFO)
 
 async def determine_prefix(_, message):
     """Determines the correct command prefix for the guild."""
-    return storyteller.settings.get_prefixes(message.guild)
+    return await storyteller.settings.aio.get_prefixes(message.guild)
 
 
 if (debug_guild := os.getenv("DEBUG")) is not None:
@@ -52,7 +52,7 @@ async def on_message(message):
         return
 
     # Make sure the user is invoking the bot
-    prefixes = storyteller.settings.get_prefixes(message.guild)
+    prefixes = await storyteller.settings.aio.get_prefixes(message.guild)
     used_prefix = None
     for prefix in prefixes:
         if message.clean_content.startswith(prefix):
@@ -98,6 +98,10 @@ async def on_ready():
     logging.info("Playing on %s servers.", len(bot.guilds))
     logging.info(discord.version_info)
 
+    # Load the settings of every guild in this process's shards up front
+    if os.getenv("SETTINGS_PREWARM", "").lower() in ("1", "true", "yes"):
+        await storyteller.settings.aio.prewarm([guild.id for guild in bot.guilds])
+
     await bot.change_presence(activity=discord.Game(__status_message()))
 
 
@@ -105,8 +109,8 @@ async def on_ready():
 async def on_guild_join(guild):
     """When joining a guild, log it for statistics purposes."""
     logging.info("Joining %s!", guild)
-    storyteller.settings.add_guild(guild.id)
-    storyteller.engine.statistics.add_guild(guild.id, guild.name)
+    await storyteller.settings.aio.add_guild(guild.id)
+    await storyteller.engine.statistics.aio.add_guild(guild.id, guild.name)
     await bot.change_presence(activity=discord.Game(__status_message()))
 
 
@@ -114,7 +118,7 @@ async def on_guild_join(guild):
 async def on_guild_remove(guild):
     """We don't want to keep track of guilds we no longer belong to."""
     logging.info("Removing %s.", guild)
-    storyteller.settings.remove_guild(guild.id)
+    await storyteller.settings.aio.remove_guild(guild.id)
     await bot.change_presence(activity=discord.Game(__status_message()))
 
 
@@ -122,13 +126,13 @@ async def on_guild_remove(guild):
 async def on_guild_update(before, after):
     """Sometimes guilds are renamed. Fix that."""
     if before.name != after.name:
-        storyteller.engine.statistics.rename_guild(after.id, after.name)
+        await storyteller.engine.statistics.aio.rename_guild(after.id, after.name)
 
 
 @bot.event
 async def on_guild_channel_delete(channel):
     """Removes initiative from the deleted channel."""
-    storyteller.initiative.remove_table(channel.id)
+    await storyteller.initiative.aio.remove_table(channel.id)
 
 
 @bot.event
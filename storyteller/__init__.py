@@ -4,15 +4,39 @@ import re
 
 import discord
 
-from storyteller import engine
-from storyteller import initiative
 from storyteller import roll
-from storyteller.databases import SettingsDB, InitiativeDB, StatisticsDB
 from storyteller import probabilities
+from storyteller import distributions
 from storyteller import views
 
-initiative = InitiativeDB()
-settings = SettingsDB()
+# The engine and the databases connect to the database as they're created, so
+# they're set up the first time they're used. Tools that only need the dice,
+# like the harness, can then run without a database.
+__DATABASE_ATTRIBUTES = ("engine", "initiative", "settings")
+__loading = False
+
+
+def __getattr__(name: str):
+    """Set up the engine and databases on first use."""
+    # pylint: disable=global-statement, import-outside-toplevel, redefined-outer-name
+    global __loading, engine, initiative, settings
+
+    # While loading, the engine's own modules import it circularly. Python
+    # falls back to the partly loaded module when the attribute is missing.
+    if name not in __DATABASE_ATTRIBUTES or __loading:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    __loading = True
+    try:
+        from storyteller import engine
+        from storyteller.databases import SettingsDB, InitiativeDB
+
+        initiative = InitiativeDB()
+        settings = SettingsDB()
+    finally:
+        __loading = False
+
+    return globals()[name]
 
 
 async def stringify_mentions(ctx, sentence):
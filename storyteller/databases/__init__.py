@@ -5,7 +5,18 @@ from .settings import SettingsDB
 from .initiative import InitiativeDB
 from .metamacros import MetaMacroDB
 from .statistics import StatisticsDB
+from .migrations import MigrationDB
 
 # Kludgy way of initiating the databases if they don't exist
 _ = SettingsDB()
 _ = RollDB()
+_ = MetaMacroDB()
+del _
+
+# Only the table is created, as each InitiativeDB loads every initiative table
+InitiativeDB.create_table()
+
+# Migrations change the tables created above, so they must come last. Those
+# that backfill existing data in a large table are left for
+# `python -m storyteller.migrate`.
+MigrationDB().migrate()
@@ -0,0 +1,465 @@
+"""backends.py - The database engines that a Database can run on."""
+
+# Every Database runs its queries through the process's backend, which owns
+# the connections and knows how its engine executes queries, batches, and
+# streams. There are two:
+#
+#   PostgresBackend: The shared connection pool (see connections.py). This is
+#       the default, and the only backend that supports the read replica,
+#       cross-process cache invalidation, and schema migrations.
+#   SqliteBackend: An embedded database file, chosen with a DATABASE_URL of
+#       the form sqlite:///relative/path.db or sqlite:////absolute/path.db.
+#       There is no server, so single-node deployments and benchmarks don't
+#       pay for a network hop. Only one process should use the file, as its
+#       caches aren't invalidated by other processes' writes.
+#
+# Queries are written for Postgres, with %s placeholders and psycopg2.sql
+# composables, and SqliteBackend translates them. Most need nothing more. Where
+# the engines differ (DDL, arrays, data-modifying CTEs, date functions), a
+# Database checks `self.dialect` and gives SQLite a query of its own.
+#
+# SQLite runs in WAL mode, so reads don't wait on writes. Each thread has its
+# own connection, and writers queue on the file lock for up to the pool timeout.
+# Booleans and timestamptz columns are converted as Postgres would return them,
+# lower() folds Unicode like Postgres, and similarity() stands in for pg_trgm.
+
+import difflib
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Iterator, Optional, Union
+
+import psycopg2.sql
+
+from . import connections
+
+
+class PreparedStatement:
+    """
+    A query that the server parses and plans once per connection, after which
+    it is executed by name. Queries use the usual %s placeholders.
+    """
+    # pylint: disable=too-few-public-methods
+
+    __PLACEHOLDERS = re.compile(r"%[s%]")
+
+    def __init__(self, name: str, query: Union[str, psycopg2.sql.Composable]):
+        self.name = name
+        self.query = query
+
+        # The EXECUTE statement is built on first use, once the query's
+        # placeholders have been counted
+        self.__execute = None
+
+
+    def execute(self, cursor, args: tuple):
+        """
+        Execute the statement, first preparing it if necessary.
+        Args:
+            cursor (psycopg2.extensions.cursor): A cursor on a connections.Connection
+            args (tuple): The values associated with the query
+        """
+        cursor.execute(self.prepare(cursor), args)
+
+
+    def prepare(self, cursor) -> str:
+        """
+        Prepare the statement if the cursor's connection hasn't seen it before.
+        A reconnection yields a fresh connection, so the statement is prepared
+        again automatically.
+        Args:
+            cursor (psycopg2.extensions.cursor): A cursor on a connections.Connection
+        Returns (str): The EXECUTE statement, with a %s placeholder for each value
+        """
+        if self.name not in cursor.connection.prepared:
+            cursor.execute(f"PREPARE {self.name} AS {self.__numbered(cursor)}")
+            cursor.connection.prepared.add(self.name)
+
+        return self.__execute
+
+
+    def __numbered(self, cursor) -> str:
+        """Returns the query with its %s placeholders replaced by $1, $2, etc."""
+        query = self.query
+        if isinstance(query, psycopg2.sql.Composable):
+            query = query.as_string(cursor)
+
+        count = 0
+        def number(match):
+            nonlocal count
+            if match.group() == "%%":
+                return "%"
+            count += 1
+            return f"${count}"
+
+        query = self.__PLACEHOLDERS.sub(number, query.strip().rstrip(";"))
+
+        self.__execute = f"EXECUTE {self.name}"
+        if count:
+            self.__execute += " (" + ", ".join(["%s"] * count) + ")"
+        self.__execute += ";"
+
+        return query
+
+
+class Backend(ABC):
+    """A database engine. Subclasses provide the connections and execution."""
+
+    dialect = None # "postgres" or "sqlite"
+    errors = () # The exceptions the engine raises
+    notifies = False # Whether other processes can be told of writes
+    begin = "BEGIN;" # Opens a transaction
+
+    @contextmanager
+    @abstractmethod
+    def connection(self):
+        """Use a connection for the duration of the context."""
+
+
+    @contextmanager
+    def cursor(self):
+        """Use a cursor on a connection for the duration of the context."""
+        with self.connection() as conn, conn.cursor() as cursor:
+            yield cursor
+
+
+    @abstractmethod
+    def execute(self, cursor, query, args: tuple):
+        """
+        Execute a query, or a PreparedStatement, on a cursor.
+        Args:
+            cursor: A cursor from cursor()
+            query (Union[str, psycopg2.sql.Composable, PreparedStatement]): The query
+            args (tuple): The values associated with the query
+        """
+
+
+    @abstractmethod
+    def execute_batch(self, cursor, statements: list):
+        """
+        Execute several statements, which all succeed or all fail.
+        Args:
+            cursor: A cursor from cursor()
+            statements (list): (query, args) tuples. The queries may be PreparedStatements
+        """
+
+
+    @abstractmethod
+    def stream(self, query, args: tuple, batch_size: int) -> Iterator[tuple]:
+        """
+        Iterate over a query's results, holding one batch of rows at a time.
+        Args:
+            query (Union[str, psycopg2.sql.Composable]): The query
+            args (tuple): The values associated with the query
+            batch_size (int): Rows per fetch
+        Yields (tuple): Each row of the results
+        """
+
+
+class PostgresBackend(Backend):
+    """Runs queries on a pool of Postgres connections."""
+
+    dialect = "postgres"
+    errors = (psycopg2.Error,)
+    notifies = True
+
+    __stream_names = itertools.count()
+
+    def __init__(self, pool: connections.ConnectionPool):
+        self.pool = pool
+        self.dsn = pool.dsn
+
+
+    def connection(self):
+        return self.pool.connection()
+
+
+    def execute(self, cursor, query, args: tuple):
+        if isinstance(query, PreparedStatement):
+            query.execute(cursor, args)
+        else:
+            cursor.execute(query, args)
+
+
+    def execute_batch(self, cursor, statements: list):
+        # The statements are sent in a single round trip, and the server runs
+        # them as one implicit transaction
+        commands = []
+        for query, args in statements:
+            if isinstance(query, PreparedStatement):
+                query = query.prepare(cursor)
+            commands.append(cursor.mogrify(query, args).rstrip().rstrip(b";"))
+
+        if commands:
+            cursor.execute(b";\n".join(commands))
+
+
+    def stream(self, query, args: tuple, batch_size: int) -> Iterator[tuple]:
+        # Rows are fetched through a named server-side cursor
+        name = f"stream_{next(self.__stream_names)}"
+
+        with self.pool.connection() as conn:
+            # A named cursor only lives as long as its transaction
+            conn.autocommit = False
+            try:
+                with conn.cursor(name) as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(query, args)
+                    yield from cursor
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+
+
+class SqliteConnection(sqlite3.Connection):
+    """A connection whose cursors accept Postgres-style queries."""
+
+    prepared = None # SQLite caches its own statements
+    closed = False # A file can't be disconnected
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or SqliteCursor)
+
+
+class SqliteCursor(sqlite3.Cursor):
+    """
+    A cursor that translates Postgres-style queries and reports a status
+    message like psycopg2's, e.g. "INSERT 0 1".
+    """
+
+    statusmessage = None
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def execute(self, query, args=()):
+        """
+        Execute a query with %s placeholders, or a composable of one.
+        Args:
+            query (Union[str, psycopg2.sql.Composable, PreparedStatement]): The query
+            args (tuple): The values associated with the query
+        Returns (SqliteCursor): The cursor
+        """
+        # pylint: disable=arguments-differ
+        if isinstance(query, PreparedStatement):
+            query = query.query
+        if isinstance(query, psycopg2.sql.Composable):
+            query = _render(query)
+
+        sql, verb = _translate(query)
+        super().execute(sql, tuple(map(_adapt, args)))
+
+        rows = max(self.rowcount, 0)
+        self.statusmessage = f"INSERT 0 {rows}" if verb == "INSERT" else f"{verb} {rows}"
+
+        return self
+
+
+
+_PLACEHOLDERS = re.compile(r"%[s%]")
+_VERB = re.compile(r"\s*(\w+)")
+
+
+@lru_cache(maxsize=1024)
+def _translate(query: str) -> tuple:
+    """Returns a query with SQLite's ? placeholders, and its leading keyword."""
+    sql = _PLACEHOLDERS.sub(lambda match: "?" if match.group() == "%s" else "%", query)
+    verb = _VERB.match(sql)
+
+    return sql, verb.group(1).upper() if verb else ""
+
+
+def _render(composable: psycopg2.sql.Composable) -> str:
+    """
+    Render a psycopg2.sql composable without a Postgres connection. Only the
+    composables that the queries use are supported.
+    """
+    if isinstance(composable, psycopg2.sql.Composed):
+        return "".join(map(_render, composable.seq))
+    if isinstance(composable, psycopg2.sql.SQL):
+        return composable.string
+    if isinstance(composable, psycopg2.sql.Identifier):
+        return ".".join('"' + part.replace('"', '""') + '"' for part in composable.strings)
+    if isinstance(composable, psycopg2.sql.Placeholder) and not composable.name:
+        return "%s"
+
+    raise TypeError(f"Can't render {composable!r} for SQLite")
+
+
+class SqliteBackend(Backend):
+    """Runs queries on an embedded SQLite database."""
+
+    dialect = "sqlite"
+    errors = (sqlite3.Error,)
+    notifies = False
+    begin = "BEGIN IMMEDIATE;" # Take the write lock up front, so commits can't deadlock
+
+    def __init__(self, path: str, timeout: float):
+        """
+        Open the database, creating it if necessary.
+        Args:
+            path (str): The database file
+            timeout (float): Seconds a writer waits for another to finish
+        """
+        if sqlite3.sqlite_version_info < (3, 35):
+            raise RuntimeError(f"SQLite 3.35 or later is required, not {sqlite3.sqlite_version}")
+
+        self.path = path
+        self.timeout = timeout
+        self.__local = threading.local()
+
+        # Converters only apply to the columns of connections that detect types,
+        # which are this backend's own. Values are adapted by SqliteCursor, as
+        # adapters would apply to every connection in the process.
+        sqlite3.register_converter("boolean", lambda value: value != b"0")
+        sqlite3.register_converter(
+            "timestamptz", lambda value: datetime.fromisoformat(value.decode())
+        )
+
+        with self.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL;")
+
+
+    @contextmanager
+    def connection(self):
+        if (conn := getattr(self.__local, "conn", None)) is None:
+            conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                factory=SqliteConnection,
+            )
+            conn.execute("PRAGMA foreign_keys=ON;")
+            conn.execute("PRAGMA synchronous=NORMAL;") # Durable enough in WAL mode
+            conn.create_function("lower", 1, _lower, deterministic=True)
+            conn.create_function("similarity", 2, _similarity, deterministic=True)
+            self.__local.conn = conn
+
+        yield conn
+
+
+    def execute(self, cursor, query, args: tuple):
+        cursor.execute(query, args)
+
+
+    def execute_batch(self, cursor, statements: list):
+        # There's no round trip to save, but the statements must still succeed
+        # or fail together, inside a transaction or out
+        cursor.execute("SAVEPOINT batch;")
+        try:
+            for query, args in statements:
+                cursor.execute(query, args)
+        except BaseException:
+            cursor.execute("ROLLBACK TO batch;")
+            cursor.execute("RELEASE batch;")
+            raise
+        cursor.execute("RELEASE batch;")
+
+
+    def stream(self, query, args: tuple, batch_size: int) -> Iterator[tuple]:
+        with self.cursor() as cursor:
+            cursor.arraysize = batch_size
+            cursor.execute(query, args)
+            while rows := cursor.fetchmany():
+                yield from rows
+
+
+def _adapt(value):
+    """
+    Returns a query parameter as SQLite stores it. Lists become JSON arrays, for
+    json_each() to stand in for Postgres arrays.
+    """
+    if isinstance(value, list):
+        return json.dumps(value)
+    if isinstance(value, datetime):
+        return _timestamp(value)
+    return value
+
+
+def _timestamp(value: datetime) -> str:
+    """Returns a datetime as ISO 8601 text in UTC, so timestamps sort as text."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.isoformat(sep=" ")
+
+
+def _lower(value: Optional[str]) -> Optional[str]:
+    """SQLite's lower() only folds ASCII, where Postgres's folds all of Unicode."""
+    return value.lower() if isinstance(value, str) else value
+
+
+def _similarity(first: Optional[str], second: Optional[str]) -> float:
+    """
+    Score how alike two strings are, from 0 to 1, for the similar macro
+    suggestions. Used in place of pg_trgm's similarity(), which it approximates.
+    """
+    if first is None or second is None:
+        return None
+    return difflib.SequenceMatcher(None, first.lower(), second.lower()).ratio()
+
+
+__backend = None
+__backend_pid = None
+__backend_lock = threading.Lock()
+
+
+def shared_backend() -> Backend:
+    """
+    Retrieve the process's backend, creating it if necessary. DATABASE_URL
+    chooses the engine. A forked worker gets a backend of its own.
+    Returns (Backend): The shared backend
+    """
+    global __backend, __backend_pid # pylint: disable=global-statement,invalid-name
+
+    with __backend_lock:
+        if __backend is None or __backend_pid != os.getpid():
+            url = os.environ["DATABASE_URL"]
+            if url.startswith("sqlite://"):
+                __backend = SqliteBackend(
+                    sqlite_path(url), timeout=float(os.environ.get("DATABASE_POOL_TIMEOUT", 10))
+                )
+            else:
+                __backend = PostgresBackend(connections.shared_pool())
+            __backend_pid = os.getpid()
+
+        return __backend
+
+
+def shared_replica() -> Optional[PostgresBackend]:
+    """
+    Retrieve the process's read-replica backend, if it has one. Only Postgres
+    has replicas.
+    Returns (Optional[PostgresBackend]): The replica, or None
+    """
+    if shared_backend().dialect != "postgres":
+        return None
+
+    if (pool := connections.shared_replica_pool()) is None:
+        return None
+
+    return PostgresBackend(pool)
+
+
+def sqlite_path(url: str) -> str:
+    """
+    Find the database file in a SQLite URL.
+    Args:
+        url (str): sqlite:///relative/path.db or sqlite:////absolute/path.db
+    Returns (str): The file's path
+    Raises: ValueError if the URL names no file
+    """
+    if not (path := url[len("sqlite:///"):]) or not url.startswith("sqlite:///"):
+        raise ValueError(f"Invalid SQLite database URL: {url}")
+    return path
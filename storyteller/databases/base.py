@@ -1,40 +1,430 @@
-"""base.py - Defines the base database class using postgres and autocommit."""
+"""base.py - Defines the base database class, which runs on the process's backend."""
 # pylint: disable=no-member
 
+import asyncio
+import functools
+import logging
 import os
-from typing import Union
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Union
 
+import psycopg2.pool
 import psycopg2.sql
 
+from . import backends, connections
+from .backends import PreparedStatement
+
+# Rows fetched at a time by Database._stream()
+STREAM_BATCH_SIZE = int(os.environ.get("DATABASE_STREAM_BATCH_SIZE", 1000))
+
+# Seconds after a write during which its owner's reads skip the replica
+REPLICA_LAG = float(os.environ.get("DATABASE_REPLICA_LAG", 10))
+
+# Seconds to leave the replica alone after it fails
+REPLICA_RETRY = float(os.environ.get("DATABASE_REPLICA_RETRY", 30))
+
+# Errors on the replica that the primary might not share
+REPLICA_ERRORS = (psycopg2.OperationalError, psycopg2.pool.PoolError)
+
+
+class Transaction:
+    """Statements run through a Transaction are committed or rolled back together."""
+
+    def __init__(self, backend: backends.Backend, cursor):
+        self.__backend = backend
+        self.__cursor = cursor
+
+
+    def execute(self, query, *args) -> str:
+        """
+        Execute a query within the transaction.
+        Args:
+            query (Union[str, psycopg2.sql.Composable, PreparedStatement]): The query
+            *args: The values associated with the query
+        Returns (str): The status message returned by the server, e.g. "UPDATE 1"
+        """
+        self.__backend.execute(self.__cursor, query, args)
+        return self.__cursor.statusmessage
+
+
+    def execute_batch(self, statements: list):
+        """
+        Execute several statements within the transaction in one round trip.
+        Args:
+            statements (list): (query, args) tuples
+        """
+        self.__backend.execute_batch(self.__cursor, statements)
+
+
+    def fetchone(self, query, *args) -> Optional[tuple]:
+        """
+        Execute a query within the transaction and fetch the first row of the results.
+        Args:
+            query (Union[str, psycopg2.sql.Composable, PreparedStatement]): The query
+            *args: The values associated with the query
+        Returns (Optional[tuple]): The first row, or None if there were no results
+        """
+        self.__backend.execute(self.__cursor, query, args)
+        return self.__cursor.fetchone()
+
+
+    def fetchall(self, query, *args) -> list:
+        """
+        Execute a query within the transaction and fetch every row of the results.
+        Args:
+            query (Union[str, psycopg2.sql.Composable, PreparedStatement]): The query
+            *args: The values associated with the query
+        Returns (list): The rows of the results
+        """
+        self.__backend.execute(self.__cursor, query, args)
+        return self.__cursor.fetchall()
+
 
 class Database:
-    """Base database class. This should never be instantiated directly."""
+    """
+    Base database class. This should never be instantiated directly.
+
+    Every Database shares the process's backend (see backends.py), usually
+    its Postgres connection pool. Each query checks out a connection and opens
+    its own cursor, so instances hold no connection of their own and are safe
+    to share between threads. Queries that differ between engines check
+    `self.dialect`.
+
+    Coroutines should use the awaitable versions of the public methods, which
+    run on the database executor: `await database.aio.method(...)`.
+
+    Hot queries should be registered with _prepare() and the resulting
+    PreparedStatement passed to _execute(), _fetchone(), or _fetchall() in
+    place of the query.
+
+    Statements that must succeed or fail together belong in a transaction:
+        with self._transaction() as transaction:
+            transaction.execute(...)
+
+    Queries that may return a great many rows should be iterated with
+    _stream(), which holds only one batch of rows in memory at a time.
+
+    Reads that can tolerate replication lag pass replica=True to _fetchone(),
+    _fetchall(), or _stream(), and are sent to the read replica if there is
+    one. Should the replica fail, they fall back to the primary, which serves
+    every read for the next REPLICA_RETRY seconds. So that users see their own
+    changes, writes record their owner with _wrote(), and reads given the same
+    owner stay on the primary for REPLICA_LAG seconds after. A write owned by
+    ("macros", guild, None) covers the reads of every user in the guild.
+    """
     # pylint: disable=too-few-public-methods
 
+    # Statement names are per connection, and every Database shares the same
+    # connections, so the names are registered across all subclasses
+    __statements = {}
+
+    # Owners whose reads must see their recent writes, oldest write first
+    __writes = OrderedDict()
+    __writes_lock = threading.Lock()
+    __replica_down_until = 0.0
+
     def __init__(self):
-        self.conn = psycopg2.connect(os.environ["DATABASE_URL"], sslmode="require")
-        self.conn.autocommit = True
-        self.cursor = self.conn.cursor()
+        self.backend = backends.shared_backend()
+        self.replica = backends.shared_replica()
+        self.dialect = self.backend.dialect
+        self.aio = AsyncDatabase(self)
+
+
+    def _prepare(self, name: str, query: Union[str, psycopg2.sql.Composable]) -> PreparedStatement:
+        """
+        Register a query to be prepared on each connection the first time it's used.
+        Args:
+            name (str): A name for the statement, unique across every Database
+            query (Union[str, psycopg2.sql.Composable]): The SQL query, with %s placeholders
+        Returns (PreparedStatement): The statement, to be executed like any other query
+        Raises: ValueError if the name is already registered to a different query
+        """
+        statement = Database.__statements.get(name)
+        if statement is None:
+            statement = PreparedStatement(name, query)
+            Database.__statements[name] = statement
+        elif statement.query != query:
+            raise ValueError(f"The prepared statement {name} is already registered")
+
+        return statement
+
+
+    def _execute(
+        self, query: Union[str, psycopg2.sql.SQL], *args, idempotent: bool = False
+    ) -> str:
+        """
+        Execute the specified query. If the connection is lost, the query is
+        retried once on a new connection, but only if it is idempotent.
+        Args:
+            query (Union[str, psycopg2.sql.SQL]): The SQL query to execute
+            *args: The values associated with the query
+            idempotent (bool): Whether running the query twice is harmless
+        Returns (str): The status message returned by the server, e.g. "UPDATE 1"
+        """
+        return self.__run(query, args, lambda cursor: cursor.statusmessage, idempotent)
+
+
+    def _execute_batch(self, statements: list, idempotent: bool = False):
+        """
+        Execute several statements in a single round trip. They run as one
+        implicit transaction, so they all succeed or all fail. (SQLite has no
+        round trips, so it simply runs them in turn.)
+        Args:
+            statements (list): (query, args) tuples. The queries may be PreparedStatements
+            idempotent (bool): Whether running the batch twice is harmless
+        """
+        statements = list(statements)
+        self.__run(statements, (), lambda cursor: None, idempotent)
+
+
+    def _fetchone(
+        self, query: Union[str, psycopg2.sql.SQL], *args,
+        replica: bool = False, owner: Optional[tuple] = None, idempotent: bool = False
+    ) -> Optional[tuple]:
+        """
+        Execute the specified query and fetch the first row of the results.
+        Args:
+            query (Union[str, psycopg2.sql.SQL]): The SQL query to execute
+            *args: The values associated with the query
+            replica (bool): Whether the query may be sent to the read replica
+            owner (Optional[tuple]): Whose data is read, for read-your-writes
+            idempotent (bool): Whether running the query twice is harmless, as
+                               it is for reads. If so, it's retried once if
+                               the connection is lost
+        Returns (Optional[tuple]): The first row, or None if there were no results
+        """
+        backend = self.__read_backend(replica, owner)
+        return self.__run(query, args, lambda cursor: cursor.fetchone(), idempotent, backend)
 
 
-    def _execute(self, query: Union[str, psycopg2.sql.SQL], *args):
+    def _fetchall(
+        self, query: Union[str, psycopg2.sql.SQL], *args,
+        replica: bool = False, owner: Optional[tuple] = None, idempotent: bool = False
+    ) -> list:
         """
-        Execute the specified query. Tries to reconnect to the database if there's an error.
+        Execute the specified query and fetch every row of the results.
         Args:
             query (Union[str, psycopg2.sql.SQL]): The SQL query to execute
             *args: The values associated with the query
-            **kwargs: Used for determining if this is a second execution attempt
+            replica (bool): Whether the query may be sent to the read replica
+            owner (Optional[tuple]): Whose data is read, for read-your-writes
+            idempotent (bool): Whether running the query twice is harmless, as
+                               it is for reads. If so, it's retried once if
+                               the connection is lost
+        Returns (list): The rows of the results
+        """
+        backend = self.__read_backend(replica, owner)
+        return self.__run(query, args, lambda cursor: cursor.fetchall(), idempotent, backend)
+
+
+    def _wrote(self, owner: tuple):
+        """
+        Record that an owner's data has just changed, so that their reads stay
+        on the primary until the replica has caught up.
+        Args:
+            owner (tuple): Identifies whose data changed, e.g. ("macros", guild, user)
+        """
+        if self.replica is None:
+            return
+
+        now = time.monotonic()
+        with Database.__writes_lock:
+            Database.__writes[owner] = now
+            Database.__writes.move_to_end(owner)
+
+            # Forget writes the replica has had time to catch up with
+            while next(iter(Database.__writes.values())) < now - REPLICA_LAG:
+                Database.__writes.popitem(last=False)
+
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run statements on a single connection in one transaction. It commits
+        when the context exits and rolls back if it exits with an exception.
+        Transactions aren't retried if the connection is lost.
+        Yields (Transaction): Executes the transaction's statements
+        Raises: connections.ConnectionLost if the connection is lost
+        """
+        with self.backend.cursor() as cursor:
+            cursor.execute(self.backend.begin)
+            try:
+                yield Transaction(self.backend, cursor)
+            except BaseException:
+                if not cursor.connection.closed:
+                    cursor.execute("ROLLBACK;")
+                raise
+            cursor.execute("COMMIT;")
+
+
+    def _stream(
+        self, query: Union[str, psycopg2.sql.Composable], *args, batch_size: Optional[int] = None,
+        replica: bool = False, owner: Optional[tuple] = None
+    ) -> Iterator[tuple]:
+        """
+        Iterate over a query's results, fetching a batch of rows at a time
+        (through a named server-side cursor on Postgres). The connection stays checked out
+        until the iterator is exhausted or closed, so iterate it promptly.
+        Streams aren't retried if the connection is lost, as some of the rows
+        may already have been used. PreparedStatements can't be streamed.
+        Args:
+            query (Union[str, psycopg2.sql.Composable]): The SQL query to execute
+            *args: The values associated with the query
+            batch_size (Optional[int]): Rows per fetch. STREAM_BATCH_SIZE if not given
+            replica (bool): Whether the query may be sent to the read replica
+            owner (Optional[tuple]): Whose data is read, for read-your-writes
+        Yields (tuple): Each row of the results
+        Raises: connections.ConnectionLost if the connection is lost
+        """
+        # pylint: disable=too-many-arguments
+        batch_size = batch_size or STREAM_BATCH_SIZE
+
+        backend = self.__read_backend(replica, owner)
+        if backend is not self.backend:
+            # Fall back to the primary only if the replica fails before the
+            # first row, as later rows can't be fetched again without repeats
+            rows = backend.stream(query, args, batch_size)
+            try:
+                first = next(rows, None)
+            except REPLICA_ERRORS:
+                self.__fall_back()
+            else:
+                if first is not None:
+                    yield first
+                    yield from rows
+                return
+
+        yield from self.backend.stream(query, args, batch_size)
+
+
+    def __read_backend(self, replica: bool, owner: Optional[tuple]) -> backends.Backend:
+        """
+        Choose the backend for a read.
+        Args:
+            replica (bool): Whether the read may be sent to the replica
+            owner (Optional[tuple]): Whose data is read. If they wrote recently,
+                                     the read goes to the primary
+        Returns (backends.Backend): The replica or the primary
+        """
+        if not replica or self.replica is None:
+            return self.backend
+
+        if time.monotonic() < Database.__replica_down_until:
+            return self.backend
+
+        if owner is not None:
+            # A write owned by (cache, guild, None) changed every user in the guild
+            owners = [owner]
+            if len(owner) == 3:
+                owners.append((*owner[:2], None))
+
+            with Database.__writes_lock:
+                written = [Database.__writes.get(key) for key in owners]
+            recent = time.monotonic() - REPLICA_LAG
+            if any(when is not None and when >= recent for when in written):
+                return self.backend
+
+        return self.replica
+
+
+    @staticmethod
+    def __fall_back():
         """
+        Note that a read is falling back to the primary after the replica
+        failed, and send reads to the primary for the next REPLICA_RETRY seconds.
+        """
+        logging.warning("Read replica query failed. Using the primary for %ss", REPLICA_RETRY)
+        connections.count("replica_fallbacks")
+        Database.__replica_down_until = time.monotonic() + REPLICA_RETRY
+
+
+    def __run(self, query, args: tuple, result: Callable, idempotent: bool, backend=None):
+        """
+        Run a query and extract its result, retrying once if the connection is
+        lost and the query is idempotent. A query sent to the replica falls
+        back to the primary if the replica fails.
+        Args:
+            query (Union[str, psycopg2.sql.SQL]): The SQL query to execute
+            args (tuple): The values associated with the query
+            result (Callable): Extracts the result from the cursor
+            idempotent (bool): Whether the query may safely be retried
+            backend (Optional[backends.Backend]): The backend to use. The primary if None
+        Raises: connections.ConnectionLost if the query can't be completed
+        """
+        # pylint: disable=too-many-arguments
+        if backend is not None and backend is not self.backend:
+            try:
+                return self.__attempt(backend, query, args, result)
+            except REPLICA_ERRORS:
+                self.__fall_back()
+
         try:
-            # Check first if the database connection is still valid
-            self.cursor.execute("SELECT 1")
-        except psycopg2.Error:
-            # Though we are going to attempt to reconnect to the database,
-            # technically this will catch other errors as well, such as bad
-            # SQL syntax. We will trust that our syntax is correct, given it is
-            # programmatically generated.
-            self.conn = psycopg2.connect(os.environ["DATABASE_URL"], sslmode="require")
-            self.conn.autocommit = True
-            self.cursor = self.conn.cursor()
-        finally:
-            self.cursor.execute(query, args)
+            return self.__attempt(self.backend, query, args, result)
+        except connections.ConnectionLost:
+            if not idempotent:
+                raise
+
+            logging.warning("Database connection lost. Retrying query")
+            connections.count("retries")
+
+            return self.__attempt(self.backend, query, args, result)
+
+
+    @staticmethod
+    def __attempt(backend: backends.Backend, query, args: tuple, result: Callable):
+        """Run a query on one of the backend's connections and extract its result."""
+        with backend.cursor() as cursor:
+            if isinstance(query, list):
+                backend.execute_batch(cursor, query)
+            else:
+                backend.execute(cursor, query, args)
+            return result(cursor)
+
+
+class AsyncDatabase:
+    """Awaitable versions of a Database's methods, run on the database executor."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, database: Database):
+        self.__database = database
+
+
+    def __getattr__(self, name: str):
+        """
+        Wrap one of the database's methods in a coroutine function.
+        Args:
+            name (str): The name of the method
+        Returns (Callable): A coroutine function with the method's signature
+        """
+        if name.startswith("_"):
+            raise AttributeError(f"{name} is not a public database method")
+
+        method = getattr(self.__database, name)
+        if not callable(method):
+            raise AttributeError(f"{name} is not a public database method")
+
+        @functools.wraps(method)
+        async def awaitable(*args, **kwargs):
+            return await self._run(method, *args, **kwargs)
+
+        # Cache the wrapper so it's only built once
+        setattr(self, name, awaitable)
+
+        return awaitable
+
+
+    @staticmethod
+    async def _run(method: Callable, *args, **kwargs):
+        """
+        Run one of the database's methods on the database executor.
+        Args:
+            method (Callable): The bound method
+        Returns (any): The method's result
+        """
+        loop = asyncio.get_running_loop()
+        call = functools.partial(method, *args, **kwargs)
+
+        return await loop.run_in_executor(connections.shared_executor(), call)
@@ -0,0 +1,280 @@
+"""connections.py - A process-wide pool of database connections."""
+
+# Every Database subclass used to open its own connection, and the bot creates
+# several of them at import, so each worker process held half a dozen idle
+# connections. Instead, every Database shares a single pool per process. A
+# connection is checked out for the duration of one operation and given a
+# fresh cursor, then returned to the pool. (An embedded SQLite database needs
+# no pool; see backends.py.)
+#
+# Connections aren't probed before use. Instead, a query that fails because its
+# connection was lost raises ConnectionLost, and the pool discards the broken
+# connection along with every idle one (they most likely went down together).
+# Replacements are opened with exponential backoff. Database retries lost
+# queries once if they are idempotent. The events are tallied in `counters`.
+#
+# The pool is configured with environment variables:
+#   DATABASE_POOL_MIN: Connections opened up front (default 1)
+#   DATABASE_POOL_MAX: The most connections the process may hold (default 5)
+#   DATABASE_POOL_TIMEOUT: Seconds to wait for a free connection (default 10)
+#
+# Reads that can tolerate a little replication lag may be sent to a read
+# replica, configured with DATABASE_REPLICA_URL. Its pool is sized like the
+# primary's. See Database for how reads are routed.
+#
+# Database calls block, so coroutines await them on a thread pool executor
+# instead (see Database.aio). The executor has one thread per pooled
+# connection, so its threads never wait on each other for a connection.
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+CONNECT_ATTEMPTS = 4
+BACKOFF = 0.25 # Seconds before the first reconnection retry; doubles each time
+
+# Tallies of "disconnects", "reconnects", "connect_failures", "retries", and
+# "replica_fallbacks", along with the invalidation listener's
+# "listener_disconnects" and "resyncs"
+counters = Counter()
+__counter_lock = threading.Lock()
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Raised when no connection becomes available before the checkout timeout."""
+
+
+class ConnectionLost(psycopg2.OperationalError):
+    """Raised when a query fails because its connection was lost."""
+
+
+def count(event: str):
+    """
+    Increment one of the connection event counters.
+    Args:
+        event (str): The event to count
+    """
+    with __counter_lock:
+        counters[event] += 1
+
+
+class Connection(psycopg2.extensions.connection):
+    """A connection that remembers which statements have been prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class ConnectionPool:
+    """A thread-safe pool of autocommit connections with a checkout timeout."""
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int, timeout: float):
+        """
+        Create the pool and open its initial connections.
+        Args:
+            dsn (str): The database URL
+            minconn (int): The number of connections to open immediately
+            maxconn (int): The maximum number of connections, idle or in use
+            timeout (float): Seconds to wait for a connection before giving up
+        """
+        if not 0 <= minconn <= maxconn:
+            raise ValueError(f"Invalid pool size: min {minconn}, max {maxconn}")
+
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.timeout = timeout
+
+        # Each checkout holds a slot, so there are never more than maxconn
+        # connections. Idle connections are reused most-recent first.
+        self.__slots = threading.BoundedSemaphore(maxconn)
+        self.__idle = queue.LifoQueue()
+        self.__lost = 0 # Lost connections not yet replaced
+        self.__lost_lock = threading.Lock()
+
+        for _ in range(minconn):
+            self.__idle.put(self.__connect())
+
+        logging.info("Opened connection pool (min %s, max %s)", minconn, maxconn)
+
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of the context.
+        Raises:
+            PoolTimeout if every connection is in use for longer than the timeout
+            ConnectionLost if the connection broke during the context
+        """
+        if not self.__slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+
+        try:
+            conn = self.__checkout()
+            try:
+                yield conn
+            except psycopg2.Error as err:
+                if conn.closed:
+                    self.__discard(conn)
+                    raise ConnectionLost(str(err)) from err
+                raise
+            finally:
+                if not conn.closed:
+                    self.__idle.put(conn)
+        finally:
+            self.__slots.release()
+
+
+    def close(self):
+        """Close every idle connection."""
+        while True:
+            try:
+                self.__idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+    def __checkout(self):
+        """Take an idle connection, or open a new one if there are none."""
+        try:
+            return self.__idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.__lost_lock:
+            replacing = self.__lost > 0
+            self.__lost = max(self.__lost - 1, 0)
+
+        if replacing:
+            conn = self.__reconnect()
+            count("reconnects")
+            return conn
+
+        return self.__connect()
+
+
+    def __discard(self, conn):
+        """
+        Drop a broken connection. The idle connections are dropped as well, as
+        whatever broke one connection has most likely broken them all.
+        """
+        logging.warning("Lost a database connection (closed: %s)", conn.closed)
+        count("disconnects")
+
+        with self.__lost_lock:
+            self.__lost += 1
+        self.close()
+
+
+    def __reconnect(self):
+        """
+        Open a connection to replace a lost one, backing off exponentially
+        while the database is unreachable.
+        Raises: psycopg2.OperationalError if every attempt fails
+        """
+        delay = BACKOFF
+        for _ in range(CONNECT_ATTEMPTS - 1):
+            try:
+                return self.__connect()
+            except psycopg2.OperationalError:
+                count("connect_failures")
+                logging.warning("Unable to reconnect to the database. Retrying in %ss", delay)
+                time.sleep(delay)
+                delay *= 2
+
+        return self.__connect()
+
+
+    def __connect(self):
+        """Open a new autocommit connection."""
+        conn = psycopg2.connect(self.dsn, sslmode="require", connection_factory=Connection)
+        conn.autocommit = True
+
+        return conn
+
+
+__pool = None
+__pool_pid = None
+__pool_lock = threading.Lock()
+
+
+def shared_pool() -> ConnectionPool:
+    """
+    Retrieve the process's connection pool, creating it if necessary. A forked
+    worker gets a new pool rather than sharing its parent's connections.
+    Returns (ConnectionPool): The shared pool
+    """
+    global __pool, __pool_pid # pylint: disable=global-statement,invalid-name
+
+    with __pool_lock:
+        if __pool is None or __pool_pid != os.getpid():
+            __pool = ConnectionPool(
+                os.environ["DATABASE_URL"],
+                minconn=int(os.environ.get("DATABASE_POOL_MIN", 1)),
+                maxconn=int(os.environ.get("DATABASE_POOL_MAX", 5)),
+                timeout=float(os.environ.get("DATABASE_POOL_TIMEOUT", 10)),
+            )
+            __pool_pid = os.getpid()
+
+        return __pool
+
+
+__replica_pool = None
+__replica_pool_pid = None
+
+
+def shared_replica_pool() -> Optional[ConnectionPool]:
+    """
+    Retrieve the process's read-replica pool, creating it if necessary. The
+    replica is optional, so its connections are only opened when first used.
+    Returns (Optional[ConnectionPool]): The replica pool, or None if
+                                        DATABASE_REPLICA_URL isn't set
+    """
+    global __replica_pool, __replica_pool_pid # pylint: disable=global-statement,invalid-name
+
+    if not (dsn := os.environ.get("DATABASE_REPLICA_URL")):
+        return None
+
+    with __pool_lock:
+        if __replica_pool is None or __replica_pool_pid != os.getpid():
+            __replica_pool = ConnectionPool(
+                dsn,
+                minconn=0,
+                maxconn=int(os.environ.get("DATABASE_POOL_MAX", 5)),
+                timeout=float(os.environ.get("DATABASE_POOL_TIMEOUT", 10)),
+            )
+            __replica_pool_pid = os.getpid()
+
+        return __replica_pool
+
+
+__executor = None
+__executor_pid = None
+
+
+def shared_executor() -> ThreadPoolExecutor:
+    """
+    Retrieve the process's database executor, creating it if necessary.
+    Returns (ThreadPoolExecutor): An executor with a thread per pooled connection
+    """
+    global __executor, __executor_pid # pylint: disable=global-statement,invalid-name
+
+    with __pool_lock:
+        if __executor is None or __executor_pid != os.getpid():
+            # Sized like the pool, without opening it, as SQLite doesn't use it
+            threads = int(os.environ.get("DATABASE_POOL_MAX", 5))
+            __executor = ThreadPoolExecutor(threads, thread_name_prefix="database")
+            __executor_pid = os.getpid()
+
+        return __executor
@@ -12,11 +12,13 @@
 # to "stored rolls" instead of macros. At some point in the future, a namespace
 # cleanup will be done to rectify this inconsistency.
 
+import functools
 import re
 from typing import Optional, Union
 
-import storyteller.parse
+from . import invalidation
 from .base import Database
+from .macrocache import Macro, MacroCache
 
 
 class RollDB(Database):
@@ -31,7 +33,32 @@ class RollDB(Database):
         # metamacros table has its own constraint set on the macro_id field such
         # that when a macro is removed, so too are all metamacro entries
         # referencing it.
-        self.cursor.execute(
+        if self.dialect == "sqlite":
+            self.__create_sqlite_table()
+        else:
+            self.__create_table()
+
+        # Various syntax-matching regex patterns
+        self.storex = re.compile(r"^(?P<name>[\w-]+)\s*=\s*(?P<syntax>.+)$")
+        self.commentx = re.compile(r"^(?P<name>[\w-]+)\s+c=\s*(?P<comment>.*)$")
+        self.usex = re.compile(r"^(?P<name>[\w-]+)\s*(?P<mods>(?P<sign>[+-])?\d+(?:\s[+-]?\d+)?)?$")
+        self.deletex = re.compile(r"^(?P<name>[\w-]+)\s*=$")
+        self.multiwordx = re.compile(r"[\w-]+ [\w-]+")
+
+        # Each user's macros are loaded on first use and kept up to date by
+        # the write methods below. Users whose macros are changed by another
+        # process are evicted.
+        self.macro_cache = MacroCache()
+        self.__load_macros = self._prepare(
+            "load_macros", "SELECT Name, Syntax, Comment FROM SavedRolls WHERE Guild=%s AND ID=%s;"
+        )
+        self.__bus = invalidation.bus()
+        self.__bus.subscribe("macros", self.__invalidate, self.macro_cache.clear)
+
+
+    def __create_table(self):
+        """Create the SavedRolls table as it was first released. Migrations bring it up to date."""
+        self._execute(
             """
             CREATE TABLE IF NOT EXISTS SavedRolls(
                 ID       bigint NOT NULL,
@@ -46,18 +73,45 @@ class RollDB(Database):
                         REFERENCES GuildSettings(ID)
                         ON DELETE CASCADE
             );
-            """
+            """,
+            idempotent=True
         )
 
         # Install trigrams to enable fuzzy string matching on macro names
-        self.cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        self._execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;", idempotent=True)
 
-        # Various syntax-matching regex patterns
-        self.storex = re.compile(r"^(?P<name>[\w-]+)\s*=\s*(?P<syntax>.+)$")
-        self.commentx = re.compile(r"^(?P<name>[\w-]+)\s+c=\s*(?P<comment>.*)$")
-        self.usex = re.compile(r"^(?P<name>[\w-]+)\s*(?P<mods>(?P<sign>[+-])?\d+(?:\s[+-]?\d+)?)?$")
-        self.deletex = re.compile(r"^(?P<name>[\w-]+)\s*=$")
-        self.multiwordx = re.compile(r"[\w-]+ [\w-]+")
+
+    def __create_sqlite_table(self):
+        """
+        Create the SavedRolls table on SQLite, which starts with the schema the
+        migrations give Postgres, minus the partitioning. The backend provides
+        similarity() in place of trigrams.
+        """
+        self._execute(
+            """
+            CREATE TABLE IF NOT EXISTS SavedRolls(
+                ID       bigint  NOT NULL,
+                Name     Text    NOT NULL,
+                Syntax   Text    NOT NULL,
+                Guild    bigint  NOT NULL,
+                Comment  Text    NULL,
+                macro_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                UNIQUE (Guild, macro_id),
+                CONSTRAINT fk_guild
+                    FOREIGN KEY (Guild)
+                        REFERENCES GuildSettings(ID)
+                        ON DELETE CASCADE
+            );
+            """,
+            idempotent=True
+        )
+        self._execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS savedrolls_owner_name_unique
+                ON SavedRolls (Guild, ID, lower(Name));
+            """,
+            idempotent=True
+        )
 
 
     def query_saved_rolls(self, guild: int, userid: int, command: dict) -> Union[str, dict]:
@@ -78,8 +132,13 @@ class RollDB(Database):
         # Store a new macro or change an old one
         match = self.storex.match(syntax)
         if match:
+            # The parser needs the engine, which needs this module, so it's
+            # imported once the engine is loaded
+            # pylint: disable=import-outside-toplevel, cyclic-import
+            from storyteller.parse import is_valid_roll
+
             syntax = match.group("syntax")
-            if storyteller.parse.is_valid_roll(syntax):
+            if is_valid_roll(syntax):
                 name = match.group("name")
                 return self.__store_roll(guild, userid, name, syntax, comment)
             return f"Sorry, `{syntax}` is invalid roll syntax!"
@@ -188,10 +247,15 @@ class RollDB(Database):
             userid (int): The Discord ID of the invoking user
         Returns (int): The number of macros owned by the user
         """
-        # Get the macro count
+        # The cache holds every one of a user's macros, so it can answer alone
+        if (macros := self.macro_cache.cached(guildid, userid)) is not None:
+            return len(macros)
+
         query = "SELECT COUNT(*) FROM SavedRolls WHERE Guild=%s AND ID=%s;"
-        self._execute(query, guildid, userid)
-        macro_count = self.cursor.fetchone()[0]
+        owner = ("macros", guildid, userid)
+        macro_count = self._fetchone(
+            query, guildid, userid, replica=True, owner=owner, idempotent=True
+        )[0]
 
         return macro_count
 
@@ -208,31 +272,40 @@ class RollDB(Database):
         """
         # pylint: disable=too-many-arguments
 
-        # Inserting a new macro
-        if not self.__macro_exists(guild, userid, name):
-            # Create the roll
-            query = "INSERT INTO SavedRolls VALUES (%s, %s, %s, %s, %s);"
-            self._execute(query, userid, name, syntax, guild, comment)
-
+        # An upsert, so concurrent saves of the same name can't race
+        existing = "SELECT 1 FROM SavedRolls WHERE Guild=%s AND ID=%s AND lower(Name)=lower(%s)"
+        upsert = """
+            INSERT INTO SavedRolls (ID, Name, Syntax, Guild, Comment)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (Guild, ID, lower(Name)) DO UPDATE
+                SET Syntax=EXCLUDED.Syntax, Comment=COALESCE(EXCLUDED.Comment, SavedRolls.Comment)
+            RETURNING Name, Syntax, Comment
+        """
+        if self.dialect == "sqlite":
+            # SQLite would show the upserted row to Existing below, so the
+            # check comes first, in a transaction that holds the write lock
+            with self._transaction() as transaction:
+                inserted = transaction.fetchone(existing, guild, userid, name) is None
+                stored = transaction.fetchone(upsert, userid, name, syntax, guild, comment)
+        else:
+            # Existing shares the upsert's snapshot, so it shows whether the macro
+            # was already there. (SavedRolls is partitioned, so xmax can't be used.)
+            query = f"""
+                WITH Existing AS ({existing})
+                {upsert.strip()}, NOT EXISTS (SELECT 1 FROM Existing);
+            """
+            # Not idempotent: if a lost connection hid a commit, a rerun would
+            # report a newly saved macro as updated
+            args = (guild, userid, name, userid, name, syntax, guild, comment)
+            *stored, inserted = self._fetchone(query, *args)
+        self._wrote(("macros", guild, userid))
+        self.macro_cache.put(guild, userid, Macro(*stored))
+        self.__bus.publish("macros", guild, userid)
+
+        if inserted:
             return f"Saved new macro: `{name}`."
-
-        # UPDATING AN OLD MACRO
-
-        # Updating both syntax and comment
         if comment:
-            query = """
-                UPDATE SavedRolls
-                SET Syntax=%s, Comment=%s
-                WHERE ID=%s AND Guild=%s AND Name ILIKE %s;
-            """
-            self._execute(query, syntax, comment, userid, guild, name)
-
             return f"Updated `{name}` syntax and comment."
-
-        # Update only the syntax
-        query = "UPDATE SavedRolls SET Syntax=%s WHERE ID=%s AND Guild=%s AND Name ILIKE %s;"
-        self._execute(query, syntax, userid, guild, name)
-
         return f"Updated `{name}` syntax."
 
 
@@ -246,16 +319,36 @@ class RollDB(Database):
             comment (str): The comment to add
         Returns (str): A confirmation message
         """
-        if self.__macro_exists(guild, userid, name):
-            if len(comment) == 0:
-                comment = None
+        if len(comment) == 0:
+            comment = None
+
+        query = """
+            UPDATE SavedRolls SET Comment=%s
+            WHERE ID=%s AND Guild=%s AND lower(Name)=lower(%s)
+            RETURNING Name, Syntax, Comment;
+        """
+        stored = self._fetchone(query, comment, userid, guild, name)
 
-            query = "UPDATE SavedRolls SET Comment=%s WHERE ID=%s AND Guild=%s AND Name ILIKE %s;"
-            self._execute(query, comment, userid, guild, name)
+        if stored is None:
+            return f"Unable to update. You don't have a roll named `{name}`!"
 
-            return f"Updated comment for `{name}`."
+        self._wrote(("macros", guild, userid))
+        self.macro_cache.put(guild, userid, Macro(*stored))
+        self.__bus.publish("macros", guild, userid)
 
-        return f"Unable to update. You don't have a roll named `{name}`!"
+        return f"Updated comment for `{name}`."
+
+
+    def __invalidate(self, guild: int, userid: Optional[int] = None):
+        """
+        Evict macros that another process, or a guild's removal, has changed.
+        Until the read replica catches up, the macros are loaded from the primary.
+        Args:
+            guild (int): The Discord ID of the guild
+            userid (Optional[int]): The Discord ID of the user. If None, every user
+        """
+        self._wrote(("macros", guild, userid))
+        self.macro_cache.evict(guild, userid)
 
 
     def retrieve_macro(self, guild: int, userid: int, name: str) -> Optional[tuple]:
@@ -267,11 +360,28 @@ class RollDB(Database):
             name (str): The name of the macro to retrieve
         Returns (Optional[tuple]): The macro's syntax and comment
         """
-        query = "SELECT Syntax, Comment FROM SavedRolls WHERE Guild=%s AND ID=%s AND Name ILIKE %s;"
-        self._execute(query, guild, userid, name)
-        result = self.cursor.fetchone()
+        if (macro := self.__cached_macro(guild, userid, name)) is not None:
+            return (macro.syntax, macro.comment)
+
+        return None
+
+
+    def __cached_macro(self, guild: int, userid: int, name: str) -> Optional[Macro]:
+        """
+        Retrieve a macro from the cache, loading all of the user's macros in the
+        guild if they aren't cached yet.
+        Args:
+            guild (int): The Discord ID of the guild associated with the macro
+            userid (int): The Discord ID of the invoking user
+            name (str): The name of the macro to retrieve
+        Returns (Optional[Macro]): The macro's name, syntax, and comment
+        """
+        load = functools.partial(
+            self._fetchall, self.__load_macros, guild, userid,
+            replica=True, owner=("macros", guild, userid), idempotent=True
+        )
 
-        return result
+        return self.macro_cache.get(guild, userid, name, load)
 
 
     def __find_similar_macro(self, guild: int, userid: int, name: str) -> Optional[str]:
@@ -284,9 +394,16 @@ class RollDB(Database):
             name (str): The name of the macro whose likeness we are trying to find
         Returns (Optional[str]): The closest matching macro name
         """
-        query = "SELECT Name FROM SavedRolls WHERE Guild=%s AND ID=%s AND SIMILARITY(Name, %s)>0.2;"
-        self._execute(query, guild, userid, name)
-        result = self.cursor.fetchone()
+        query = """
+            SELECT Name FROM SavedRolls
+            WHERE Guild=%s AND ID=%s AND SIMILARITY(Name, %s)>0.2
+            ORDER BY SIMILARITY(Name, %s) DESC
+            LIMIT 1;
+        """
+        owner = ("macros", guild, userid)
+        result = self._fetchone(
+            query, guild, userid, name, name, replica=True, owner=owner, idempotent=True
+        )
 
         if result:
             return result[0]
@@ -303,11 +420,18 @@ class RollDB(Database):
             name (str): The name of the macro to delete
         Returns (str): A status message
         """
-        if not self.__macro_exists(guild, userid, name):
+        query = """
+            DELETE FROM SavedRolls WHERE Guild=%s AND ID=%s AND lower(Name)=lower(%s)
+            RETURNING Name;
+        """
+        deleted = self._fetchone(query, guild, userid, name)
+        self._wrote(("macros", guild, userid))
+        self.macro_cache.discard(guild, userid, name)
+
+        if deleted is None:
             return f"Can't delete. `{name}` not found!"
 
-        query = "DELETE FROM SavedRolls WHERE Guild=%s AND ID=%s AND Name ILIKE %s;"
-        self._execute(query, guild, userid, name)
+        self.__bus.publish("macros", guild, userid)
 
         return f"`{name}` deleted! It has also been removed from any meta-macros containing it."
 
@@ -320,7 +444,10 @@ class RollDB(Database):
             userid (int): The Discord ID of the user whose macros will be deleted
         """
         query = "DELETE FROM SavedRolls WHERE Guild=%s AND ID=%s;"
-        self._execute(query, guild, userid)
+        self._execute(query, guild, userid, idempotent=True)
+        self._wrote(("macros", guild, userid))
+        self.macro_cache.evict(guild, userid)
+        self.__bus.publish("macros", guild, userid)
 
 
     def stored_rolls(self, guild: int, userid: int) -> list:
@@ -333,11 +460,10 @@ class RollDB(Database):
         """
         query = """SELECT Name, Syntax, Comment FROM SavedRolls WHERE Guild=%s AND ID=%s
                    ORDER BY Name;"""
-        self._execute(query, guild, userid)
-        results = self.cursor.fetchall()
 
         fields = []
-        for row in results:
+        owner = ("macros", guild, userid)
+        for row in self._stream(query, guild, userid, replica=True, owner=owner):
             name = row[0]
             syntax = row[1]
             comment = row[2]
@@ -348,14 +474,3 @@ class RollDB(Database):
             fields.append((name, syntax))
 
         return fields
-
-
-    def __macro_exists(self, guild: int, userid: int, name: str) -> bool:
-        """
-        Determine whether the user has a specific macro in a given guild.
-        Args:
-            guild (int): The Discord ID of the guild from which to search
-            userid (int): The Discord ID of the user performing the search
-            name (str): The name of the macro to search for
-        """
-        return self.retrieve_macro(guild, userid, name) is not None
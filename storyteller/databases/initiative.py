@@ -1,8 +1,10 @@
 """initiative.py - Database for handling initiative."""
 
 from collections import defaultdict
+from typing import Optional
 
 from storyteller.initiative import InitiativeManager
+from . import invalidation
 from .base import Database
 
 
@@ -11,11 +13,38 @@ class InitiativeDB(Database):
 
     def __init__(self):
         super().__init__()
+        self.__create_table()
 
+        self.__tables = self.__fetch_initiative_tables(replica=True)
+
+        self.__insert = self._prepare(
+            "insert_initiative", "INSERT INTO Initiative VALUES (%s, %s, %s, %s, %s, %s);"
+        )
+        self.__remove = self._prepare(
+            "remove_initiative", "DELETE FROM Initiative WHERE Channel=%s AND Character=%s;"
+        )
+
+        self.__bus = invalidation.bus()
+        self.__bus.subscribe("initiative", self.__reload_table, self.__reload_tables)
+
+
+    @classmethod
+    def create_table(cls):
+        """
+        Create the initiative table if it doesn't exist, without loading the
+        tables or subscribing to changes, as creating an InitiativeDB would.
+        """
+        database = cls.__new__(cls)
+        Database.__init__(database)
+        database.__create_table()
+
+
+    def __create_table(self):
+        """Create the initiative table and, on SQLite, its index."""
         # Create the initiative table. The foreign key constraint means that if
         # the guild removes the bot or is deleted, all initiative records will
         # automatically be removed.
-        self.cursor.execute(
+        self._execute(
             """
             CREATE TABLE IF NOT EXISTS Initiative(
                 Channel   bigint NOT NULL,
@@ -29,16 +58,25 @@ class InitiativeDB(Database):
                         REFERENCES GuildSettings(ID)
                         ON DELETE CASCADE
             );
-            """
+            """,
+            idempotent=True
         )
-
-        self.__tables = self.__fetch_initiative_tables()
+        if self.dialect == "sqlite":
+            # Postgres gets this index from a migration
+            self._execute(
+                """
+                CREATE INDEX IF NOT EXISTS initiative_channel_character
+                    ON Initiative (Channel, Character);
+                """,
+                idempotent=True
+            )
 
 
     # For performance reasons, tables are stored in a cache that is generated at
     # login. This cache is maintained by the database action methods in the next
     # section. Tables are an abstraction that are simply a list of initiatives
-    # associated with a single channel.
+    # associated with a single channel. When another process changes a channel's
+    # initiative, that channel's table is reloaded.
 
     def add_table(self, channel: int, table: InitiativeManager):
         """
@@ -69,7 +107,8 @@ class InitiativeDB(Database):
             del self.__tables[channel]
 
         query = "DELETE FROM Initiative WHERE Channel=%s;"
-        self._execute(query, channel)
+        self._execute(query, channel, idempotent=True)
+        self.__bus.publish("initiative", channel)
 
 
     # Database actions
@@ -85,10 +124,24 @@ class InitiativeDB(Database):
             mod (int): The character's initiative modifier
             die (int): The character's initiative die roll
         """
-        self.remove_initiative(channel, character)
+        self.set_initiatives(guild, channel, [(character, mod, die)])
+
+
+    def set_initiatives(self, guild: int, channel: int, initiatives: list):
+        """
+        Add or replace several initiative records in a single round trip.
+        Args:
+            guild (int): The Discord ID of the channel's guild
+            channel (int): The Discord ID of the channel where the initiative table lives
+            initiatives (list): (character, mod, die) tuples
+        """
+        statements = []
+        for character, mod, die in initiatives:
+            statements.append((self.__remove, (channel, character)))
+            statements.append((self.__insert, (channel, character, mod, die, None, guild)))
 
-        query = "INSERT INTO Initiative VALUES (%s, %s, %s, %s, %s, %s);"
-        self._execute(query, channel, character, mod, die, None, guild)
+        self._execute_batch(statements, idempotent=True)
+        self.__bus.publish("initiative", channel)
 
 
     def set_initiative_action(self, channel, character, action):
@@ -100,7 +153,8 @@ class InitiativeDB(Database):
             action (str): The action the character is taking this round
         """
         query = "UPDATE Initiative SET Action=%s WHERE Channel=%s AND Character=%s;"
-        self._execute(query, action, channel, character)
+        self._execute(query, action, channel, character, idempotent=True)
+        self.__bus.publish("initiative", channel)
 
 
     def remove_initiative(self, channel, character):
@@ -110,25 +164,54 @@ class InitiativeDB(Database):
             channel (int): The Discord ID of the channel where the initiative table lives
             character (str): The name of the character to remove
         """
-        query = "DELETE FROM Initiative WHERE Channel=%s AND Character=%s;"
-        self._execute(query, channel, character)
+        self._execute(self.__remove, channel, character, idempotent=True)
+        self.__bus.publish("initiative", channel)
 
 
-    def __fetch_initiative_tables(self) -> dict:
+    def __reload_table(self, channel: int):
+        """
+        Replace a channel's table with the one in the database, after another
+        process has changed it.
+        Args:
+            channel (int): The Discord ID of the channel
         """
-        Retrieve the initiative table for every single channel.
+        if (manager := self.__fetch_initiative_tables(channel).get(channel)) is not None:
+            self.__tables[channel] = manager
+        elif channel in self.__tables:
+            del self.__tables[channel]
+
+
+    def __reload_tables(self):
+        """Replace every table, as changes made by other processes might have been missed."""
+        self.__tables = self.__fetch_initiative_tables()
+
+
+    def __fetch_initiative_tables(
+        self, channel: Optional[int] = None, replica: bool = False
+    ) -> dict:
+        """
+        Retrieve the initiative table for every single channel, or for just one.
+        Args:
+            channel (Optional[int]): The Discord ID of the channel. If None, every channel
+            replica (bool): Whether the read replica may be used. Only at startup,
+                            as reloads after another process's change must be current
         Returns (dict): A dictionary of InitiativeManagers with Discord channel IDs as the keys
         """
-        query = "SELECT Channel, Character, Mod, Die, Action FROM Initiative ORDER BY Channel;"
-        self._execute(query)
+        # Every table is loaded at startup, so the rows are streamed rather than
+        # fetched all at once
+        query = "SELECT Channel, Character, Mod, Die, Action FROM Initiative"
+        if channel is None:
+            rows = self._stream(query + " ORDER BY Channel;", replica=replica)
+        else:
+            rows = self._fetchall(query + " WHERE Channel=%s;", channel, idempotent=True)
 
         managers = defaultdict(lambda: None)
 
-        for channel, character, mod, die, action in self.cursor.fetchall():
-            manager = managers[channel]
+        for row_channel, character, mod, die, action in rows:
+            manager = managers[row_channel]
             if not manager:
                 manager = InitiativeManager()
-                managers[channel] = manager
+                managers[row_channel] = manager
 
             manager.add_init(character, mod, die, action)
 
@@ -0,0 +1,227 @@
+"""invalidation.py - Keeps every process's caches in step using LISTEN/NOTIFY."""
+
+# Guild settings, macros, and initiative tables are cached in memory. When the
+# bot's shards are split across several processes, a change made by one
+# process must reach the caches of the others. Every write to a cached table
+# publishes an invalidation on a Postgres notification channel, naming the
+# cache and the key that changed. Each process listens on that channel with a
+# dedicated connection and drops or reloads the named entries. A process
+# ignores its own notifications, since it has already updated its caches.
+#
+# Notifications sent while the listener is disconnected are lost, so after
+# reconnecting, every cache is fully resynchronized. The listener also checks
+# its connection whenever the channel has been quiet for a while, so a dead
+# connection is noticed without waiting for the next notification.
+#
+# A SQLite database has no notifications, and is only used by one process, so
+# its bus neither publishes nor listens.
+
+import json
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+import weakref
+from collections import defaultdict
+
+import psycopg2
+
+from . import backends, connections
+
+CHANNEL = "cache_invalidation"
+HEARTBEAT = 30 # Seconds of silence before the listener checks its connection
+BACKOFF = 0.5 # Seconds before the first reconnection attempt; doubles each time
+MAX_BACKOFF = 30
+
+
+class InvalidationBus:
+    """Publishes cache invalidations and applies those published by other processes."""
+
+    def __init__(self, backend: backends.Backend):
+        """
+        Create the bus. The listener starts with the first subscription.
+        Args:
+            backend (backends.Backend): The backend to notify through. If it
+                                        can't notify, the bus does nothing
+        """
+        self.backend = backend
+        self.dsn = backend.dsn if backend.notifies else None
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self.__subscribers = defaultdict(list) # cache: [(invalidate, resync)]
+        self.__lock = threading.Lock()
+        self.__listener = None
+
+
+    def subscribe(self, cache: str, invalidate, resync):
+        """
+        Register a cache's handlers. Bound methods are held weakly, so a
+        subscription doesn't keep its Database alive.
+        Args:
+            cache (str): The cache's name
+            invalidate (Callable): Called with the key of each changed entry
+            resync (Callable): Called with no arguments after notifications were missed
+        """
+        with self.__lock:
+            handlers = (weakref.WeakMethod(invalidate), weakref.WeakMethod(resync))
+            self.__subscribers[cache].append(handlers)
+
+            if self.__listener is None and self.dsn is not None:
+                self.__listener = threading.Thread(
+                    target=self.__listen, name="invalidation", daemon=True
+                )
+                self.__listener.start()
+
+
+    def publish(self, cache: str, *key):
+        """
+        Tell the other processes that a cache entry has changed. A failure is
+        logged rather than raised, as the change itself has already been made.
+        Args:
+            cache (str): The cache's name
+            *key: The changed entry's key
+        """
+        if self.dsn is None:
+            return
+
+        payload = json.dumps({"origin": self.origin, "cache": cache, "key": key})
+        try:
+            with self.backend.cursor() as cursor:
+                cursor.execute("SELECT pg_notify(%s, %s);", (CHANNEL, payload))
+        except psycopg2.Error:
+            logging.exception("Unable to publish a %s invalidation", cache)
+
+
+    def invalidate(self, cache: str, *key):
+        """
+        Invalidate a cache entry in this process as well as the others. This is
+        for changes the cache's owner didn't make itself, such as the rows
+        deleted when a guild's removal cascades.
+        Args:
+            cache (str): The cache's name
+            *key: The changed entry's key
+        """
+        self.__apply(cache, key)
+        self.publish(cache, *key)
+
+
+    def __listen(self):
+        """Receive notifications forever, reconnecting and resyncing as needed."""
+        conn = None
+        delay = BACKOFF
+        missed = False
+
+        while True:
+            try:
+                if conn is None:
+                    conn = self.__connect()
+                    delay = BACKOFF
+                    if missed:
+                        self.__resync()
+                        missed = False
+
+                if select.select([conn], [], [], HEARTBEAT) == ([], [], []):
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1;")
+                conn.poll()
+
+                while conn.notifies:
+                    self.__dispatch(conn.notifies.pop(0).payload)
+
+            except (psycopg2.Error, OSError):
+                logging.warning("Lost the invalidation listener. Reconnecting in %ss", delay)
+                connections.count("listener_disconnects")
+
+                if conn is not None:
+                    conn.close()
+                conn = None
+                missed = True
+
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF)
+
+
+    def __connect(self):
+        """Open the listening connection."""
+        conn = psycopg2.connect(self.dsn, sslmode="require")
+        conn.autocommit = True
+
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL};")
+
+        return conn
+
+
+    def __dispatch(self, payload: str):
+        """Apply another process's invalidation to the local caches."""
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logging.warning("Ignoring a malformed invalidation: %s", payload)
+            return
+
+        if message.get("origin") == self.origin:
+            return
+
+        self.__apply(message.get("cache"), message.get("key", []))
+
+
+    def __apply(self, cache: str, key):
+        """Apply an invalidation to the local caches."""
+        for invalidate, _ in self.__handlers(cache):
+            try:
+                invalidate(*key)
+            except Exception: # pylint: disable=broad-except
+                logging.exception("Unable to apply a %s invalidation: %s", cache, key)
+
+
+    def __resync(self):
+        """Resynchronize every cache after notifications may have been missed."""
+        logging.info("Resynchronizing caches after missed invalidations")
+        connections.count("resyncs")
+
+        for cache in list(self.__subscribers):
+            for _, resync in self.__handlers(cache):
+                try:
+                    resync()
+                except Exception: # pylint: disable=broad-except
+                    logging.exception("Unable to resync the %s cache", cache)
+
+
+    def __handlers(self, cache: str) -> list:
+        """Returns the live handlers for a cache, dropping any whose owners are gone."""
+        with self.__lock:
+            handlers = []
+            live = []
+            for subscription in self.__subscribers.get(cache, []):
+                invalidate, resync = subscription[0](), subscription[1]()
+                if invalidate is not None and resync is not None:
+                    handlers.append((invalidate, resync))
+                    live.append(subscription)
+
+            if cache in self.__subscribers:
+                self.__subscribers[cache] = live
+
+            return handlers
+
+
+__bus = None
+__bus_pid = None
+__bus_lock = threading.Lock()
+
+
+def bus() -> InvalidationBus:
+    """
+    Retrieve the process's invalidation bus, creating it if necessary.
+    Returns (InvalidationBus): The shared bus
+    """
+    global __bus, __bus_pid # pylint: disable=global-statement,invalid-name
+
+    with __bus_lock:
+        if __bus is None or __bus_pid != os.getpid():
+            __bus = InvalidationBus(backends.shared_backend())
+            __bus_pid = os.getpid()
+
+        return __bus
@@ -0,0 +1,197 @@
+"""macrocache.py - An in-memory working set of users' macros."""
+
+# Using a macro used to cost a query, and storing, editing, or deleting one
+# cost an extra query to see whether it existed. Instead, the first time a user
+# touches their macros in a guild, all of them are loaded in a single query.
+# Later lookups are served from memory, and RollDB keeps the cached macros in
+# step with every write it makes.
+#
+# Users are evicted least-recently-used first once the cache's estimated size
+# exceeds its cap, which is set with the MACRO_CACHE_BYTES environment variable
+# (default 16 MiB).
+
+import os
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Callable, Optional
+
+Macro = namedtuple("Macro", ["name", "syntax", "comment"])
+
+# Rough per-macro and per-user costs of the tuples and dicts holding them
+MACRO_OVERHEAD = 250
+USER_OVERHEAD = 500
+
+
+class MacroCache:
+    """A thread-safe LRU cache of each user's macros, keyed by guild and user."""
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        """
+        Create an empty cache.
+        Args:
+            max_bytes (Optional[int]): The approximate memory cap. Read from the
+                                       environment if not given
+        """
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("MACRO_CACHE_BYTES", 16 * 1024 * 1024))
+
+        self.max_bytes = max_bytes
+        self.__users = OrderedDict() # (guild, user): {lowercase name: Macro}
+        self.__sizes = {}
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+        # Incremented on every write, so a load that raced a write can tell
+        # that its results might be stale
+        self.__generation = 0
+
+
+    def macros(self, guild: int, userid: int, load: Callable) -> dict:
+        """
+        Retrieve a user's macros, loading them if they aren't cached.
+        Args:
+            guild (int): The Discord ID of the guild
+            userid (int): The Discord ID of the user
+            load (Callable): Returns the user's (name, syntax, comment) rows
+        Returns (dict): The user's macros, keyed by lowercase name. Don't modify it!
+        """
+        key = (guild, userid)
+        with self.__lock:
+            if key in self.__users:
+                self.__users.move_to_end(key)
+                return self.__users[key]
+            generation = self.__generation
+
+        macros = {row[0].lower(): Macro(*row) for row in load()}
+
+        with self.__lock:
+            # A write during the load means the rows might be out of date. They
+            # are still the best answer for this lookup, but they aren't cached.
+            if generation == self.__generation:
+                self.__insert(key, macros)
+
+        return macros
+
+
+    def cached(self, guild: int, userid: int) -> Optional[dict]:
+        """
+        Retrieve a user's macros only if they are already cached.
+        Args:
+            guild (int): The Discord ID of the guild
+            userid (int): The Discord ID of the user
+        Returns (Optional[dict]): The user's macros, keyed by lowercase name, or
+                                  None if they aren't cached. Don't modify it!
+        """
+        key = (guild, userid)
+        with self.__lock:
+            if key in self.__users:
+                self.__users.move_to_end(key)
+                return self.__users[key]
+            return None
+
+
+    def get(self, guild: int, userid: int, name: str, load: Callable) -> Optional[Macro]:
+        """
+        Retrieve a single macro, loading the user's macros if necessary.
+        Args:
+            guild (int): The Discord ID of the guild
+            userid (int): The Discord ID of the user
+            name (str): The macro's name, in any case
+            load (Callable): Returns the user's (name, syntax, comment) rows
+        Returns (Optional[Macro]): The macro, or None if the user doesn't have it
+        """
+        return self.macros(guild, userid, load).get(name.lower())
+
+
+    def put(self, guild: int, userid: int, macro: Macro):
+        """
+        Add or replace one of a user's macros, if the user is cached.
+        Args:
+            guild (int): The Discord ID of the guild
+            userid (int): The Discord ID of the user
+            macro (Macro): The macro as it now stands in the database
+        """
+        with self.__lock:
+            self.__generation += 1
+            if (macros := self.__users.get((guild, userid))) is not None:
+                macros = dict(macros)
+                macros[macro.name.lower()] = macro
+                self.__insert((guild, userid), macros)
+
+
+    def discard(self, guild: int, userid: int, name: str):
+        """
+        Remove one of a user's macros, if the user is cached.
+        Args:
+            guild (int): The Discord ID of the guild
+            userid (int): The Discord ID of the user
+            name (str): The macro's name, in any case
+        """
+        with self.__lock:
+            self.__generation += 1
+            if (macros := self.__users.get((guild, userid))) is not None:
+                macros = {key: macro for key, macro in macros.items() if key != name.lower()}
+                self.__insert((guild, userid), macros)
+
+
+    def evict(self, guild: int, userid: Optional[int] = None):
+        """
+        Forget a user's macros, or every user's in a guild.
+        Args:
+            guild (int): The Discord ID of the guild
+            userid (Optional[int]): The Discord ID of the user. If None, every user
+        """
+        with self.__lock:
+            self.__generation += 1
+            if userid is not None:
+                self.__remove((guild, userid))
+            else:
+                for key in [key for key in self.__users if key[0] == guild]:
+                    self.__remove(key)
+
+
+    def clear(self):
+        """Forget every cached macro."""
+        with self.__lock:
+            self.__generation += 1
+            self.__users.clear()
+            self.__sizes.clear()
+            self.__size = 0
+
+
+    @property
+    def size(self) -> int:
+        """The estimated memory used by the cached macros, in bytes."""
+        return self.__size
+
+
+    def __len__(self) -> int:
+        return len(self.__users)
+
+
+    def __insert(self, key: tuple, macros: dict):
+        """Cache a user's macros as most recently used, evicting others if over the cap."""
+        self.__remove(key)
+
+        size = USER_OVERHEAD + sum(map(self.__macro_size, macros.values()))
+        self.__users[key] = macros
+        self.__sizes[key] = size
+        self.__size += size
+
+        # Evict least-recently-used users, but always keep the newest
+        while self.__size > self.max_bytes and len(self.__users) > 1:
+            self.__remove(next(iter(self.__users)))
+
+
+    def __remove(self, key: tuple):
+        """Drop a user from the cache, if present."""
+        if key in self.__users:
+            del self.__users[key]
+            self.__size -= self.__sizes.pop(key)
+
+
+    @staticmethod
+    def __macro_size(macro: Macro) -> int:
+        """Estimate the memory used by a cached macro."""
+        return MACRO_OVERHEAD + sum(sys.getsizeof(field) for field in macro if field is not None)
@@ -1,6 +1,9 @@
 """metamacros.py - Defines a Database class for managing metamacros."""
 
+from itertools import groupby
+
 from .base import Database
+from .macrocache import Macro
 
 
 class MetaMacroDB(Database):
@@ -9,8 +12,9 @@ class MetaMacroDB(Database):
 
     A metamacro is a special type of macro that calls other macros. Each
     metamacro comprises three or more records in a table, with an associated
-    metamacro name and a reference to a MacroID, which is the ID (and primary
-    key) of a macro defined in SavedRolls.
+    metamacro name and a reference to a MacroID, which is the ID of a macro
+    defined in SavedRolls. Both tables are partitioned by guild (see
+    migrations.py), so entries reference their macro by guild and ID.
     """
 
     def __init__(self):
@@ -21,7 +25,11 @@ class MetaMacroDB(Database):
         # with fewer than three entries; however, there is no compelling reason
         # for the bot to complain in this case, even if we mandate 3+ macros at
         # creation.
-        self.cursor.execute(
+        if self.dialect == "sqlite":
+            self.__create_sqlite_table()
+            return
+
+        self._execute(
             """
             CREATE TABLE IF NOT EXISTS MetaMacros(
                 GuildID  bigint NOT NULL,
@@ -33,7 +41,42 @@ class MetaMacroDB(Database):
                          REFERENCES SavedRolls(macro_id)
                          ON DELETE CASCADE
             );
+            """,
+            idempotent=True
+        )
+
+
+    def __create_sqlite_table(self):
+        """
+        Create the MetaMacros table on SQLite, which starts with the schema the
+        migrations give Postgres, minus the partitioning.
+        """
+        self._execute(
+            """
+            CREATE TABLE IF NOT EXISTS MetaMacros(
+                GuildID  bigint NOT NULL,
+                UserID   bigint NOT NULL,
+                MetaName Text   NOT NULL,
+                MacroID  int    NOT NULL,
+                Position int,
+                CONSTRAINT fk_macro
+                    FOREIGN KEY (GuildID, MacroID)
+                        REFERENCES SavedRolls(Guild, macro_id)
+                        ON DELETE CASCADE
+            );
+            """,
+            idempotent=True
+        )
+        self._execute(
             """
+            CREATE INDEX IF NOT EXISTS metamacros_owner_name
+                ON MetaMacros (GuildID, UserID, lower(MetaName));
+            """,
+            idempotent=True
+        )
+        self._execute(
+            "CREATE INDEX IF NOT EXISTS metamacros_macro ON MetaMacros (GuildID, MacroID);",
+            idempotent=True
         )
 
 
@@ -48,45 +91,119 @@ class MetaMacroDB(Database):
         Returns (bool): True if the user has just overwritten an old metamacro
         Raises: KeyError if one of the given macros doesn't exist
         """
-        for macro in macros:
-            if not self.__macro_exists(guildid, userid, macro):
-                raise KeyError(f"Error! You don't have a macro named `{macro}`!")
+        if self.dialect == "sqlite":
+            return self.__store_sqlite_metamacro(guildid, userid, meta_name, macros)
 
-        # There's no simple way to update a metamacro, so let's simply delete the old one
-        overwriting = False
-        if self.__metamacro_exists(guildid, userid, meta_name):
-            self.delete_metamacro(guildid, userid, meta_name)
-            overwriting = True
+        # Resolving the macros, replacing any old metamacro, and inserting the
+        # new one happen in a single statement, so they succeed or fail
+        # together. Nothing is written if any macro is missing. The data-
+        # modifying CTEs share a snapshot, so Deleted can't see Inserted's rows.
+        query = """
+            WITH Resolved AS (
+                SELECT Requested.Name, Requested.Position, macro_id
+                FROM unnest(%s::text[]) WITH ORDINALITY AS Requested(Name, Position)
+                LEFT JOIN SavedRolls
+                    ON Guild=%s AND ID=%s AND lower(SavedRolls.Name)=lower(Requested.Name)
+            ), Missing AS (
+                SELECT Name, Position FROM Resolved WHERE macro_id IS NULL
+            ), Deleted AS (
+                DELETE FROM MetaMacros
+                WHERE GuildID=%s AND UserID=%s AND lower(MetaName)=lower(%s)
+                    AND NOT EXISTS (SELECT 1 FROM Missing)
+                RETURNING 1
+            ), Inserted AS (
+                INSERT INTO MetaMacros (GuildID, UserID, MetaName, MacroID, Position)
+                SELECT %s, %s, %s, macro_id, Position
+                FROM Resolved
+                WHERE NOT EXISTS (SELECT 1 FROM Missing)
+            )
+            SELECT
+                (SELECT array_agg(Name ORDER BY Position) FROM Missing),
+                EXISTS (SELECT 1 FROM Deleted);
+        """
+        # Not idempotent: if a lost connection hid a commit, a rerun would find
+        # the new metamacro and report it as overwritten
+        owner = (guildid, userid, meta_name)
+        missing, overwriting = self._fetchone(
+            query, list(macros), guildid, userid, *owner, *owner, idempotent=False
+        )
+
+        if missing:
+            raise KeyError(f"Error! You don't have a macro named `{missing[0]}`!")
 
-        # All macros exist, and we're clear to store
-        for macro in macros:
-            macro_id = self.__macro_id(guildid, userid, macro)
-            query = "INSERT INTO MetaMacros VALUES (%s, %s, %s, %s);"
-            self._execute(query, guildid, userid, meta_name, macro_id)
+        self._wrote(("macros", guildid, userid))
 
         return overwriting
 
 
+    def __store_sqlite_metamacro(
+        self, guildid: int, userid: int, meta_name: str, macros: tuple
+    ) -> bool:
+        """
+        Store a metamacro on SQLite, which has no data-modifying CTEs. The
+        statements share a transaction instead, so they succeed or fail together.
+        Args:
+            guildid (int): The Discord ID of the associated guild
+            userid (int): The Discord ID of the user who owns the metamacro
+            meta_name (str): The name of the new metamacro
+            macros (tuple): The macros comprising the metamacro
+        Returns (bool): True if the user has just overwritten an old metamacro
+        Raises: KeyError if one of the given macros doesn't exist
+        """
+        resolve = """
+            SELECT Requested.value, macro_id
+            FROM json_each(%s) AS Requested
+            LEFT JOIN SavedRolls
+                ON Guild=%s AND SavedRolls.ID=%s AND lower(Name)=lower(Requested.value)
+            ORDER BY Requested.key;
+        """
+        delete = """
+            DELETE FROM MetaMacros WHERE GuildID=%s AND UserID=%s AND lower(MetaName)=lower(%s);
+        """
+        insert = """
+            INSERT INTO MetaMacros (GuildID, UserID, MetaName, MacroID, Position)
+            VALUES (%s, %s, %s, %s, %s);
+        """
+        with self._transaction() as transaction:
+            resolved = transaction.fetchall(resolve, list(macros), guildid, userid)
+            for name, macro_id in resolved:
+                if macro_id is None:
+                    raise KeyError(f"Error! You don't have a macro named `{name}`!")
+
+            status = transaction.execute(delete, guildid, userid, meta_name)
+            transaction.execute_batch([
+                (insert, (guildid, userid, meta_name, macro_id, position))
+                for position, (_, macro_id) in enumerate(resolved, start=1)
+            ])
+
+        self._wrote(("macros", guildid, userid))
+
+        return status != "DELETE 0"
+
+
     def retrieve_macros(self, guildid: int , userid: int, meta_name: str) -> list:
         """
-        Retrieve the macro names for a given metamacro.
+        Retrieve the macros comprising a given metamacro, in order. The fk_macro
+        constraint guarantees every member still exists.
         Args:
             guildid (int): The Discord ID of the guild where the bot was invoked
             userid (int): The Discord ID of the user invoking the bot
             meta_name (str): The name of the metamacro
-        Returns (list): A list of macro names
+        Returns (list): A list of Macros: (name, syntax, comment)
         """
         query = """
-            SELECT Name
-            FROM SavedRolls
-            RIGHT JOIN MetaMacros
-                ON MacroID=macro_id
-            WHERE GuildID=%s AND UserID=%s AND MetaName ILIKE %s;
+            SELECT Name, Syntax, Comment
+            FROM MetaMacros
+            JOIN SavedRolls
+                ON Guild=GuildID AND macro_id=MacroID
+            WHERE GuildID=%s AND UserID=%s AND lower(MetaName)=lower(%s)
+            ORDER BY Position;
         """
-        self._execute(query, guildid, userid, meta_name)
-        macros = list(map(lambda item: item[0], self.cursor.fetchall()))
-
-        return macros
+        rows = self._fetchall(
+            query, guildid, userid, meta_name, replica=True,
+            owner=("macros", guildid, userid), idempotent=True
+        )
+        return [Macro(*row) for row in rows]
 
 
     def delete_metamacro(self, guildid: int, userid: int, meta_name: str) -> bool:
@@ -98,33 +215,58 @@ class MetaMacroDB(Database):
             meta_name (str): The name of the metamacro to delete
         Returns (bool): True if the user had a metamacro by that name on the server
         """
-        if not self.__metamacro_exists(guildid, userid, meta_name):
-            return False
-
-        query = "DELETE FROM MetaMacros WHERE GuildID=%s AND UserID=%s AND MetaName ILIKE %s;"
-        self._execute(query, guildid, userid, meta_name)
+        query = """
+            DELETE FROM MetaMacros WHERE GuildID=%s AND UserID=%s AND lower(MetaName)=lower(%s);
+        """
+        status = self._execute(query, guildid, userid, meta_name, idempotent=True)
+        self._wrote(("macros", guildid, userid))
 
-        return True
+        return status != "DELETE 0"
 
 
     def metamacro_list(self, guildid: int, userid: int) -> list:
         """
-        Retrieve a list of metamacros and their components.
+        Retrieve a list of metamacros and their components. Names are grouped
+        case-insensitively, as they are looked up and counted.
         Args:
             guildid (int): The Discord ID of the guild the bot was invoked in
             userid (int): The Discord ID of the user invoking the bot
         Returns (list): An array of tuples of type (meta_name, associated_macros)
         """
-        query = "SELECT DISTINCT MetaName FROM MetaMacros WHERE GuildID=%s AND UserID=%s;"
-        self._execute(query, guildid, userid)
-        meta_names = list(map(lambda name: name[0], self.cursor.fetchall()))
+        owner = ("macros", guildid, userid)
+        if self.dialect == "sqlite":
+            # SQLite can't order within an aggregate, so the rows are grouped here
+            query = """
+                SELECT MetaName, Name
+                FROM MetaMacros
+                JOIN SavedRolls
+                    ON Guild=GuildID AND macro_id=MacroID
+                WHERE GuildID=%s AND UserID=%s
+                ORDER BY lower(MetaName), Position;
+            """
+            rows = self._fetchall(query, guildid, userid, owner=owner, idempotent=True)
+            records = []
+            for _, group in groupby(rows, key=lambda row: row[0].lower()):
+                group = list(group)
+                meta_name = min(meta_name for meta_name, _ in group)
+                records.append((meta_name, ", ".join(name for _, name in group)))
 
-        records = []
-        for meta_name in meta_names:
-            macros = self.retrieve_macros(guildid, userid, meta_name)
-            macros = ", ".join(macros)
+            return records
 
-            records.append((meta_name, macros))
+        query = """
+            SELECT min(MetaName), array_agg(Name ORDER BY Position)
+            FROM MetaMacros
+            JOIN SavedRolls
+                ON Guild=GuildID AND macro_id=MacroID
+            WHERE GuildID=%s AND UserID=%s
+            GROUP BY lower(MetaName)
+            ORDER BY lower(MetaName);
+        """
+        records = []
+        for meta_name, macros in self._fetchall(
+            query, guildid, userid, replica=True, owner=owner, idempotent=True
+        ):
+            records.append((meta_name, ", ".join(macros)))
 
         return records
 
@@ -137,55 +279,10 @@ class MetaMacroDB(Database):
             userid (int): The Discord ID of the user invoking the bot
         Returns (int): The number of metamacros the user has in this guild
         """
-        records = self.metamacro_list(guildid, userid)
-        return len(records)
-
-
-    def __macro_exists(self, guildid: int, userid: int, macro_name: str) -> bool:
-        """
-        Determine if a given macro exists in SavedRolls.
-        Args:
-            guildid (int): The Discord ID of the guild the bot was invoked in
-            userid (int): The Discord ID of the user invoking the bot
-            macro_name (str): The name of the macro
-        Returns (bool): True if the macro exists for that user in that guild
-        """
-        query = "SELECT * FROM SavedRolls WHERE Guild=%s AND ID=%s AND Name ILIKE %s;"
-        self._execute(query, guildid, userid, macro_name)
-        result = self.cursor.fetchone()
-
-        return result is not None
-
-
-    def __macro_id(self, guildid: int, userid: int, macro_name: str) -> int:
-        """
-        Retrieve the macro_id of a given macro.
-        Args:
-            guildid (int): The Discord ID of the guild the bot was invoked in
-            userid (int): The Discord ID of the user invoking the bot
-            macro_name (str): The name of the macro in question
-        Returns (int): The Discord ID of the given macro
-        """
-        if not self.__macro_exists(guildid, userid, macro_name):
-            raise KeyError(f"Error! {macro_name} doesn't exist!")
-
-        query = "SELECT macro_id FROM SavedROLLS WHERE Guild=%s AND ID=%s AND Name ILIKE %s;"
-        self._execute(query, guildid, userid, macro_name)
-        result = self.cursor.fetchone()
-
-        return result[0]
-
-
-    def __metamacro_exists(self, guildid: int, userid: int, metamacro_name: str) -> bool:
-        """
-        Determine if a given metamacro exists.
-        Args:
-            guildid (int): The Discord ID of the guild in which the bot was invoked
-            userid (int): The Discord ID of the user invoking the bot
-        Returns (bool): True if the user has a metamacro by that name in that guild
+        query = """
+            SELECT COUNT(DISTINCT lower(MetaName)) FROM MetaMacros WHERE GuildID=%s AND UserID=%s;
         """
-        query = "SELECT * FROM MetaMacros WHERE GuildID=%s AND UserID=%s AND MetaName ILIKE %s;"
-        self._execute(query, guildid, userid, metamacro_name)
-        result = self.cursor.fetchone()
-
-        return result is not None
+        owner = ("macros", guildid, userid)
+        return self._fetchone(
+            query, guildid, userid, replica=True, owner=owner, idempotent=True
+        )[0]
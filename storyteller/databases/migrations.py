@@ -0,0 +1,485 @@
+"""migrations.py - Applies versioned schema changes to the database."""
+
+# The Database classes create their own tables with CREATE TABLE IF NOT EXISTS,
+# which can't change a table that already exists. Changes to existing tables,
+# such as new indexes, are instead made by migrations. Each migration has a
+# version number and is applied exactly once, in order, inside a transaction;
+# the versions that have been applied are recorded in SchemaMigrations.
+#
+# Every bot process runs the migrations at startup. An advisory lock ensures
+# only one process applies them, while the others wait and then find nothing
+# left to do. If a migration fails, it and every later migration are skipped
+# until the next startup, and the bot carries on with the schema it has.
+#
+# A migration that must copy a large table can't hold its transaction open
+# for the whole copy. Its batches are statements that are each run over and
+# over, in transactions of their own, until they report that they handled no
+# rows. They run before the migration's statements, and must be safe to
+# resume if interrupted partway through. Such a migration would hold up the
+# bot's startup, so it's left pending there, along with every migration after
+# it, until it's applied with `python -m storyteller.migrate`. The bot keeps
+# running meanwhile, so the migrations before it must keep the copy current.
+# The exception is a new or unused database: if every one of the migration's
+# sources, the tables its batches copy, is empty, there's nothing to wait
+# for, so the bot applies it at startup like any other.
+#
+# To change the schema, append a Migration to MIGRATIONS. Never edit or
+# reorder a migration that has been released.
+#
+# The migrations are written for Postgres. A SQLite database's tables are
+# created with the schema the migrations produce, so its migrations are only
+# recorded, never run. A migration that changes the schema must change the
+# Database classes' SQLite tables to match.
+
+import logging
+from collections import namedtuple
+
+from .base import Database
+
+Migration = namedtuple(
+    "Migration", ["version", "description", "statements", "batches", "sources"],
+    defaults=[(), ()]
+)
+
+# An arbitrary key for pg_advisory_xact_lock(), so concurrent processes take turns
+LOCK_KEY = 0x547A
+
+# The number of hash partitions of the macro tables. Every guild's macros and
+# metamacros land in the same-numbered partition of each table.
+PARTITIONS = 16
+
+MIGRATIONS = (
+    Migration(1, "Index macro, metamacro, and initiative lookups", (
+        # Macros are looked up by guild, owner, and case-insensitive name. The
+        # leading (Guild, ID) columns also serve the per-user listings and the
+        # similar-name search, which only compares trigrams within one user's
+        # macros, so a trigram index would never be chosen over this one.
+        """
+        CREATE INDEX IF NOT EXISTS savedrolls_owner_name
+            ON SavedRolls (Guild, ID, lower(Name));
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS metamacros_owner_name
+            ON MetaMacros (GuildID, UserID, lower(MetaName));
+        """,
+        # Deleting a macro cascades to MetaMacros, which would otherwise scan
+        # the whole table to find the referencing rows
+        "CREATE INDEX IF NOT EXISTS metamacros_macro ON MetaMacros (MacroID);",
+        """
+        CREATE INDEX IF NOT EXISTS initiative_channel_character
+            ON Initiative (Channel, Character);
+        """,
+    )),
+    Migration(2, "Make macro names unique per user", (
+        # Racing saves could create duplicate names. Keep the oldest of each,
+        # moving any metamacro entries over to it before the rest are deleted.
+        """
+        CREATE TEMPORARY TABLE DuplicateMacros ON COMMIT DROP AS
+            SELECT macro_id, min(macro_id) OVER owner AS keep_id
+            FROM SavedRolls
+            WINDOW owner AS (PARTITION BY Guild, ID, lower(Name));
+        """,
+        """
+        UPDATE MetaMacros SET MacroID=keep_id
+        FROM DuplicateMacros
+        WHERE MacroID=macro_id AND macro_id<>keep_id;
+        """,
+        """
+        DELETE FROM SavedRolls USING DuplicateMacros
+        WHERE SavedRolls.macro_id=DuplicateMacros.macro_id AND SavedRolls.macro_id<>keep_id;
+        """,
+        # Replaces the plain index, and lets saves upsert with ON CONFLICT
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS savedrolls_owner_name_unique
+            ON SavedRolls (Guild, ID, lower(Name));
+        """,
+        "DROP INDEX IF EXISTS savedrolls_owner_name;",
+    )),
+    Migration(3, "Record the order of each metamacro's macros", (
+        "ALTER TABLE MetaMacros ADD COLUMN IF NOT EXISTS Position int;",
+        # Existing entries were inserted in order, so their physical order is
+        # the best record there is
+        """
+        UPDATE MetaMacros SET Position=Ordered.Position
+        FROM (
+            SELECT ctid, row_number() OVER (
+                PARTITION BY GuildID, UserID, lower(MetaName) ORDER BY ctid
+            ) AS Position
+            FROM MetaMacros
+        ) AS Ordered
+        WHERE MetaMacros.ctid=Ordered.ctid;
+        """,
+    )),
+    Migration(4, "Create the guild-partitioned macro tables", (
+        # Every macro query filters by guild, so the tables are hash-partitioned
+        # by guild to keep each partition's indexes and vacuums small. Primary
+        # and foreign keys on partitioned tables must include the partition
+        # key, so metamacro entries reference their macro by guild and ID.
+        """
+        CREATE TABLE IF NOT EXISTS SavedRollsByGuild(
+            ID       bigint NOT NULL,
+            Name     Text   NOT NULL,
+            Syntax   Text   NOT NULL,
+            Guild    bigint NOT NULL,
+            Comment  Text   NULL,
+            macro_id int GENERATED ALWAYS AS IDENTITY,
+            PRIMARY KEY(Guild, macro_id),
+            CONSTRAINT fk_guild
+                FOREIGN KEY (Guild)
+                    REFERENCES GuildSettings(ID)
+                    ON DELETE CASCADE
+        ) PARTITION BY HASH (Guild);
+        """,
+        *(
+            f"""
+            CREATE TABLE IF NOT EXISTS savedrolls_p{remainder} PARTITION OF SavedRollsByGuild
+                FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {remainder});
+            """
+            for remainder in range(PARTITIONS)
+        ),
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS savedrollsbyguild_owner_name
+            ON SavedRollsByGuild (Guild, ID, lower(Name));
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS MetaMacrosByGuild(
+            GuildID  bigint NOT NULL,
+            UserID   bigint NOT NULL,
+            MetaName Text   NOT NULL,
+            MacroID  int    NOT NULL,
+            Position int,
+            CONSTRAINT fk_macro
+                FOREIGN KEY (GuildID, MacroID)
+                    REFERENCES SavedRollsByGuild(Guild, macro_id)
+                    ON DELETE CASCADE
+        ) PARTITION BY HASH (GuildID);
+        """,
+        *(
+            f"""
+            CREATE TABLE IF NOT EXISTS metamacros_p{remainder} PARTITION OF MetaMacrosByGuild
+                FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {remainder});
+            """
+            for remainder in range(PARTITIONS)
+        ),
+        """
+        CREATE INDEX IF NOT EXISTS metamacrosbyguild_owner_name
+            ON MetaMacrosByGuild (GuildID, UserID, lower(MetaName));
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS metamacrosbyguild_macro
+            ON MetaMacrosByGuild (GuildID, MacroID);
+        """,
+        # Until the tables are swapped, triggers mirror every write to the old
+        # tables, so the copy stays current while the bot keeps running. A
+        # metamacro entry whose macro hasn't been copied yet is left for the
+        # backfill, which copies the macros first.
+        """
+        CREATE OR REPLACE FUNCTION mirror_savedrolls() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM SavedRollsByGuild WHERE Guild=OLD.Guild AND macro_id=OLD.macro_id;
+            ELSE
+                INSERT INTO SavedRollsByGuild (ID, Name, Syntax, Guild, Comment, macro_id)
+                OVERRIDING SYSTEM VALUE
+                VALUES (NEW.ID, NEW.Name, NEW.Syntax, NEW.Guild, NEW.Comment, NEW.macro_id)
+                ON CONFLICT (Guild, macro_id) DO UPDATE
+                    SET ID=EXCLUDED.ID, Name=EXCLUDED.Name, Syntax=EXCLUDED.Syntax,
+                        Comment=EXCLUDED.Comment;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION mirror_metamacros() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM MetaMacrosByGuild
+                WHERE GuildID=OLD.GuildID AND UserID=OLD.UserID AND MetaName=OLD.MetaName
+                    AND MacroID=OLD.MacroID AND Position IS NOT DISTINCT FROM OLD.Position;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND EXISTS (
+                SELECT 1 FROM SavedRollsByGuild WHERE Guild=NEW.GuildID AND macro_id=NEW.MacroID
+            ) THEN
+                INSERT INTO MetaMacrosByGuild (GuildID, UserID, MetaName, MacroID, Position)
+                VALUES (NEW.GuildID, NEW.UserID, NEW.MetaName, NEW.MacroID, NEW.Position);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS mirror_savedrolls ON SavedRolls;",
+        """
+        CREATE TRIGGER mirror_savedrolls AFTER INSERT OR UPDATE OR DELETE ON SavedRolls
+            FOR EACH ROW EXECUTE FUNCTION mirror_savedrolls();
+        """,
+        "DROP TRIGGER IF EXISTS mirror_metamacros ON MetaMacros;",
+        """
+        CREATE TRIGGER mirror_metamacros AFTER INSERT OR UPDATE OR DELETE ON MetaMacros
+            FOR EACH ROW EXECUTE FUNCTION mirror_metamacros();
+        """,
+        # Records how far each backfill has got, so it can resume after a restart
+        """
+        CREATE TABLE IF NOT EXISTS MigrationProgress(
+            Name Text   PRIMARY KEY,
+            Mark bigint NOT NULL
+        );
+        """,
+        """
+        INSERT INTO MigrationProgress VALUES ('savedrolls', 0), ('metamacros', 0)
+            ON CONFLICT (Name) DO NOTHING;
+        """,
+    )),
+    Migration(5, "Partition the macro tables by guild", (
+        # The backfills are done, and the triggers have kept the copies current.
+        # Block writes for the moment it takes to check and swap the tables.
+        "LOCK TABLE SavedRolls, MetaMacros IN SHARE ROW EXCLUSIVE MODE;",
+        """
+        DO $$
+        BEGIN
+            IF (SELECT count(*) FROM SavedRolls) <> (SELECT count(*) FROM SavedRollsByGuild) THEN
+                RAISE EXCEPTION 'SavedRolls and SavedRollsByGuild differ';
+            END IF;
+            IF (
+                SELECT count(*) FROM MetaMacros JOIN SavedRolls
+                    ON MacroID=macro_id AND GuildID=Guild
+            ) <> (SELECT count(*) FROM MetaMacrosByGuild) THEN
+                RAISE EXCEPTION 'MetaMacros and MetaMacrosByGuild differ';
+            END IF;
+        END
+        $$;
+        """,
+        "DROP TABLE MetaMacros;",
+        "DROP TABLE SavedRolls;",
+        "DROP FUNCTION mirror_savedrolls, mirror_metamacros;",
+        "DROP TABLE MigrationProgress;",
+        "ALTER TABLE SavedRollsByGuild RENAME TO SavedRolls;",
+        "ALTER TABLE MetaMacrosByGuild RENAME TO MetaMacros;",
+        "ALTER TABLE SavedRolls RENAME CONSTRAINT savedrollsbyguild_pkey TO savedrolls_pkey;",
+        "ALTER INDEX savedrollsbyguild_owner_name RENAME TO savedrolls_owner_name_unique;",
+        "ALTER INDEX metamacrosbyguild_owner_name RENAME TO metamacros_owner_name;",
+        "ALTER INDEX metamacrosbyguild_macro RENAME TO metamacros_macro;",
+        "ALTER SEQUENCE savedrollsbyguild_macro_id_seq RENAME TO savedrolls_macro_id_seq;",
+        # The copied rows kept their IDs, so new macros must be numbered after them
+        """
+        SELECT setval('savedrolls_macro_id_seq', max(macro_id))
+        FROM SavedRolls
+        HAVING max(macro_id) IS NOT NULL;
+        """,
+    ), batches=(
+        # Copy the macros in order of ID, locking each batch so that a write
+        # racing the copy is either copied or mirrored, never lost or revived.
+        # The advisory lock keeps batches from running concurrently, and every
+        # part of a statement sees the progress mark as it was at the start.
+        """
+        WITH Batch AS (
+            SELECT * FROM SavedRolls
+            WHERE macro_id > (SELECT Mark FROM MigrationProgress WHERE Name='savedrolls')
+            ORDER BY macro_id
+            LIMIT 5000
+            FOR SHARE
+        ), Copied AS (
+            INSERT INTO SavedRollsByGuild (ID, Name, Syntax, Guild, Comment, macro_id)
+            OVERRIDING SYSTEM VALUE
+            SELECT ID, Name, Syntax, Guild, Comment, macro_id FROM Batch
+            ON CONFLICT DO NOTHING
+        )
+        UPDATE MigrationProgress SET Mark=(SELECT max(macro_id) FROM Batch)
+        WHERE Name='savedrolls' AND EXISTS (SELECT 1 FROM Batch);
+        """,
+        # MetaMacros has no key, so it's copied a range of pages at a time.
+        # Entries the triggers have already mirrored are skipped, as are any
+        # that reference another guild's macro, which the new key can't hold.
+        """
+        WITH Progress AS (
+            SELECT ('(' || Mark || ',0)')::tid AS First, ('(' || (Mark + 64) || ',0)')::tid AS Last
+            FROM MigrationProgress WHERE Name='metamacros'
+        ), Batch AS (
+            SELECT GuildID, UserID, MetaName, MacroID, Position FROM MetaMacros
+            WHERE ctid >= (SELECT First FROM Progress) AND ctid < (SELECT Last FROM Progress)
+            FOR SHARE
+        ), Copied AS (
+            INSERT INTO MetaMacrosByGuild (GuildID, UserID, MetaName, MacroID, Position)
+            SELECT * FROM Batch
+            WHERE EXISTS (
+                SELECT 1 FROM SavedRollsByGuild WHERE Guild=GuildID AND macro_id=MacroID
+            ) AND NOT EXISTS (
+                SELECT 1 FROM MetaMacrosByGuild AS Copy
+                WHERE Copy.GuildID=Batch.GuildID AND Copy.UserID=Batch.UserID
+                    AND Copy.MetaName=Batch.MetaName AND Copy.MacroID=Batch.MacroID
+                    AND Copy.Position IS NOT DISTINCT FROM Batch.Position
+            )
+        )
+        UPDATE MigrationProgress SET Mark=Mark + 64
+        WHERE Name='metamacros'
+            AND Mark < pg_relation_size('MetaMacros') / current_setting('block_size')::bigint;
+        """,
+    ), sources=("SavedRolls", "MetaMacros")),
+)
+
+
+class MigrationDB(Database):
+    """Tracks and applies schema migrations."""
+
+    def __init__(self):
+        super().__init__()
+
+        self._execute(
+            """
+            CREATE TABLE IF NOT EXISTS SchemaMigrations(
+                Version     int         PRIMARY KEY,
+                Description Text        NOT NULL,
+                Applied     timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            idempotent=True
+        )
+
+
+    def applied_versions(self) -> set:
+        """
+        Retrieve the versions of every migration that has been applied.
+        Returns (set): The applied migration versions
+        """
+        rows = self._fetchall("SELECT Version FROM SchemaMigrations;", idempotent=True)
+        return {row[0] for row in rows}
+
+
+    def migrate(self, migrations: tuple = MIGRATIONS, backfill: bool = False) -> list:
+        """
+        Apply every pending migration, in version order. Each migration runs in
+        its own transaction, so a failure leaves the earlier ones in place and
+        stops the later ones from being applied.
+        Args:
+            migrations (tuple): The migrations to apply, if not already applied
+            backfill (bool): Whether to run batches. If False, a migration with
+                             batches, and every one after it, is left pending
+                             unless the migration's sources are empty
+        Returns (list): The versions of the migrations that were applied
+        """
+        if self.dialect == "sqlite":
+            return self.__record(migrations)
+
+        applied = []
+
+        for migration in sorted(migrations):
+            if migration.version in self.applied_versions():
+                continue
+
+            if migration.batches and not (backfill or self.__sources_empty(migration)):
+                logging.warning(
+                    "Migration %s (%s) is pending. Apply it with `python -m storyteller.migrate`",
+                    *migration[:2]
+                )
+                break
+
+            try:
+                self.__backfill(migration)
+                if self.__apply(migration):
+                    logging.info("Applied migration %s: %s", *migration[:2])
+                    applied.append(migration.version)
+            except self.backend.errors:
+                logging.exception("Migration %s failed: %s", *migration[:2])
+                break
+
+        return applied
+
+
+    def __record(self, migrations: tuple) -> list:
+        """
+        Record migrations as applied without running them, for a database
+        whose tables were created with the migrated schema.
+        Args:
+            migrations (tuple): The migrations to record, if not already recorded
+        Returns (list): The versions of the migrations that were recorded
+        """
+        recorded = []
+        query = """
+            INSERT INTO SchemaMigrations (Version, Description) VALUES (%s, %s)
+            ON CONFLICT (Version) DO NOTHING;
+        """
+        for migration in sorted(migrations):
+            if self._execute(query, migration.version, migration.description) == "INSERT 0 1":
+                logging.info("Recorded migration %s: %s", *migration[:2])
+                recorded.append(migration.version)
+
+        return recorded
+
+
+    def __sources_empty(self, migration: Migration) -> bool:
+        """
+        Check whether a migration's batches have nothing to copy, in which case
+        they're quick enough to run at startup.
+        Args:
+            migration (Migration): The migration whose sources to check
+        Returns (bool): True if the migration has sources and all are empty
+        """
+        if not migration.sources:
+            return False
+
+        # The table names come from MIGRATIONS, never from input
+        query = " AND ".join(
+            f"NOT EXISTS (SELECT 1 FROM {table})" for table in migration.sources
+        )
+        return self._fetchone(f"SELECT {query};", idempotent=True)[0]
+
+
+    def __backfill(self, migration: Migration):
+        """
+        Run each of a migration's batches until it reports handling no rows.
+        Each run is its own transaction, so the tables aren't held for long.
+        Args:
+            migration (Migration): The migration whose batches to run
+        """
+        for number, batch in enumerate(migration.batches, start=1):
+            runs = 0
+            while self.__run_batch(migration, batch):
+                runs += 1
+                if runs % 100 == 0:
+                    logging.info(
+                        "Migration %s: Batch %s has run %s times", migration.version, number, runs
+                    )
+
+
+    def __run_batch(self, migration: Migration, batch: str) -> bool:
+        """
+        Run one of a migration's batches once.
+        Args:
+            migration (Migration): The migration the batch belongs to
+            batch (str): The batch statement
+        Returns (bool): True if the batch handled any rows and should run again
+        """
+        with self._transaction() as transaction:
+            transaction.execute("SELECT pg_advisory_xact_lock(%s);", LOCK_KEY)
+
+            # Another process might have finished the migration meanwhile
+            query = "SELECT 1 FROM SchemaMigrations WHERE Version=%s;"
+            if transaction.fetchone(query, migration.version) is not None:
+                return False
+
+            status = transaction.execute(batch)
+
+        return not status.endswith(" 0")
+
+
+    def __apply(self, migration: Migration) -> bool:
+        """
+        Apply a single migration in a transaction.
+        Args:
+            migration (Migration): The migration to apply
+        Returns (bool): False if another process applied it first
+        """
+        with self._transaction() as transaction:
+            transaction.execute("SELECT pg_advisory_xact_lock(%s);", LOCK_KEY)
+
+            query = "SELECT 1 FROM SchemaMigrations WHERE Version=%s;"
+            if transaction.fetchone(query, migration.version) is not None:
+                return False
+
+            for statement in migration.statements:
+                transaction.execute(statement)
+
+            query = "INSERT INTO SchemaMigrations (Version, Description) VALUES (%s, %s);"
+            transaction.execute(query, migration.version, migration.description)
+
+        return True
@@ -1,17 +1,76 @@
 """settings.py - Database for managing server settings."""
 
-import copy
 import logging
-from collections import defaultdict
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
 from distutils.util import strtobool
 
 from psycopg2.sql import SQL, Identifier
 
-from .base import Database
+from . import invalidation
+from .base import AsyncDatabase, Database
+
+
+class GuildSettings(Mapping):
+    """
+    An immutable snapshot of a guild's settings. Snapshots are interned, so
+    every guild with the same settings (most often the defaults) shares one.
+    Changing a setting replaces the guild's snapshot rather than modifying it.
+    """
+
+    __slots__ = ("__values", "__key", "__weakref__")
+    __interned = weakref.WeakValueDictionary()
+    __intern_lock = threading.Lock()
+
+    def __new__(cls, values: dict):
+        key = tuple(sorted(values.items()))
+        with cls.__intern_lock:
+            if (snapshot := cls.__interned.get(key)) is None:
+                snapshot = super().__new__(cls)
+                snapshot.__values = dict(values)
+                snapshot.__key = key
+                cls.__interned[key] = snapshot
+
+        return snapshot
+
+    def replacing(self, changes: dict) -> "GuildSettings":
+        """
+        Create a snapshot with some of the settings changed.
+        Args:
+            changes (dict): The new values of the changed settings
+        Returns (GuildSettings): The new snapshot
+        """
+        return GuildSettings({**self.__values, **changes})
+
+    def __getitem__(self, key):
+        return self.__values[key]
+
+    def __iter__(self):
+        return iter(self.__values)
+
+    def __len__(self):
+        return len(self.__values)
+
+    def __hash__(self):
+        return hash(self.__key)
+
+    def __repr__(self):
+        return f"GuildSettings({self.__values})"
 
 
 class SettingsDB(Database):
-    """Interface for setting and retrieving server parameters."""
+    """
+    Interface for setting and retrieving server parameters.
+
+    Each guild's settings are loaded the first time they're needed and kept in
+    a least-recently-used cache of SETTINGS_CACHE_SIZE guilds (default 5000).
+    Guilds without settings are cached as well, so they aren't looked up again
+    and again. The cache can be prewarmed with the guilds this process serves.
+    Changes made by other processes evict the changed guild from the cache.
+    """
 
     # "Interesting" keys that get specially referenced elsewhere
     DEFAULT_DIFF = "default_diff"
@@ -37,6 +96,9 @@ class SettingsDB(Database):
         CHRONICLES: "Enables Chronicles of Darkness-style rolls.",
     }
 
+    # Marks a guild known to have no settings row
+    __MISSING = object()
+
     # Though "sort_rolls" would be a more logical setting (and unsorted the default), for historical
     # reasons we're doing the opposite. In earlier versions, the bot only displayed dice in sorted
     # order. After conducting a small poll on the Discord server, it was decided to keep sorted as
@@ -45,7 +107,7 @@ class SettingsDB(Database):
     def __init__(self):
         super().__init__()
 
-        self.cursor.execute(
+        self._execute(
             """
             CREATE TABLE IF NOT EXISTS GuildSettings(
                 ID                bigint  PRIMARY KEY,
@@ -62,57 +124,183 @@ class SettingsDB(Database):
                 never_botch       boolean DEFAULT FALSE,
                 unsort_rolls        boolean DEFAULT FALSE
             );
-            """
+            """,
+            idempotent=True
+        )
+        self.__cache = OrderedDict()
+        self.__cache_size = int(os.environ.get("SETTINGS_CACHE_SIZE", 5000))
+        self.__cache_lock = threading.RLock()
+        self.__generation = 0 # Incremented by every update
+        self.__update_statements = {}
+
+        columns = SQL(", ").join(
+            SQL("{key}=%s").format(key=Identifier(key)) for key in self.__chronicles_values(True)
+        )
+        self.__chronicles_statement = self._prepare(
+            "update_chronicles", SQL("UPDATE GuildSettings SET {columns} WHERE ID=%s;").format(
+                columns=columns
+            )
         )
-        self.__all_settings = self.__fetch_all_settings()  # Cache for performance reasons
 
         # Set up the default parameters
-        self.default_params = defaultdict(lambda: False)
-        self.default_params[self.DEFAULT_DIFF] = 6
-        self.default_params[self.PREFIX] = None
+        defaults = dict.fromkeys(self.available_parameters, False)
+        defaults[self.DEFAULT_DIFF] = 6
+        defaults[self.PREFIX] = None
+        self.default_params = GuildSettings(defaults)
+
+        # SQLite has no arrays, so the list of guilds is sent as JSON instead
+        fields = SQL(", ").join(map(Identifier, self.available_parameters))
+        if self.dialect == "sqlite":
+            guilds = SQL("ID IN (SELECT value FROM json_each(%s))")
+        else:
+            guilds = SQL("ID = ANY(%s)")
+        self.__load_settings = self._prepare(
+            "load_settings",
+            SQL("SELECT ID, {fields} FROM GuildSettings WHERE {guilds};").format(
+                fields=fields, guilds=guilds
+            )
+        )
+
+        self.__bus = invalidation.bus()
+        self.__bus.subscribe("settings", self.__invalidate, self.__resync)
+        self.aio = AsyncSettingsDB(self)
 
         logging.info("Created SettingsDB")
 
-    def __fetch_all_settings(self) -> dict:
+    def prewarm(self, guilds: list) -> int:
         """
-        Retrieves the settings for each server.
-        Returns (dict): The settings for each server, with the Discord guild ID as the keys
+        Load the settings for many guilds at once, such as every guild in the
+        shards this process owns. Only as many guilds as fit in the cache are loaded.
+        Args:
+            guilds (list): The Discord IDs of the guilds
+        Returns (int): The number of guilds loaded
         """
-        fields = SQL(", ").join(map(Identifier, self.available_parameters))
-        query = SQL("SELECT ID, {fields} FROM GuildSettings;").format(fields=fields)
+        guilds = [guild for guild in guilds if guild is not None][:self.__cache_size]
+        loaded = len(self.__load(guilds))
+        logging.info("Prewarmed settings for %s guilds", loaded)
 
-        self._execute(query)
-        results = self.cursor.fetchall()
+        return loaded
 
-        settings = defaultdict(lambda: copy.deepcopy(self.default_params))
+    def __cached(self, guild: int):
+        """
+        Retrieve a guild's settings, loading them if they aren't cached.
+        Args:
+            guild (int): The Discord ID of the guild
+        Returns (Optional[dict]): The guild's settings, or None if it has none
+        """
+        with self.__cache_lock:
+            if guild in self.__cache:
+                self.__cache.move_to_end(guild)
+                settings = self.__cache[guild]
+                return None if settings is self.__MISSING else settings
 
-        # Put the fetched parameters into dictionaries
-        for row in results:
-            row = list(row)
-            guild = row.pop(0)
-            parameters = dict(zip(self.available_parameters, row))
+        return self.__load([guild]).get(guild)
 
-            settings[guild] = parameters
+    def cached(self, guild):
+        """
+        Retrieve a guild's settings only if they're cached, without querying.
+        Args:
+            guild (int): The Discord ID of the guild
+        Returns (Optional[GuildSettings]): The guild's settings, or None if they
+                                           aren't cached or the guild has none
+        """
+        if guild and not isinstance(guild, int):
+            guild = guild.id
 
-        logging.info("Fetched all guild settings")
-        return settings
+        if guild is None:
+            return self.default_params
+
+        with self.__cache_lock:
+            if isinstance(settings := self.__cache.get(guild), GuildSettings):
+                self.__cache.move_to_end(guild)
+                return settings
+
+        return None
 
-    def settings_for_guild(self, guild) -> dict:
+    def __load(self, guilds: list) -> dict:
+        """
+        Fetch guilds' settings in one query and cache them. Guilds without a
+        settings row are cached as missing. If settings were updated during the
+        query, the results might be stale, so they aren't cached.
+        Args:
+            guilds (list): The Discord IDs of the guilds
+        Returns (dict): The settings of each guild that has them
+        """
+        with self.__cache_lock:
+            generation = self.__generation
+
+        # A prewarm loads thousands of guilds, so their rows are streamed
+        if len(guilds) > 1:
+            rows = self._stream(self.__load_settings.query, guilds, replica=True)
+        else:
+            owner = ("settings", guilds[0]) if guilds else None
+            rows = self._fetchall(
+                self.__load_settings, guilds, replica=True, owner=owner, idempotent=True
+            )
+
+        found = {}
+        for row in rows:
+            found[row[0]] = GuildSettings(dict(zip(self.available_parameters, row[1:])))
+
+        with self.__cache_lock:
+            if generation == self.__generation:
+                for guild in guilds:
+                    self.__cache_settings(guild, found.get(guild, self.__MISSING))
+
+        return found
+
+    def __invalidate(self, guild: int):
+        """
+        Evict a guild that another process has changed, so it's loaded afresh
+        from the primary.
+        Args:
+            guild (int): The Discord ID of the guild
+        """
+        self._wrote(("settings", guild))
+        with self.__cache_lock:
+            self.__generation += 1
+            self.__cache.pop(guild, None)
+
+    def __resync(self):
+        """Evict every guild, as changes made by other processes might have been missed."""
+        with self.__cache_lock:
+            self.__generation += 1
+            self.__cache.clear()
+
+    def __cache_settings(self, guild: int, settings):
+        """
+        Cache a guild's settings as most recently used, evicting the least recently used.
+        Args:
+            guild (int): The Discord ID of the guild
+            settings (GuildSettings): The guild's settings, or __MISSING if it has none
+        """
+        with self.__cache_lock:
+            self.__cache[guild] = settings
+            self.__cache.move_to_end(guild)
+
+            while len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+
+    def settings_for_guild(self, guild) -> GuildSettings:
         """
         Fetch the settings for a specific guild.
         Args:
             guild (int): The Discord ID of the guild
-        Returns (dict): The guild's settings
+        Returns (GuildSettings): An immutable snapshot of the guild's settings
         """
         if guild and not isinstance(guild, int):
             guild = guild.id
 
+        if guild is None:
+            return self.default_params
+
         # Make sure the settings are actually in the guild
-        if guild is not None and guild not in self.__all_settings:
+        if (settings := self.__cached(guild)) is None:
             logging.info("Guild %s wasn't in GuildSettings! Adding now.", guild)
             self.add_guild(guild)
+            settings = self.__cached(guild) or self.default_params
 
-        return copy.deepcopy(self.__all_settings[guild])
+        return settings
 
     def get_prefixes(self, guild) -> tuple:
         """
@@ -121,11 +309,17 @@ class SettingsDB(Database):
             guild (int): The guild's ID
         Returns (tuple): A tuple containing the guild's prefixes
         """
-        if guild and not isinstance(guild, int):
-            guild = guild.id
+        return self.prefixes_in(self.settings_for_guild(guild))
 
-        prefix = self.settings_for_guild(guild)[SettingsDB.PREFIX]
-        if prefix:
+    @classmethod
+    def prefixes_in(cls, settings: Mapping) -> tuple:
+        """
+        Determine the prefixes set by a guild's settings.
+        Args:
+            settings (Mapping): The guild's settings
+        Returns (tuple): A tuple containing the guild's prefixes
+        """
+        if prefix := settings[cls.PREFIX]:
             return (prefix,)
         return ("!m", "/m")
 
@@ -140,10 +334,27 @@ class SettingsDB(Database):
         """
         value = self.__validated_parameter(key, value)  # Raises ValueError if invalid
 
-        query = SQL("UPDATE GuildSettings SET {key}=%s WHERE ID=%s;").format(key=Identifier(key))
-        self._execute(query, value, guild)
-        self.__all_settings[guild][key] = value
-        logging.info("Settings: Guild %s: Set %s to %s", guild, key, value)
+        if key == self.CHRONICLES:
+            # Chronicles mode also sets the default difficulty, always explode,
+            # nullify ones, and no botching, all in the same statement
+            values = self.__chronicles_values(value)
+            self._execute(self.__chronicles_statement, *values.values(), guild, idempotent=True)
+        else:
+            values = {key: value}
+            self._execute(self.__update_statement(key), value, guild, idempotent=True)
+        self._wrote(("settings", guild))
+
+        # The cached snapshot is swapped for a new one, so anyone holding the
+        # old snapshot never sees a half-applied change. Guilds that aren't
+        # cached will pick up the changes when they're loaded.
+        with self.__cache_lock:
+            self.__generation += 1
+            if isinstance(settings := self.__cache.get(guild), GuildSettings):
+                self.__cache[guild] = settings.replacing(values)
+        self.__bus.publish("settings", guild)
+
+        for changed_key, changed_value in values.items():
+            logging.info("Settings: Guild %s: Set %s to %s", guild, changed_key, changed_value)
 
         message = f"Setting `{key}` to `{value}`!"
         if key == self.PREFIX:
@@ -154,17 +365,44 @@ class SettingsDB(Database):
             else:
                 message = "Reset the command prefix to `/m` and `!m`."
         elif key == self.CHRONICLES:
-            # Also set default difficulty, always explode, nullify ones, no botching
-            self.update(guild, SettingsDB.DEFAULT_DIFF, 8 if value else 6)
-            self.update(guild, SettingsDB.XPL_ALWAYS, str(value))
-            self.update(guild, SettingsDB.IGNORE_ONES, str(value))
-            self.update(guild, SettingsDB.NEVER_BOTCH, str(value))
-
             message = "Enabling" if value else "Disabling"
             message += " Chronicles of Darkness mode."
 
         return message
 
+    @classmethod
+    def __chronicles_values(cls, enabled: bool) -> dict:
+        """
+        Determine every setting changed by toggling Chronicles mode.
+        Args:
+            enabled (bool): Whether Chronicles mode is being enabled
+        Returns (dict): The new values, in the order of the Chronicles statement's columns
+        """
+        return {
+            cls.CHRONICLES: enabled,
+            cls.DEFAULT_DIFF: 8 if enabled else 6,
+            cls.XPL_ALWAYS: enabled,
+            cls.IGNORE_ONES: enabled,
+            cls.NEVER_BOTCH: enabled,
+        }
+
+    def __update_statement(self, key: str):
+        """
+        Compose and prepare the UPDATE statement for one of the parameters. The
+        result is cached, so each parameter's statement is only built once.
+        Args:
+            key (str): A valid parameter
+        Returns (PreparedStatement): The statement, taking the value and guild ID
+        """
+        if (statement := self.__update_statements.get(key)) is None:
+            query = SQL("UPDATE GuildSettings SET {key}=%s WHERE ID=%s;").format(
+                key=Identifier(key)
+            )
+            statement = self._prepare(f"update_setting_{key}", query)
+            self.__update_statements[key] = statement
+
+        return statement
+
     def value(self, guild, key):
         """
         Retrieve a specific setting on a given guild.
@@ -180,7 +418,11 @@ class SettingsDB(Database):
         if key == SettingsDB.PREFIX:
             return ", ".join(self.get_prefixes(guild))
 
-        return copy.deepcopy(self.__all_settings[guild][key])
+        settings = self.__cached(guild) if guild is not None else None
+        if settings is None:
+            settings = self.default_params
+
+        return settings[key]
 
     def __validated_parameter(self, key, new_value):
         """
@@ -237,24 +479,89 @@ class SettingsDB(Database):
         Args:
             guildid (int): The Discord ID of the guild to add
         """
-        query = "INSERT INTO GuildSettings VALUES (%s);"
-        self._execute(query, guildid)
-        logging.info("Guild %s added to database", guildid)
-
-        # Add the guild to the settings dictionary
-        self.__all_settings[guildid] = copy.deepcopy(self.default_params)
+        query = "INSERT INTO GuildSettings (ID) VALUES (%s) ON CONFLICT (ID) DO NOTHING;"
+        status = self._execute(query, guildid, idempotent=True)
+        self._wrote(("settings", guildid))
+
+        if status == "INSERT 0 1":
+            logging.info("Guild %s added to database", guildid)
+            self.__cache_settings(guildid, self.default_params)
+            self.__bus.publish("settings", guildid)
+        else:
+            # Another process got there first, and its settings might have changed
+            self.__load([guildid])
         logging.info("Guild %s added to settings cache", guildid)
 
     def remove_guild(self, guildid: int):
         """
-        Remove a guild from the GuildSettings table.
+        Remove a guild from the GuildSettings table. The guild's macros,
+        metamacros, and initiative are deleted along with it, so their caches
+        are invalidated in this process and the others.
         Args:
             guildid (int): The Discord ID of the guild to remove
         """
-        query = "DELETE FROM GuildSettings WHERE ID=%s;"
-        self._execute(query, guildid)
+        # The cascade wouldn't say which channels' initiative tables it emptied
+        with self._transaction() as transaction:
+            channels = transaction.fetchall(
+                "DELETE FROM Initiative WHERE Guild=%s RETURNING Channel;", guildid
+            )
+            transaction.execute("DELETE FROM GuildSettings WHERE ID=%s;", guildid)
+        self._wrote(("settings", guildid))
         logging.info("Guild %s removed from database", guildid)
 
-        if guildid in self.__all_settings:
-            del self.__all_settings[guildid]
-            logging.info("Guild %s removed from settings cache", guildid)
+        self.__cache_settings(guildid, self.__MISSING)
+        self.__bus.publish("settings", guildid)
+        logging.info("Guild %s removed from settings cache", guildid)
+
+        self.__bus.invalidate("macros", guildid)
+        for channel in {channel for channel, in channels}:
+            self.__bus.invalidate("initiative", channel)
+
+
+class AsyncSettingsDB(AsyncDatabase):
+    """
+    Awaitable versions of SettingsDB's methods. The settings lookups made for
+    every message are answered from the cache without leaving the event loop.
+    Only cache misses, which query and might add the guild, go to the executor.
+    """
+
+    def __init__(self, settings: SettingsDB):
+        super().__init__(settings)
+        self.__settings = settings
+
+
+    async def settings_for_guild(self, guild) -> GuildSettings:
+        """
+        Fetch the settings for a specific guild.
+        Args:
+            guild (int): The Discord ID of the guild
+        Returns (GuildSettings): An immutable snapshot of the guild's settings
+        """
+        if (settings := self.__settings.cached(guild)) is not None:
+            return settings
+        return await self._run(self.__settings.settings_for_guild, guild)
+
+
+    async def get_prefixes(self, guild) -> tuple:
+        """
+        Retrieve the guild's prefixes.
+        Args:
+            guild (int): The guild's ID
+        Returns (tuple): A tuple containing the guild's prefixes
+        """
+        return SettingsDB.prefixes_in(await self.settings_for_guild(guild))
+
+
+    async def value(self, guild, key):
+        """
+        Retrieve a specific setting on a given guild.
+        Args:
+            guild (int): The guild's ID
+            key (str): The parameter whose value is desired
+        Returns (any): The current value for the parameter
+        Raises: ValueError if key isn't a valid parameter
+        """
+        settings = self.__settings.cached(guild)
+        if settings is not None and key in settings and key != SettingsDB.PREFIX:
+            return settings[key]
+        return await self._run(self.__settings.value, guild, key)
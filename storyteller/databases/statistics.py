@@ -1,12 +1,38 @@
 """statistics.py - Simple database for tracking guild statistics."""
 
+import atexit
+import logging
+import threading
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
 from psycopg2.sql import SQL, Identifier
 
 from .base import Database
 
+StatsRollup = namedtuple("StatsRollup", [
+    "period", "rolls", "compact_rolls", "traditional_rolls", "initiative_rolls", "stats_calculated"
+])
+
 
 class StatisticsDB(Database):
-    """Maintains a database of guild statistics."""
+    """
+    Maintains a database of guild statistics.
+
+    Statistics are written far more than anything else, so increments are
+    buffered in memory and merged per guild, hour, and field. A background
+    thread writes the buffer every FLUSH_INTERVAL seconds, or once FLUSH_SIZE
+    increments are pending, and the buffer is drained when the process exits.
+
+    Each flush updates both the lifetime totals in GuildStats and the hourly
+    buckets in GuildStatsHourly, which the rollup methods summarize. (On
+    SQLite, the buckets aren't partitioned, and are stored as UTC text.)
+    """
+
+    FIELDS = StatsRollup._fields[1:]
+    FLUSH_INTERVAL = 30 # Seconds
+    FLUSH_SIZE = 500 # Pending increments
 
     def __init__(self):
         super().__init__()
@@ -14,7 +40,7 @@ class StatisticsDB(Database):
         # Unlike some other tables, GuildStats does not have a foreign key
         # constraint on GuildSettings. We want to track all statistics from all
         # time, even if the guild removed the bot or was deleted.
-        self.cursor.execute(
+        self._execute(
             """
             CREATE TABLE IF NOT EXISTS GuildStats(
                 ID                bigint  PRIMARY KEY,
@@ -25,8 +51,86 @@ class StatisticsDB(Database):
                 Initiative_Rolls  int     DEFAULT 0,
                 Stats_Calculated  int     DEFAULT 0
             );
-            """
+            """,
+            idempotent=True
+        )
+
+        # Hourly statistics, partitioned by month. Partitions are created as
+        # needed when statistics are flushed. Lifetime totals stay in GuildStats,
+        # so they never require a scan of the buckets.
+        partitioning = "" if self.dialect == "sqlite" else "PARTITION BY RANGE (Bucket)"
+        self._execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS GuildStatsHourly(
+                ID                bigint      NOT NULL,
+                Bucket            timestamptz NOT NULL,
+                Rolls             int         DEFAULT 0,
+                Compact_Rolls     int         DEFAULT 0,
+                Traditional_Rolls int         DEFAULT 0,
+                Initiative_Rolls  int         DEFAULT 0,
+                Stats_Calculated  int         DEFAULT 0,
+                PRIMARY KEY (ID, Bucket)
+            ) {partitioning};
+            """,
+            idempotent=True
+        )
+        self.__partitions = set()
+
+        fields = SQL(", ").join(map(Identifier, self.FIELDS))
+        hourly_sums = self.__sums("GuildStatsHourly")
+        lifetime_sums = self.__sums("GuildStats")
+
+        if self.dialect == "sqlite":
+            # SQLite has no arrays, so each bucket and guild is upserted in turn
+            values = SQL(", ").join(SQL("%s") for _ in self.FIELDS)
+            self.__flush_hourly = self._prepare("flush_hourly_statistics", SQL(
+                """
+                INSERT INTO GuildStatsHourly (ID, Bucket, {fields}) VALUES (%s, %s, {values})
+                ON CONFLICT (ID, Bucket) DO UPDATE SET {hourly_sums};
+                """
+            ).format(fields=fields, values=values, hourly_sums=hourly_sums))
+            self.__flush_lifetime = self._prepare("flush_lifetime_statistics", SQL(
+                """
+                INSERT INTO GuildStats (ID, Name, {fields}) VALUES (%s, %s, {values})
+                ON CONFLICT (ID) DO UPDATE SET {lifetime_sums};
+                """
+            ).format(fields=fields, values=values, lifetime_sums=lifetime_sums))
+
+        # Every buffered (guild, hour) is added to its bucket, and each guild's
+        # sums are added to its lifetime totals, all in one statement
+        arrays = SQL(", ").join(SQL("%s::int[]") for _ in self.FIELDS)
+        totals = SQL(", ").join(
+            SQL("sum({field})::int").format(field=Identifier(field)) for field in self.FIELDS
         )
+        self.__flush_query = self._prepare("flush_statistics", SQL(
+            """
+            WITH Increments AS (
+                SELECT * FROM unnest(%s::bigint[], %s::timestamptz[], %s::text[], {arrays})
+                AS Increments(ID, Bucket, Name, {fields})
+            ), Hourly AS (
+                INSERT INTO GuildStatsHourly (ID, Bucket, {fields})
+                SELECT ID, Bucket, {fields} FROM Increments
+                ON CONFLICT (ID, Bucket) DO UPDATE SET {hourly_sums}
+            )
+            INSERT INTO GuildStats (ID, Name, {fields})
+            SELECT ID, min(Name), {totals} FROM Increments GROUP BY ID
+            ON CONFLICT (ID) DO UPDATE SET {lifetime_sums};
+            """
+        ).format(
+            fields=fields, arrays=arrays, totals=totals,
+            hourly_sums=hourly_sums, lifetime_sums=lifetime_sums,
+        ))
+
+        self.__pending = defaultdict(Counter)
+        self.__names = {}
+        self.__pending_count = 0
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+
+        threading.Thread(
+            target=self.__flush_periodically, name="statistics", daemon=True
+        ).start()
+        atexit.register(self.flush)
 
 
     def add_guild(self, guildid, guildname):
@@ -40,7 +144,7 @@ class StatisticsDB(Database):
         INSERT INTO GuildStats VALUES (%s, %s)
         ON CONFLICT (ID) DO UPDATE SET Name=%s;
         """
-        self._execute(query, guildid, guildname, guildname)
+        self._execute(query, guildid, guildname, guildname, idempotent=True)
 
 
     def rename_guild(self, guildid, name):
@@ -51,31 +155,125 @@ class StatisticsDB(Database):
             name (str): The guild's new name
         """
         query = "UPDATE GuildStats SET Name=%s WHERE ID=%s;"
-        self._execute(query, name, guildid)
+        self._execute(query, name, guildid, idempotent=True)
 
 
     def __increment(self, field, guild):
         """
-        Increment the indicated field on a given guild, creating the entry if needed.
+        Buffer an increment of the indicated field on a given guild. Buffered
+        increments are written by flush().
         Args:
             field (str): The table field to increment. Must be lowercase
-            guild (int): The guild to increment on
+            guild (discord.Guild): The guild to increment on
         """
+        bucket = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
 
-        # This method does the actual meat of statistics tracking. It's done this way to present
-        # a unified query structure for database updates in case changes happen in the future.
+        with self.__lock:
+            self.__pending[guild.id, bucket][field] += 1
+            self.__names[guild.id] = guild.name
+            self.__pending_count += 1
 
-        query = SQL(
-            "UPDATE GuildStats SET {field} = {field} + 1 WHERE ID=%s;"
-        ).format(field=Identifier(field))
+            if self.__pending_count >= self.FLUSH_SIZE:
+                self.__wake.set()
+
+
+    def flush(self):
+        """
+        Write every buffered increment in a single statement. Guilds missing
+        from GuildStats are added. If the write fails, the increments are put
+        back in the buffer for the next flush.
+        """
+        with self.__lock:
+            pending, self.__pending = self.__pending, defaultdict(Counter)
+            names, self.__names = self.__names, {}
+            self.__pending_count = 0
+
+        if not pending:
+            return
 
-        self._execute(query, guild.id)
+        keys = list(pending)
+        guilds = [guild for guild, _ in keys]
+        buckets = [bucket for _, bucket in keys]
 
-        # If nothing was updated, then the guild isn't in the table. Add it and try again.
-        if self.cursor.statusmessage == "UPDATE 0":
-            print(f"{guild.name} ({guild.id}) wasn't in GuildStats! Adding now.")
-            self.add_guild(guild.id, guild.name)
-            self._execute(query, guild.id)
+        try:
+            if self.dialect == "sqlite":
+                self._execute_batch(self.__sqlite_flush_statements(pending, names))
+            else:
+                columns = [guilds, buckets, [names[guild] for guild in guilds]]
+                columns.extend([pending[key][field] for key in keys] for field in self.FIELDS)
+
+                self.__create_partitions(buckets)
+                self._execute(self.__flush_query, *columns)
+        except self.backend.errors:
+            logging.exception("Unable to flush statistics for %s guilds", len(set(guilds)))
+            with self.__lock:
+                for key, counts in pending.items():
+                    self.__pending[key].update(counts)
+                    self.__names.setdefault(key[0], names[key[0]])
+                    self.__pending_count += sum(counts.values())
+
+
+    def __sqlite_flush_statements(self, pending: dict, names: dict) -> list:
+        """
+        Build the upserts that flush the buffer on SQLite.
+        Args:
+            pending (dict): The increments of each (guild, hour)
+            names (dict): The name of each guild
+        Returns (list): (query, args) tuples for _execute_batch()
+        """
+        lifetime = defaultdict(Counter)
+        statements = []
+        for (guild, bucket), counts in pending.items():
+            lifetime[guild].update(counts)
+            values = [counts[field] for field in self.FIELDS]
+            statements.append((self.__flush_hourly, (guild, bucket, *values)))
+
+        for guild, counts in lifetime.items():
+            values = [counts[field] for field in self.FIELDS]
+            statements.append((self.__flush_lifetime, (guild, names[guild], *values)))
+
+        return statements
+
+
+    def __create_partitions(self, buckets: list):
+        """
+        Create the monthly GuildStatsHourly partitions for the given buckets.
+        Args:
+            buckets (list[datetime]): The hourly buckets about to be written
+        """
+        for month in {bucket.replace(day=1, hour=0) for bucket in buckets}:
+            if month in self.__partitions:
+                continue
+
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            query = SQL(
+                """
+                CREATE TABLE IF NOT EXISTS {partition}
+                PARTITION OF GuildStatsHourly FOR VALUES FROM (%s) TO (%s);
+                """
+            ).format(partition=Identifier(f"guildstatshourly_{month:%Y%m}"))
+
+            self._execute(query, month, next_month, idempotent=True)
+            self.__partitions.add(month)
+
+
+    @classmethod
+    def __sums(cls, table: str) -> SQL:
+        """Returns the SET clause that adds each EXCLUDED field to the table's."""
+        return SQL(", ").join(
+            SQL("{field} = {table}.{field} + EXCLUDED.{field}").format(
+                table=SQL(table), field=Identifier(field)
+            )
+            for field in cls.FIELDS
+        )
+
+
+    def __flush_periodically(self):
+        """Flush the buffer every FLUSH_INTERVAL seconds, or sooner if it fills up."""
+        while True:
+            self.__wake.wait(self.FLUSH_INTERVAL)
+            self.__wake.clear()
+            self.flush()
 
 
     # Public-facing convenience incrementer methods
@@ -123,3 +321,132 @@ class StatisticsDB(Database):
             guild (int): The guild to track
         """
         self.__increment("stats_calculated", guild)
+
+
+    # Rollups
+
+    def daily_rollup(self, start: datetime, end: datetime, guild: Optional[int] = None) -> list:
+        """
+        Sum the hourly statistics into daily totals (UTC).
+        Args:
+            start (datetime): The start of the range, inclusive
+            end (datetime): The end of the range, exclusive
+            guild (Optional[int]): The guild to summarize. All guilds if None
+        Returns (list[StatsRollup]): The totals for each day with activity
+        """
+        return self.__rollup("day", start, end, guild)
+
+
+    def monthly_rollup(self, start: datetime, end: datetime, guild: Optional[int] = None) -> list:
+        """
+        Sum the hourly statistics into monthly totals (UTC).
+        Args:
+            start (datetime): The start of the range, inclusive
+            end (datetime): The end of the range, exclusive
+            guild (Optional[int]): The guild to summarize. All guilds if None
+        Returns (list[StatsRollup]): The totals for each month with activity
+        """
+        return self.__rollup("month", start, end, guild)
+
+
+    def hourly_profile(self, start: datetime, end: datetime) -> list:
+        """
+        Sum the statistics of every guild by hour of the day, for capacity planning.
+        Args:
+            start (datetime): The start of the range, inclusive
+            end (datetime): The end of the range, exclusive
+        Returns (list[StatsRollup]): The totals for each hour (0-23, UTC) with activity
+        """
+        if self.dialect == "sqlite":
+            hour = SQL("CAST(strftime('%%H', Bucket) AS int)")
+        else:
+            hour = SQL("extract(hour FROM Bucket AT TIME ZONE 'UTC')::int")
+
+        query = SQL(
+            """
+            SELECT {hour}, {totals}
+            FROM GuildStatsHourly
+            WHERE Bucket >= %s AND Bucket < %s
+            GROUP BY 1 ORDER BY 1;
+            """
+        ).format(hour=hour, totals=self.__totals())
+
+        rows = self._fetchall(query, start, end, replica=True, idempotent=True)
+        return list(map(StatsRollup._make, rows))
+
+
+    def lifetime_totals(self, guild: Optional[int] = None) -> StatsRollup:
+        """
+        Retrieve lifetime totals. These come from GuildStats, not the buckets.
+        Args:
+            guild (Optional[int]): The guild to total. All guilds if None
+        Returns (StatsRollup): The totals, with the guild ID (or None) as the period
+        """
+        query = SQL("SELECT {guild}, {totals} FROM GuildStats").format(
+            guild=self.__cast("%s", "bigint"), totals=self.__totals()
+        )
+        if guild is not None:
+            query = SQL("{query} WHERE ID = %s").format(query=query)
+            row = self._fetchone(query, guild, guild, replica=True, idempotent=True)
+            return StatsRollup._make(row)
+
+        return StatsRollup._make(self._fetchone(query, None, replica=True, idempotent=True))
+
+
+    def __rollup(self, period: str, start: datetime, end: datetime, guild: Optional[int]) -> list:
+        """
+        Sum the hourly statistics over the given period.
+        Args:
+            period (str): The date_trunc() field, e.g. "day"
+            start (datetime): The start of the range, inclusive
+            end (datetime): The end of the range, exclusive
+            guild (Optional[int]): The guild to summarize. All guilds if None
+        Returns (list[StatsRollup]): The totals for each period with activity
+        """
+        if self.dialect == "sqlite":
+            # SQLite has no date_trunc(), but the buckets are UTC text, so each
+            # is truncated by formatting it. The column name sets its type.
+            start_of = {"day": "%%Y-%%m-%%d", "month": "%%Y-%%m-01"}[period]
+            truncated = SQL(
+                f"strftime('{start_of} 00:00:00+00:00', Bucket) AS \"Period [timestamptz]\""
+            )
+            args = (start, end, guild, guild)
+        else:
+            truncated = SQL("date_trunc(%s, Bucket, 'UTC')")
+            args = (period, start, end, guild, guild)
+
+        query = SQL(
+            """
+            SELECT {truncated}, {totals}
+            FROM GuildStatsHourly
+            WHERE Bucket >= %s AND Bucket < %s AND ({guild} IS NULL OR ID = %s)
+            GROUP BY 1 ORDER BY 1;
+            """
+        ).format(truncated=truncated, totals=self.__totals(), guild=self.__cast("%s", "bigint"))
+
+        rows = self._fetchall(query, *args, replica=True, idempotent=True)
+        return list(map(StatsRollup._make, rows))
+
+
+    def __totals(self) -> SQL:
+        """Returns the select list that sums each statistics field."""
+        return SQL(", ").join(
+            self.__cast(SQL("COALESCE(sum({field}), 0)").format(field=Identifier(field)), "bigint")
+            for field in self.FIELDS
+        )
+
+
+    def __cast(self, expression, sql_type: str) -> SQL:
+        """
+        Cast an expression to a Postgres type. SQLite's columns take any type,
+        so its expressions are left as they are.
+        Args:
+            expression (Union[str, SQL]): The expression to cast
+            sql_type (str): The Postgres type
+        Returns (SQL): The cast expression
+        """
+        if isinstance(expression, str):
+            expression = SQL(expression)
+        if self.dialect == "sqlite":
+            return expression
+        return SQL("{expression}::{sql_type}").format(expression=expression, sql_type=SQL(sql_type))
@@ -0,0 +1,162 @@
+"""Exact success distributions for pool rolls, built by convolving per-die outcomes."""
+
+from collections import defaultdict, namedtuple
+
+from storyteller.probabilities import Probability
+
+ChroniclesProbability = namedtuple("ChroniclesProbability", [
+    "avg", "avg_rote", "prob", "prob_rote", "prob_wp", "prob_rote_wp",
+    "exceptional", "exceptional_rote", "fail", "fail_rote"
+])
+
+EXCEPTIONAL_SUCCESSES = 5 # Chronicles of Darkness exceptional success threshold
+
+cached_probabilities = defaultdict(lambda: None)
+
+
+def net_successes(pool: int, difficulty: int, specialty: bool) -> dict:
+    """
+    Compute the distribution of successes minus ones for a roll without
+    explosions, Willpower, or automatic successes.
+    Args:
+        pool (int): The number of dice rolled
+        difficulty (int): The roll's difficulty
+        specialty (bool): Whether tens count as two successes
+    Returns (dict): The probability of each net success value
+    """
+    # Each die contributes -1 (a one), 0 (a failure), +1 (a success), or +2 (a
+    # specialty ten). Rolling the pool is the pool-th power of that polynomial.
+    die = {
+        -1: .1,
+        0: (difficulty - 2) / 10,
+        1: (10 - difficulty) / 10 + (0 if specialty else .1),
+        2: .1 if specialty else 0,
+    }
+
+    distribution = {0: 1.0}
+    for _ in range(pool):
+        rolled = defaultdict(float)
+        for total, p_total in distribution.items():
+            for value, p_value in die.items():
+                if p_value:
+                    rolled[total + value] += p_total * p_value
+        distribution = rolled
+
+    return dict(distribution)
+
+
+def get_probabilities(pool: int, difficulty: int, target: int) -> Probability:
+    """
+    Returns a Probability object containing the statistics for a given roll.
+    The results match probabilities.get_probabilities().
+    """
+    key = (pool, difficulty, target)
+    probability = cached_probabilities[key]
+    if probability:
+        return probability
+
+    standard = net_successes(pool, difficulty, False)
+    specialty = net_successes(pool, difficulty, True)
+
+    # Botching requires no successes and at least one 1
+    p_fail = (difficulty - 2) / 10
+    botch = pow(.1 + p_fail, pool) - pow(p_fail, pool)
+
+    probability = Probability(
+        avg=pool * ((11 - difficulty) / 10) - pool * .1,
+        avg_spec=pool * ((11 - difficulty) / 10),
+        prob=__at_least(standard, target),
+        prob_wp=__at_least(standard, target - 1) if target > 1 else 1,
+        prob_spec=__at_least(specialty, target),
+        prob_spec_wp=__at_least(specialty, target - 1) if target > 1 else 1,
+        fail=1 - __at_least(standard, 1),
+        fail_spec=1 - __at_least(specialty, 1),
+        botch=botch,
+    )
+    cached_probabilities[key] = probability
+
+    return probability
+
+
+def chronicles_successes(
+    pool: int, difficulty: int, xpl_target: int, rote: bool, limit: int
+) -> list:
+    """
+    Compute the distribution of successes for a Chronicles of Darkness roll.
+    Because dice explode, the number of successes is unbounded; every outcome
+    of limit or more successes is collected in the final element, which keeps
+    the result exact for any question about fewer than limit successes.
+    Args:
+        pool (int): The number of dice rolled
+        difficulty (int): The face at or above which dice succeed
+        xpl_target (int): The x-again threshold
+        rote (bool): Whether failed dice are rerolled once
+        limit (int): The success count at which outcomes are collected
+    Returns (list): P(successes = k) for k < limit, then P(successes >= limit)
+    """
+    p_success = (11 - difficulty) / 10
+    p_explode = (11 - xpl_target) / 10
+    p_fail = 1 - p_success
+
+    # A die scores k successes by exploding k - 1 times and then either
+    # succeeding without exploding or exploding once more and failing. Summed
+    # over k, that leaves p_success * p_explode^(k - 1) as the tail.
+    die = [p_fail]
+    for successes in range(1, limit):
+        die.append(pow(p_explode, successes - 1) * p_success * (1 - p_explode))
+    die.append(pow(p_explode, limit - 1) * p_success)
+
+    if rote:
+        # A failed die is rerolled once, as a fresh die
+        die = [p * (1 + p_fail) for p in die]
+        die[0] = p_fail * p_fail
+
+    distribution = [1.0] + [0.0] * limit
+    for _ in range(pool):
+        rolled = [0.0] * (limit + 1)
+        for total, p_total in enumerate(distribution):
+            if p_total:
+                for value, p_value in enumerate(die):
+                    rolled[min(total + value, limit)] += p_total * p_value
+        distribution = rolled
+
+    return distribution
+
+
+def get_chronicles_probabilities(
+    pool: int, difficulty: int, xpl_target: int, target: int
+) -> ChroniclesProbability:
+    """
+    Returns the statistics for a Chronicles of Darkness roll, both as a
+    standard roll and as a rote action. Willpower adds three dice.
+    """
+    key = (pool, difficulty, xpl_target, target, "cofd")
+    probability = cached_probabilities[key]
+    if probability:
+        return probability
+
+    limit = max(target, EXCEPTIONAL_SUCCESSES)
+    p_success = (11 - difficulty) / 10
+    p_explode = (11 - xpl_target) / 10
+    average = p_success / (1 - p_explode)
+
+    elements = {}
+    for rote, suffix in ((False, ""), (True, "_rote")):
+        standard = chronicles_successes(pool, difficulty, xpl_target, rote, limit)
+        willpower = chronicles_successes(pool + 3, difficulty, xpl_target, rote, limit)
+
+        elements[f"avg{suffix}"] = pool * average * ((2 - p_success) if rote else 1)
+        elements[f"prob{suffix}"] = sum(standard[target:])
+        elements[f"prob{suffix}_wp"] = sum(willpower[target:])
+        elements[f"exceptional{suffix}"] = sum(standard[EXCEPTIONAL_SUCCESSES:])
+        elements[f"fail{suffix}"] = standard[0]
+
+    probability = ChroniclesProbability(**elements)
+    cached_probabilities[key] = probability
+
+    return probability
+
+
+def __at_least(distribution: dict, target: int) -> float:
+    """Returns the probability that a distribution's value is at least the target."""
+    return sum(p for value, p in distribution.items() if value >= target)
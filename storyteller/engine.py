@@ -46,6 +46,10 @@ async def handle_command(command, ctx, send=True):
         command = response
         response = None
 
+    # Several rolls at once (e.g. 7 6; 5 6 +1; 2d10)
+    if not response:
+        response = await parse.multiroll(ctx, command)
+
     # Pooled roll
     if not response:
         response = await parse.pool(ctx, command)
@@ -56,7 +60,7 @@ async def handle_command(command, ctx, send=True):
 
     # Meta-macros
     if not response and command["syntax"][0] == "$":
-        response = parse.metamacros(ctx, command, handle_command)
+        response = await parse.metamacros(ctx, command, handle_command)
         if isinstance(response, parse.MetaMacro):
             await __run_metamacro(response)
             return
@@ -80,9 +84,13 @@ async def __send_response(ctx, response):
         )
     else:
         confirm = None
+        attachments = {"file": response.file} if response.file else {}
         try:
             await ctx.respond(
-                embed=response.embed, content=response.content, ephemeral=response.ephemeral
+                embed=response.embed,
+                content=response.content,
+                ephemeral=response.ephemeral,
+                **attachments,
             )
         except discord.errors.HTTPException as err:
             # Temporary. There have been a bunch of errors with the embed field
@@ -101,7 +109,7 @@ async def __send_response(ctx, response):
                 command.update(match.groupdict())
 
                 # Get the server settings
-                guild_settings = storyteller.settings.settings_for_guild(ctx.guild)
+                guild_settings = await storyteller.settings.aio.settings_for_guild(ctx.guild)
                 command.update(guild_settings)
 
                 await handle_command(command, ctx)
@@ -132,8 +140,8 @@ async def __run_metamacro(metamacro):
 
 async def show_stored_rolls(ctx):
     """Sends an embed describing all the user's macros."""
-    stored_rolls = database.stored_rolls(ctx.guild.id, ctx.author.id)
-    meta_records = parse.meta_records(ctx.guild.id, ctx.author.id)
+    stored_rolls = await database.aio.stored_rolls(ctx.guild.id, ctx.author.id)
+    meta_records = await parse.meta_records(ctx.guild.id, ctx.author.id)
 
     if not stored_rolls:
         await ctx.respond(f"You have no macros on {ctx.guild}!", ephemeral=True)
@@ -164,17 +172,17 @@ def __yaml_block(lines) -> str:
     return block, lines
 
 
-def macro_counts(ctx) -> list:
+async def macro_counts(ctx) -> list:
     """Returns the number of macros and metamacros the user has stored."""
-    macro_count = database.macro_count(ctx.guild.id, ctx.author.id)
-    meta_count = parse.meta_count(ctx.guild.id, ctx.author.id)
+    macro_count = await database.aio.macro_count(ctx.guild.id, ctx.author.id)
+    meta_count = await parse.meta_count(ctx.guild.id, ctx.author.id)
 
     return (macro_count, meta_count)
 
 
 async def delete_user_rolls(ctx):
     """Deletes all of a user's macros on the given guild."""
-    database.delete_user_rolls(ctx.guild.id, ctx.author.id)
+    await database.aio.delete_user_rolls(ctx.guild.id, ctx.author.id)
     message = f"Deleted your macros on {ctx.guild}."
 
     await ctx.respond(message, ephemeral=True)
@@ -0,0 +1,366 @@
+"""harness.py - Checks the vectorized roll engine against the reference implementation.
+
+The reference implementations are roll.Pool and probabilities.get_probabilities.
+Any faster engine must produce exactly the same results. This harness:
+
+  * Drives roll.Pool and roll.vectorized from identical seeded streams of
+    faces across the full grid of server settings, and diffs the dice,
+    explosions, and success counts
+  * Does the same for Chronicles rolls, with and without rote actions,
+    against a die-at-a-time reference
+  * Diffs the exact probabilities from distributions against probabilities
+  * Runs chi-square tests of both rollers against the exact distributions,
+    including Chronicles rolls with x-again and rote actions
+  * Reports the throughput of each implementation
+
+Usage: python -m storyteller.harness [--seeds N] [--stats-pool N] [--samples N] [--rolls N]
+"""
+
+import argparse
+import itertools
+import math
+import random
+import sys
+import time
+from collections import Counter
+
+from storyteller import distributions, probabilities, roll
+
+POOLS = (1, 2, 3, 5, 8, 13, 20)
+DIFFICULTIES = range(2, 11)
+AUTOS = (-3, -1, 0, 1, 3)
+XPL_TARGETS = (10, 11)
+FLAGS = ("double_tens", "never_botch", "ignore_ones", "wp_cancelable")
+
+
+class SeededFaces:
+    """
+    A seeded stream of d10 faces. Two streams with the same seed yield the same
+    faces, whether they are drawn one at a time or in batches, so the reference
+    and vectorized rollers can be given identical dice.
+    """
+
+    def __init__(self, seed: int):
+        self.__random = random.Random(seed)
+        self.drawn = 0
+
+
+    def randint(self, low: int, high: int) -> int:
+        """Draw the next face, one die at a time."""
+        self.drawn += 1
+        return self.__random.randint(low, high)
+
+
+    def choices(self, population, k: int) -> list:
+        """Draw the next k faces in one batch, as the vectorized roller does."""
+        assert population == roll.vectorized.FACES
+        return [self.randint(1, 10) for _ in range(k)]
+
+
+def check_successes(seeds: int) -> int:
+    """
+    Roll every combination of settings through both rollers from identical
+    seeded streams, and compare the dice, explosions, and successes.
+    Returns (int): The number of mismatches
+    """
+    mismatches = 0
+    cases = 0
+
+    grid = itertools.product(
+        POOLS, DIFFICULTIES, AUTOS, (False, True), XPL_TARGETS,
+        itertools.product((False, True), repeat=len(FLAGS))
+    )
+    for pool, difficulty, autos, will, xpl_target, flags in grid:
+        options = dict(zip(FLAGS, flags))
+        options["xpl_target"] = xpl_target
+        options["unsort_rolls"] = False
+
+        for seed in range(seeds):
+            # roll.Pool draws each die from the global generator
+            random.seed(seed)
+            reference = roll.Pool(pool, difficulty, autos, will, False, options)
+
+            faces = SeededFaces(seed)
+            request = roll.vectorized.RollRequest(pool, xpl_target)
+            rolled = roll.vectorized.roll_batch([request], faces)[0]
+            fast = roll.vectorized.successes(
+                Counter(rolled.dice), difficulty, autos, will, options
+            )
+            cases += 1
+
+            expected = (reference.dice, reference.explosions, reference.successes)
+            actual = (sorted(rolled.dice, reverse=True), rolled.explosions, fast)
+            if actual != expected:
+                mismatches += 1
+                if mismatches <= 10:
+                    print(
+                        f"  MISMATCH pool={pool} diff={difficulty} autos={autos} will={will}",
+                        f"xpl={xpl_target} {options} seed={seed}:",
+                        f"reference={expected} vectorized={actual}"
+                    )
+
+    print(f"Successes: {cases} cases, {mismatches} mismatches")
+    return mismatches
+
+
+def check_chronicles_rolls(seeds: int) -> int:
+    """
+    Roll Chronicles pools, with and without rote, through the vectorized roller
+    and a die-at-a-time reference from identical seeded streams, and compare
+    the dice, explosions, rerolls, and number of faces drawn.
+    Returns (int): The number of mismatches
+    """
+    mismatches = 0
+    cases = 0
+
+    grid = itertools.product(POOLS, (6, 7, 8), (8, 9, 10, 11), (False, True))
+    for pool, difficulty, xpl_target, rote in grid:
+        for seed in range(seeds):
+            reference_faces = SeededFaces(seed)
+            reference = __chronicles_reference(
+                pool, difficulty, xpl_target, rote, reference_faces
+            )
+
+            faces = SeededFaces(seed)
+            rolled = roll.vectorized.roll_chronicles(pool, difficulty, xpl_target, rote, faces)
+            cases += 1
+
+            expected = (sorted(reference.dice), *reference[1:], reference_faces.drawn)
+            actual = (sorted(rolled.dice), *rolled[1:], faces.drawn)
+            if actual != expected:
+                mismatches += 1
+                if mismatches <= 10:
+                    print(
+                        f"  MISMATCH pool={pool} diff={difficulty} xpl={xpl_target}",
+                        f"rote={rote} seed={seed}: reference={expected} vectorized={actual}"
+                    )
+
+    print(f"Chronicles rolls: {cases} cases, {mismatches} mismatches")
+    return mismatches
+
+
+def check_probabilities(max_pool: int) -> int:
+    """
+    Compare every /stats result up to the given pool from both probability engines.
+    Returns (int): The number of mismatches
+    """
+    mismatches = 0
+    cases = 0
+
+    for pool in range(1, max_pool + 1):
+        for difficulty in DIFFICULTIES:
+            for target in range(1, pool * 2 + 1):
+                reference = probabilities.get_probabilities(pool, difficulty, target)
+                fast = distributions.get_probabilities(pool, difficulty, target)
+                cases += 1
+
+                for field, expected, actual in zip(reference._fields, reference, fast):
+                    if not math.isclose(expected, actual, rel_tol=1e-9, abs_tol=1e-12):
+                        mismatches += 1
+                        if mismatches <= 10:
+                            print(
+                                f"  MISMATCH {pool} v {difficulty}, target {target}: {field}",
+                                f"reference={expected!r} distributions={actual!r}"
+                            )
+
+    print(f"Probabilities: {cases} cases, {mismatches} mismatches")
+    return mismatches
+
+
+def check_distributions(samples: int, alpha: float = 0.0001) -> int:
+    """
+    Chi-square test both rollers' net successes against the exact distribution.
+    Returns (int): The number of failed tests
+    """
+    failures = 0
+    options = {
+        "xpl_target": 11, "double_tens": False, "never_botch": True, "ignore_ones": False,
+        "wp_cancelable": False, "unsort_rolls": True,
+    }
+
+    for pool, difficulty in ((1, 6), (3, 6), (5, 4), (7, 8), (10, 6), (15, 9)):
+        expected = distributions.net_successes(pool, difficulty, False)
+
+        reference = Counter()
+        for _ in range(samples):
+            dice = roll.Pool(pool, difficulty, 0, False, False, options).dice
+            reference[__net(Counter(dice), difficulty)] += 1
+
+        # Sample the vectorized roller as one batch, as /mr and saved rolls do
+        fast = Counter()
+        requests = [roll.vectorized.RollRequest(pool, 11)] * samples
+        for rolled in roll.vectorized.roll_batch(requests):
+            fast[__net(Counter(rolled.dice), difficulty)] += 1
+
+        for name, observed in (("reference", reference), ("vectorized", fast)):
+            statistic, dof = __chi_square(observed, expected, samples)
+            p_value = __chi_square_p(statistic, dof)
+            passed = p_value >= alpha
+            failures += not passed
+
+            status = "ok" if passed else "FAIL"
+            print(
+                f"  {pool} v {difficulty} {name:>10}: chi2={statistic:8.2f} dof={dof:2}",
+                f"p={p_value:.4f} {status}"
+            )
+
+    print(f"Distributions: {failures} failed chi-square tests")
+    return failures
+
+
+def check_chronicles(samples: int, alpha: float = 0.0001) -> int:
+    """
+    Chi-square test Chronicles rolls, with and without rote, against the exact distribution.
+    Returns (int): The number of failed tests
+    """
+    failures = 0
+    limit = distributions.EXCEPTIONAL_SUCCESSES + 1
+
+    for pool, difficulty, xpl_target in ((1, 8, 10), (4, 8, 10), (6, 8, 9), (9, 8, 8), (5, 7, 8)):
+        for rote in (False, True):
+            options = {
+                "xpl_target": xpl_target, "double_tens": False, "never_botch": True,
+                "ignore_ones": True, "wp_cancelable": False, "unsort_rolls": False, "rote": rote,
+            }
+            expected = distributions.chronicles_successes(
+                pool, difficulty, xpl_target, rote, limit
+            )
+
+            observed = Counter()
+            for _ in range(samples):
+                successes = roll.Pool(pool, difficulty, 0, False, True, options).successes
+                observed[min(successes, limit)] += 1
+
+            statistic, dof = __chi_square(observed, dict(enumerate(expected)), samples)
+            p_value = __chi_square_p(statistic, dof)
+            passed = p_value >= alpha
+            failures += not passed
+
+            status = "ok" if passed else "FAIL"
+            action = "rote" if rote else "standard"
+            print(
+                f"  {pool} @ {difficulty}, {xpl_target}-again {action:>8}:",
+                f"chi2={statistic:8.2f} dof={dof:2} p={p_value:.4f} {status}"
+            )
+
+    print(f"Chronicles: {failures} failed chi-square tests")
+    return failures
+
+
+def report_throughput(rolls: int):
+    """Print rolls per second for each roller and probabilities per second for each engine."""
+    options = {
+        "xpl_target": 10, "double_tens": True, "never_botch": False, "ignore_ones": False,
+        "wp_cancelable": False, "unsort_rolls": False,
+    }
+
+    for pool in (5, 20, 100):
+        start = time.perf_counter()
+        for _ in range(rolls):
+            roll.Pool(pool, 6, 0, False, False, options)
+        reference = rolls / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(rolls):
+            rolled = roll.vectorized.roll(pool, 10)
+            roll.vectorized.successes(Counter(rolled.dice), 6, 0, False, options)
+        fast = rolls / (time.perf_counter() - start)
+
+        print(f"  Pool {pool:3}: reference {reference:10,.0f}/s  vectorized {fast:10,.0f}/s")
+
+    for engine in (probabilities, distributions):
+        start = time.perf_counter()
+        for pool in range(1, 31):
+            engine.cached_probabilities.clear()
+            engine.get_probabilities(pool, 6, pool)
+        elapsed = time.perf_counter() - start
+        print(f"  {engine.__name__}: 30 uncached /stats in {elapsed * 1000:,.1f} ms")
+
+
+def __chronicles_reference(
+    pool: int, difficulty: int, xpl_target: int, rote: bool, faces: SeededFaces
+):
+    """
+    Roll a Chronicles pool one die at a time: the initial dice, then on a rote
+    action one reroll of each failure, then each die's explosions in turn.
+    Returns (roll.vectorized.RolledDice): The dice, explosions, and rerolls
+    """
+    dice = [faces.randint(1, 10) for _ in range(pool)]
+
+    rerolls = 0
+    if rote:
+        rerolls = sum(die < difficulty for die in dice)
+        dice = [die for die in dice if die >= difficulty]
+        dice.extend(faces.randint(1, 10) for _ in range(rerolls))
+
+    exploded = []
+    explosions = 0
+    for die in dice:
+        exploded.append(die)
+        while die >= xpl_target:
+            die = faces.randint(1, 10)
+            exploded.append(die)
+            explosions += 1
+
+    return roll.vectorized.RolledDice(exploded, explosions, rerolls)
+
+
+def __net(counts: Counter, difficulty: int) -> int:
+    """Returns the number of successes minus the number of ones."""
+    return sum(counts[face] for face in range(difficulty, 11)) - counts[1]
+
+
+def __chi_square(observed: Counter, expected: dict, samples: int) -> tuple:
+    """
+    Compute the chi-square statistic, merging sparse bins so each expects 5+ hits.
+    Returns (tuple): The statistic and the degrees of freedom
+    """
+    bins = []
+    p_bin = 0
+    hits = 0
+    for value in sorted(expected):
+        p_bin += expected[value]
+        hits += observed[value]
+        if p_bin * samples >= 5:
+            bins.append((hits, p_bin * samples))
+            p_bin = 0
+            hits = 0
+
+    if bins and (p_bin or hits):
+        last_hits, last_expected = bins.pop()
+        bins.append((last_hits + hits, last_expected + p_bin * samples))
+
+    statistic = sum((hits - expected) ** 2 / expected for hits, expected in bins)
+    return statistic, max(len(bins) - 1, 1)
+
+
+def __chi_square_p(statistic: float, dof: int) -> float:
+    """Approximate the chi-square upper tail using the Wilson-Hilferty transformation."""
+    spread = 2 / (9 * dof)
+    z_score = ((statistic / dof) ** (1 / 3) - (1 - spread)) / math.sqrt(spread)
+    return 0.5 * math.erfc(z_score / math.sqrt(2))
+
+
+def main() -> int:
+    """Run every check and return a process exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seeds", type=int, default=3, help="Seeded rolls per settings combo")
+    parser.add_argument("--stats-pool", type=int, default=15, help="Largest /stats pool to diff")
+    parser.add_argument("--samples", type=int, default=20000, help="Rolls per chi-square test")
+    parser.add_argument("--rolls", type=int, default=20000, help="Rolls per throughput test")
+    args = parser.parse_args()
+
+    failures = check_successes(args.seeds)
+    failures += check_chronicles_rolls(args.seeds)
+    failures += check_probabilities(args.stats_pool)
+    failures += check_distributions(args.samples)
+    failures += check_chronicles(args.samples)
+
+    print("Throughput:")
+    report_throughput(args.rolls)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
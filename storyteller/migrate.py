@@ -0,0 +1,35 @@
+"""migrate.py - Applies the migrations that backfill large tables.
+
+The bot applies most migrations when it starts, but one that copies a large
+table in batches would hold up the startup for as long as the copy takes. Such
+a migration is left pending, along with every migration after it, until this
+command runs its batches and applies them. The bot can keep running meanwhile.
+On a new database, whose tables have nothing to copy, the bot applies such
+migrations itself, so this is only needed to backfill existing data.
+Concurrent runs, and bots starting up, take turns through an advisory lock.
+
+Usage: python -m storyteller.migrate
+"""
+
+import sys
+
+from storyteller.databases import MigrationDB
+from storyteller.databases.migrations import MIGRATIONS
+
+
+def main() -> int:
+    """Apply every pending migration and return a process exit code."""
+    database = MigrationDB()
+
+    applied = database.migrate(backfill=True)
+    pending = [
+        migration.version for migration in MIGRATIONS
+        if migration.version not in database.applied_versions()
+    ]
+
+    print(f"Migrations: {len(applied)} applied, {len(pending)} pending")
+    return 1 if pending else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 """Package parse. Contains the various argument parsers."""
 
 from .pool import pool, is_valid_pool
+from .multiroll import multiroll
 from .traditional import traditional, is_valid_traditional
 from .db import database
 from .initiative import initiative, initiative_bulk_add, initiative_removal, initiative_declare
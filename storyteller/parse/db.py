@@ -33,8 +33,9 @@ async def database(ctx, command: dict) -> Union[dict, Response]:
 
     # If the command syntax doesn't start with an alpha character, then the user
     # isn't doing anything with the macro database, and we simply return the
-    # unmodified command for futher processing
-    if command["syntax"][0].isalpha():
+    # unmodified command for futher processing. The same goes for syntax that
+    # has already been expanded from a macro, such as a metamacro's members.
+    if command["syntax"][0].isalpha() and not command["expanded"]:
         if ctx.channel.type is discord.ChannelType.private:
             response = Response(Response.DATABASE)
             response.content = "Sorry, you can't store macros in private DMs!"
@@ -45,7 +46,7 @@ async def database(ctx, command: dict) -> Union[dict, Response]:
         # database hit) or an error message. If the former, pass that along for
         # further processing; if the latter, wrap it up in a Response object to
         # present to the user
-        query_result = engine.database.query_saved_rolls(
+        query_result = await engine.database.aio.query_saved_rolls(
             guild=ctx.guild.id,
             userid=ctx.author.id,
             command=command
@@ -11,7 +11,7 @@ from storyteller.initiative import InitiativeManager
 from .response import Response
 
 
-def initiative(
+async def initiative(
     ctx,
     mod: Optional[int],
     character_name: Optional[str],
@@ -91,7 +91,7 @@ def initiative(
     )
 
     # Track the initiative in the database
-    storyteller.initiative.set_initiative(
+    await storyteller.initiative.aio.set_initiative(
         ctx.guild.id, ctx.channel.id, character_name, init.mod, init.die
     )
     storyteller.engine.statistics.increment_initiative_rolls(ctx.guild)
@@ -99,22 +99,23 @@ def initiative(
     return response
 
 
-def initiative_bulk_add(ctx, characters: List[Tuple[str, int]]):
+async def initiative_bulk_add(ctx, characters: List[Tuple[str, int]]):
     """Add multiple characters to the initiative table."""
     if not (manager := storyteller.initiative.get_table(ctx.channel.id)):
         manager = InitiativeManager()
 
+    initiatives = []
     for char, mod in characters:
         init = manager.add_init(char, mod)
-        storyteller.initiative.set_initiative(
-            ctx.guild.id, ctx.channel.id, char, init.mod, init.die
-        )
+        initiatives.append((char, init.mod, init.die))
+
+    await storyteller.initiative.aio.set_initiatives(ctx.guild.id, ctx.channel.id, initiatives)
 
     storyteller.initiative.add_table(ctx.channel.id, manager)
     storyteller.engine.statistics.increment_initiative_rolls(ctx.guild)
 
 
-def initiative_removal(ctx, character_name: str) -> Response:
+async def initiative_removal(ctx, character_name: str) -> Response:
     """
     Remove a character from initiative and returns a status response.
     Args:
@@ -129,11 +130,11 @@ def initiative_removal(ctx, character_name: str) -> Response:
         character = character_name or ctx.author.display_name
         removed = manager.remove_init(character)
         if removed:
-            storyteller.initiative.remove_initiative(ctx.channel.id, character)
+            await storyteller.initiative.aio.remove_initiative(ctx.channel.id, character)
             message = f"Removed {character} from initiative!"
 
             if manager.count == 0:
-                storyteller.initiative.remove_table(ctx.channel.id)
+                await storyteller.initiative.aio.remove_table(ctx.channel.id)
                 message += "\nNo characters left in initiative. Clearing table."
 
             response.content = message
@@ -155,7 +156,7 @@ parser.add_argument("-n", "--name", nargs="*", dest="character")
 parser.add_argument("-c", "--celerity", nargs="?", type=int, const=1)
 
 
-def initiative_declare(ctx, args: list):
+async def initiative_declare(ctx, args: list):
     """
     Declare an initiative action.
     Args:
@@ -194,7 +195,7 @@ def initiative_declare(ctx, args: list):
             if not manager.declare_action(character, action):
                 raise NameError(character)
 
-            storyteller.initiative.set_initiative_action(
+            await storyteller.initiative.aio.set_initiative_action(
                 ctx.channel.id, character, action
             )
 
@@ -9,7 +9,7 @@ class MetaMacro:
         Args:
             ctx (discord.extensions.Context): A Discord bot context
             command (dict): A dictionary of command parameters
-            macros (list[str]): A list of macro names to perform
+            macros (list[Macro]): The name, syntax, and comment of each macro to perform
             handler: A completion handler for macro results. Signature:
                      handler(command, ctx, send: bool)
         """
@@ -28,9 +28,12 @@ class MetaMacro:
         if len(self.macros) == 0:
             return
 
+        # The macros were resolved along with the metamacro, so the handler
+        # is told not to look them up again
         macro = self.macros.pop(0)
-        self.command["syntax"] = macro
-        self.command["comment"] = None
+        self.command["syntax"] = macro.syntax
+        self.command["comment"] = macro.comment
+        self.command["expanded"] = True
         return await self.handler(self.command, self.ctx, send=False)
 
 
@@ -44,6 +47,6 @@ class MetaMacro:
     def next_macro_name(self) -> bool:
         """Returns the name of the next macro to be run."""
         try:
-            return self.macros[0]
+            return self.macros[0].name
         except IndexError:
             return None
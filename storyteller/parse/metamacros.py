@@ -20,7 +20,7 @@ __creating_metamacro = re.compile(r"^(?P<name>\w[\w-]*)\s*=\s*(?P<macros>.+)$")
 __deleting_metamacro = re.compile(r"^(?P<name>\w[\w-]*)\s*=\s*$")
 
 
-def parse(ctx, command: dict, handler) -> Union[Response, MetaMacro]:
+async def parse(ctx, command: dict, handler) -> Union[Response, MetaMacro]:
     """
     Parse metamacro input, allowing for creation, deletion, and retrieval but
     only the most limited of updating.
@@ -47,7 +47,7 @@ def parse(ctx, command: dict, handler) -> Union[Response, MetaMacro]:
     # an error if they gave a bad command
 
     if __using_metamacro.match(syntax):
-        macros = __metamacros.retrieve_macros(guildid, userid, syntax)
+        macros = await __metamacros.aio.retrieve_macros(guildid, userid, syntax)
         if macros:
             return MetaMacro(ctx, command, macros, handler)
         response.content = f"Error! You have no meta-macro named `${syntax}`."
@@ -64,7 +64,9 @@ def parse(ctx, command: dict, handler) -> Union[Response, MetaMacro]:
             response.content = "Error! Meta-macros must contain between 2-10 macros."
         else:
             try:
-                overwriting = __metamacros.store_metamacro(guildid, userid, meta_name, *macros)
+                overwriting = await __metamacros.aio.store_metamacro(
+                    guildid, userid, meta_name, *macros
+                )
                 if overwriting:
                     response.content = f"Meta-macro `${meta_name}` updated!"
                 else:
@@ -79,7 +81,7 @@ def parse(ctx, command: dict, handler) -> Union[Response, MetaMacro]:
     match = __deleting_metamacro.match(syntax)
     if match:
         meta_name = match.group("name")
-        if __metamacros.delete_metamacro(guildid, userid, meta_name):
+        if await __metamacros.aio.delete_metamacro(guildid, userid, meta_name):
             response.content = f"Deleted meta-macro `${meta_name}`!"
         else:
             response.content = f"Error! You have no meta-macro named `${meta_name}` on this server!"
@@ -90,7 +92,7 @@ def parse(ctx, command: dict, handler) -> Union[Response, MetaMacro]:
     return None
 
 
-def meta_records(guildid: int, userid: int) -> list[tuple[str, list[str]]]:
+async def meta_records(guildid: int, userid: int) -> list[tuple[str, list[str]]]:
     """
     Retrieve the "meta-records" for the user. This function is effectively a
     wrapper for the MetaMacroDB class's metamacro_list() method.
@@ -104,10 +106,10 @@ def meta_records(guildid: int, userid: int) -> list[tuple[str, list[str]]]:
     # and a list of strings (associated macro names) as the second. In the future,
     # this may be changed to a namedtuple for the sake of clarity.
 
-    return __metamacros.metamacro_list(guildid, userid)
+    return await __metamacros.aio.metamacro_list(guildid, userid)
 
 
-def meta_count(guildid: int, userid: int) -> int:
+async def meta_count(guildid: int, userid: int) -> int:
     """
     Retrieve the number of metamacros the user has in a given guild. This
     function is a wrapper for the MetaMacroDB metamacro_count() method.
@@ -116,4 +118,4 @@ def meta_count(guildid: int, userid: int) -> int:
         userid (int): The Discord ID of the user
     Returns (int): The number of metamacros the user has in the guild
     """
-    return __metamacros.metamacro_count(guildid, userid)
+    return await __metamacros.aio.metamacro_count(guildid, userid)
@@ -0,0 +1,210 @@
+"""multiroll.py - Performs several rolls from a single invocation."""
+
+# Multi-roll syntax separates rolls with semicolons: "7 6; 5 6 +1; 2d10". Every
+# expression is parsed and validated before anything is rolled, and all of the
+# pools are rolled together in a single batch. The results are shown in one
+# embed, with one field per roll. Syntax is only a multi-roll if every part is
+# a pool or a traditional roll. Otherwise, as with a specialty containing a
+# semicolon (7 6 Brawl; Grapple), it's left to the other parsers.
+
+import copy
+from typing import Optional
+
+from storyteller import engine, roll  # pylint: disable=cyclic-import
+
+from .pool import (
+    MAX_EMOJI_DICE, PoolRoll, emojify_dice, explosions_note, is_valid_pool, match_pool,
+    prepare_roll, roll_request
+)
+from .response import Response
+from .traditional import is_valid_traditional
+
+MAX_ROLLS = 10
+
+# Embeds are limited to 6000 characters in total, so emoji are only used when
+# every pool in the batch can be shown that way
+MAX_EMOJI_TOTAL = 150
+
+
+async def multiroll(ctx, command: dict) -> Optional[Response]:
+    """
+    Parse user input to determine if they are performing several rolls at once.
+    If they are, roll them all and return the results.
+    Args:
+        ctx (discord.ext.commands.Context): The bot invocation context
+        command (dict): The user's syntax, comment, invocation parameters, and
+                        server settings
+    Returns (Optional[Response]): The results, an error, or None if not a multi-roll
+    """
+    syntax = command["syntax"]
+    if ";" not in syntax or syntax[0].isalpha() or syntax[0] == "$":
+        return None
+
+    expressions = [expression.strip() for expression in syntax.split(";")]
+    expressions = [expression for expression in expressions if expression]
+
+    for expression in expressions:
+        if not (is_valid_pool(expression) or is_valid_traditional(expression)):
+            return None
+
+    if not 1 < len(expressions) <= MAX_ROLLS:
+        return __error(f"Multi-rolls must have between 2 and {MAX_ROLLS} rolls.")
+
+    # Parse everything before rolling anything
+    rolls = []
+    for expression in expressions:
+        parsed = __parse_expression(command, expression)
+        if isinstance(parsed, str):
+            return __error(f"`{expression}`: {parsed}")
+        rolls.append(parsed)
+
+    # Roll every pool in one batch
+    pools = [parameters for parameters in rolls if isinstance(parameters, PoolRoll)]
+    batch = roll.vectorized.roll_batch(list(map(roll_request, pools)))
+    rolled = iter(batch)
+
+    results = []
+    for expression, parameters in zip(expressions, rolls):
+        if isinstance(parameters, PoolRoll):
+            dice_pool, difficulty, autos, will, chronicles, options, *_ = parameters
+            pool_result = roll.Pool(
+                dice_pool, difficulty, autos, will, chronicles, options, next(rolled)
+            )
+            results.append((parameters, pool_result))
+        else:
+            results.append((expression, parameters))
+
+    response_type = Response.POOL if pools else Response.TRADITIONAL
+
+    if command["use_compact"]:
+        return Response(response_type, content=__build_compact(results, command["comment"]))
+
+    can_use_emoji = ctx.channel.permissions_for(ctx.guild.default_role).external_emojis
+    can_use_emoji &= sum(len(pool_result.dice) for pool_result in __pool_results(results)) \
+        <= MAX_EMOJI_TOTAL
+
+    fields = []
+    if command["override"]:
+        fields.append(("Macro override", command["override"], False))
+
+    for description, result in results:
+        if isinstance(result, roll.Pool):
+            fields.append(__pool_field(description, result, can_use_emoji))
+        else:
+            fields.append(__traditional_field(description, result))
+
+    embed = engine.build_embed(
+        author=ctx.author,
+        header=syntax,
+        fields=fields,
+        footer=command["comment"],
+    )
+
+    return Response(response_type, embed=embed)
+
+
+def __parse_expression(command: dict, expression: str):
+    """
+    Parse a single roll expression.
+    Args:
+        command (dict): The user's full command
+        expression (str): One of the semicolon-separated roll expressions
+    Returns (Union[str, PoolRoll, TraditionalRoll]): An error message or the parsed roll
+    """
+    if expression[0].isalpha() or expression[0] == "$":
+        return "Macros can't be used in a multi-roll."
+
+    if (groups := match_pool(expression)) is not None:
+        # Each pool gets its own copy of the command, as prepare_roll() reads
+        # the regex capture groups from it
+        pool_command = copy.copy(command)
+        pool_command["syntax"] = expression
+        pool_command.update(groups)
+
+        if groups["repeat"] is not None:
+            return "Repeated rolls can't be used in a multi-roll."
+
+        return prepare_roll(pool_command)
+
+    if (result := roll.traditional.roll_from_string(expression)) is not None:
+        return result
+
+    return "Come again?"
+
+
+def __pool_results(results: list) -> list:
+    """Returns the pool results from a list of (description, result) tuples."""
+    return [result for _, result in results if isinstance(result, roll.Pool)]
+
+
+def __pool_field(parameters, results: roll.Pool, can_use_emoji: bool) -> tuple:
+    """
+    Build the embed field for a pool roll.
+    Args:
+        parameters (PoolRoll): The roll parameters
+        results (roll.Pool): The roll results
+        can_use_emoji (bool): Whether the dice may be shown as emoji
+    Returns (tuple): The field name, value, and inline setting
+    """
+    name = parameters.title + explosions_note(results)
+    if parameters.specialty:
+        name += f" ({parameters.specialty})"
+
+    if can_use_emoji and len(results.dice) <= MAX_EMOJI_DICE:
+        dice = emojify_dice(results.dice_emoji_names, parameters.will, parameters.autos)
+    else:
+        dice = results.formatted_dice
+
+    result = f"**{results.formatted_result}**"
+    available = 1024 - len(result) - 1
+    if len(dice) > available:
+        dice = dice[:available - 1] + "…"
+
+    return (name, f"{dice}\n{result}", False)
+
+
+def __traditional_field(expression: str, result) -> tuple:
+    """
+    Build the embed field for a traditional roll.
+    Args:
+        expression (str): The roll expression
+        result (roll.traditional.TraditionalRoll): The roll results
+    Returns (tuple): The field name, value, and inline setting
+    """
+    value = f"**{result.total}**"
+    if result.equation != result.total:
+        value = f"{result.equation} = {value}"
+
+    return (expression, value, False)
+
+
+def __build_compact(results: list, comment: str) -> str:
+    """
+    Generate a compact result string for the rolls, one line per roll.
+    Args:
+        results (list): The (description, result) tuples of each roll
+        comment (str): The description text for the roll
+    Returns (str): The formatted compact result string
+    """
+    lines = []
+    if comment:
+        lines.append(f"> {comment}\n")
+
+    for description, result in results:
+        if isinstance(result, roll.Pool):
+            line = f"{description.title}: {result.formatted_dice}"
+            if description.specialty:
+                line += f"   ({description.specialty})"
+            lines.append(f"{line}   **{result.formatted_result}**")
+        else:
+            lines.append(f"{description}: {__traditional_field(description, result)[1]}")
+
+    return "\n".join(lines)
+
+
+def __error(message: str) -> Response:
+    """Wrap an error message in an ephemeral Response."""
+    response = Response(Response.POOL, content=message)
+    response.ephemeral = True
+
+    return response
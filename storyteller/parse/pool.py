@@ -1,15 +1,26 @@
 """pool.py - Performs pool-based rolls for the user."""
 
 import re
-from typing import Union
+from collections import Counter, namedtuple
+from typing import Optional, Union
 
 import discord
-from storyteller import engine, roll  # pylint: disable=cyclic-import
+from storyteller import engine, roll, sprites  # pylint: disable=cyclic-import
 
 from .response import Response
 
 __poolx = re.compile(
-    r"^(?P<pool>-?\d+)[\s@]?(?P<difficulty>\d+)?\s?(?P<auto>[+-]?\d+)?(?: (?P<specialty>\D[^#]*))?$"
+    r"^(?P<pool>-?\d+)[\s@]?(?P<difficulty>\d+)?\s?(?P<auto>[+-]?\d+)?(?:\s?x(?P<repeat>\d+))?"
+    r"(?: (?P<specialty>\D[^#]*))?$"
+)
+
+PoolRoll = namedtuple(
+    "PoolRoll",
+    [
+        "pool", "difficulty", "autos", "will", "chronicles", "options", "specialty", "title",
+        "repeat"
+    ],
+    defaults=(1,)
 )
 
 # These embed colors are used for giving at-a-glance notice if a roll was
@@ -21,6 +32,13 @@ MARGINAL_COLOR = 0x14A1A0
 FAIL_COLOR = 0x777777
 BOTCH_COLOR = 0xFF0000
 
+# Emoji dice overflow the embed field beyond this many dice, so larger pools
+# are rendered as an image instead
+MAX_EMOJI_DICE = 37
+
+# The most times a pool may be rolled with the repeat modifier (7 6 x10)
+MAX_REPEAT = 50
+
 
 async def pool(ctx, command: dict) -> Response:
     """
@@ -31,16 +49,16 @@ async def pool(ctx, command: dict) -> Response:
         command (dict): The user's syntax, comment, invocation parameters, and
                         server settings
     """
-    pool_command = __poolx.match(command["syntax"])
+    pool_command = match_pool(command["syntax"])
     if pool_command:
         # pool_command's capture groups contain a great deal of information
         # about the user's intentions, including pool, difficulty, and specialty
-        command.update(pool_command.groupdict())
-        result = __pool_roll(ctx, command)
+        command.update(pool_command)
+        result = await __pool_roll(ctx, command)
 
         # Wrap up the roll result in a Response type
-        if isinstance(result, discord.Embed):
-            return Response(Response.POOL, embed=result)
+        if isinstance(result, Response):
+            return result
 
         return Response(Response.POOL, content=result)
 
@@ -55,17 +73,28 @@ def is_valid_pool(syntax: str) -> bool:
     return __poolx.match(syntax) is not None
 
 
-def __pool_roll(ctx, command: dict) -> Union[str, discord.Embed]:
+def match_pool(syntax: str) -> Optional[dict]:
     """
-    Perform a pool-based roll.
+    Match the syntax against the pool regex.
     Args:
-        ctx (discord.ext.commands.Context): The bot invocation context
-        command (dict): The user's syntax, comment, invocation parameters, and
-                        server settings
-    Returns (Union[str, discord.Embed]): The formatted roll result
+        syntax (str): The user's command syntax
+    Returns (Optional[dict]): The pool, difficulty, auto, and specialty capture
+                              groups, or None if the syntax isn't a pool roll
+    """
+    if (pool_command := __poolx.match(syntax)) is not None:
+        return pool_command.groupdict()
+    return None
+
+
+def prepare_roll(command: dict) -> Union[str, PoolRoll]:
+    """
+    Validate a pool command and determine the parameters of its roll.
+    Args:
+        command (dict): The user's syntax, invocation parameters, and server
+                        settings, updated with the pool regex's capture groups
+    Returns (Union[str, PoolRoll]): An error message or the roll parameters
     """
     will = command["will"]
-    compact = command["use_compact"]
     dice_pool = int(command["pool"])
 
     if not 1 <= dice_pool <= 100:
@@ -104,54 +133,193 @@ def __pool_roll(ctx, command: dict) -> Union[str, discord.Embed]:
     if chronicles and not difficulty <= options["xpl_target"] <= 10:
         return f"Whoops! X-Again must be between {difficulty} and 10, not {options['xpl_target']}."
 
+    # The repeat modifier rolls the same pool several times
+    repeat = int(command["repeat"] or 1)
+    if not 1 <= repeat <= MAX_REPEAT:
+        return f"Sorry, you can repeat a roll between 1 and {MAX_REPEAT} times. *(Input: {repeat})*"
+
     # Sometimes, a roll may have auto-successes that can be canceled by 1s.
     autos = int(command["auto"] or 0)
 
     specialty = command["specialty"]  # Doubles 10s if set
-    if specialty.casefold() == "yes":
+    if specialty and specialty.casefold() == "yes":
         return "Actually put a specialty, you coward. You absolute scrub. None of this 'yes' BS."
 
+    # Chronicles rote actions are requested with a leading "rote" in place of a specialty
+    options["rote"] = False
+    words = specialty.split(maxsplit=1) if specialty else []
+    if chronicles and words and words[0].casefold() == "rote":
+        options["rote"] = True
+        specialty = words[1] if len(words) > 1 else None
+
     options["double_tens"] = __should_double(command, specialty is not None)
 
     if not chronicles:  # Regular CofD rolls *always* explode
         options["xpl_target"] = __explosion_target(command, specialty is not None)
 
+    # The embed title describes the roll
+    title = f"Pool {dice_pool}, diff. {difficulty}"
+    if chronicles:
+        title = f"Pool {dice_pool}, {options['xpl_target']}-again"
+        if options["rote"]:
+            title += ", rote"
+
+    if autos != 0:
+        title += f", {__pluralize_auto_successes(autos)}"
+
+    # Let the user know if we aren't allowing botches
+    if command["never_botch"] and not chronicles:
+        title += ", no botch"
+
+    if repeat > 1:
+        title += f", ×{repeat}"
+
+    return PoolRoll(
+        dice_pool, difficulty, autos, will, chronicles, options, specialty, title, repeat
+    )
+
+
+def roll_request(parameters: PoolRoll) -> roll.vectorized.RollRequest:
+    """
+    Describe a prepared roll for the batched roller.
+    Args:
+        parameters (PoolRoll): The roll parameters from prepare_roll()
+    Returns (roll.vectorized.RollRequest): The dice to roll
+    """
+    dice_pool = parameters.pool
+    if parameters.chronicles and parameters.will:
+        dice_pool += 3 # Willpower adds three dice in Chronicles
+
+    options = parameters.options
+    rote_difficulty = parameters.difficulty if options["rote"] else 0
+
+    return roll.vectorized.RollRequest(dice_pool, options["xpl_target"], rote_difficulty)
+
+
+def explosions_note(results: roll.Pool) -> str:
+    """Returns a note of the roll's explosions for the embed title, if there were any."""
+    if results.explosions > 0:
+        explosions = "explosion" if results.explosions == 1 else "explosions"
+        return f" (+{results.explosions} {explosions})"
+    return ""
+
+
+async def __pool_roll(ctx, command: dict) -> Union[str, Response]:
+    """
+    Perform a pool-based roll.
+    Args:
+        ctx (discord.ext.commands.Context): The bot invocation context
+        command (dict): The user's syntax, comment, invocation parameters, and
+                        server settings
+    Returns (Union[str, Response]): The compact roll result or a Response with an embed
+    """
+    parameters = prepare_roll(command)
+    if isinstance(parameters, str):
+        return parameters
+
+    if parameters.repeat > 1:
+        return __repeated_roll(ctx, command, parameters)
+
     # Finally, roll it!
+    dice_pool, difficulty, autos, will, chronicles, options, specialty, title, _ = parameters
     results = roll.Pool(dice_pool, difficulty, autos, will, chronicles, options)
 
     # OUTPUT GENERATION
 
     comment = command["comment"]
 
-    if compact:
+    if command["use_compact"]:
         # The user or the server has requested compact formatting instead of Discord
         # embeds. This format has the side effect of being nicer for screen readers
         return __build_compact(results, specialty, comment)
 
     # EMBED CREATION
 
-    title = f"Pool {dice_pool}, diff. {difficulty}"
-    if command["chronicles"]:
-        title = f"Pool {dice_pool}, {options['xpl_target']}-again"
+    # Inform the user of any explosions
+    title += explosions_note(results)
 
-    if autos != 0:
-        title += f", {__pluralize_auto_successes(autos)}"
+    return await __build_embed(
+        ctx, command["override"], results, specialty, will, autos, title, comment
+    )
 
-    # Let the user know if we aren't allowing botches
-    if command["never_botch"] and not command["chronicles"]:
-        title += ", no botch"
 
-    # Inform the user of any explosions
-    if results.explosions > 0:
-        explosions = "explosion" if results.explosions == 1 else "explosions"
-        title += f" (+{results.explosions} {explosions})"
+def __repeated_roll(ctx, command: dict, parameters: PoolRoll) -> Union[str, Response]:
+    """
+    Roll the same pool several times. Every roll comes from a single batch and
+    is scored from its face counts, so no Pool objects are created.
+    Args:
+        ctx (discord.ext.commands.Context): The bot invocation context
+        command (dict): The user's syntax, comment, invocation parameters, and
+                        server settings
+        parameters (PoolRoll): The roll parameters from prepare_roll()
+    Returns (Union[str, Response]): The compact roll results or a Response with an embed
+    """
+    request = roll_request(parameters)
+    rolls = roll.vectorized.roll_batch([request] * parameters.repeat)
+
+    # Chronicles Willpower adds dice rather than a success
+    will = parameters.will and not parameters.chronicles
+    results = [
+        roll.vectorized.successes(
+            Counter(rolled.dice), parameters.difficulty, parameters.autos, will, parameters.options
+        )
+        for rolled in rolls
+    ]
+
+    # Aggregate the results. Botches count as zero successes toward the mean.
+    mean = sum(max(successes, 0) for successes in results) / len(results)
+    botches = sum(successes < 0 for successes in results)
+    listing = ", ".join(map(__format_successes, results))
+    summary = f"Mean: {mean:.1f}, best: {__format_successes(max(results))}, "
+    summary += f"worst: {__format_successes(min(results))}"
+    if botches:
+        summary += f", {botches} {'botch' if botches == 1 else 'botches'}"
+    if parameters.chronicles:
+        exceptional = sum(successes >= 5 for successes in results)
+        summary += f", {exceptional} exceptional"
 
-    return __build_embed(
-        ctx, command["override"], results, specialty, will, autos, title, comment
+    comment = command["comment"]
+
+    if command["use_compact"]:
+        compact_string = ""
+        if comment:
+            compact_string += f"> {comment}\n\n"
+
+        compact_string += f"{parameters.title}: {listing}"
+        if parameters.specialty:
+            compact_string += f"   ({parameters.specialty})"
+        compact_string += f"\n**{summary}**"
+
+        return compact_string
+
+    fields = []
+    if command["override"]:
+        fields.append(("Macro override", command["override"], False))
+
+    fields.append(("Successes", listing, False))
+    if parameters.specialty:
+        fields.append(("Specialty", parameters.specialty, True))
+
+    embed = engine.build_embed(
+        author=ctx.author,
+        title=summary,
+        header=parameters.title,
+        color=success_color(round(mean)),
+        fields=fields,
+        footer=comment,
     )
 
+    return Response(Response.POOL, embed=embed)
 
-def __build_embed(
+
+def __format_successes(successes: int) -> str:
+    """Returns the successes of a repeated roll, marking botches."""
+    if successes < 0:
+        return f"*botch ({successes})*"
+    return str(successes)
+
+
+async def __build_embed(
     ctx: discord.ext.commands.Context,
     override: bool,
     results: roll.Pool,
@@ -172,32 +340,33 @@ def __build_embed(
         autos (int): The number of automatic successes for the roll
         title (str): The title for the embed
         comment (str): The description text for the roll
-    Returns (discord.Embed): The formatted embed
+    Returns (Response): A Response containing the formatted embed and, for
+                        large pools, an image of the dice
     """
     # pylint: disable=too-many-arguments
 
     # The embed's color indicates if the roll succeeded, failed, or botched
-    color = FAIL_COLOR
-    if results.successes >= 5:
-        color = EXCEPTIONAL_COLOR
-    elif results.successes >= 3:
-        color = SUCCESS_COLOR
-    elif results.successes > 0:
-        color = MARGINAL_COLOR
-    elif results.successes < 0:
-        color = BOTCH_COLOR
+    color = success_color(results.successes)
 
     # Set up the embed fields
     fields = []
     if override:
         fields.append(("Macro override", override, False))
 
-    # Display individual dice as emoji, if available
+    # Display individual dice as emoji, if available. Pools too large for emoji
+    # are drawn as an image, leaving the field for Willpower and autos only. If
+    # the bot can't attach files here, they're listed as text instead.
     can_use_emoji = ctx.channel.permissions_for(ctx.guild.default_role).external_emojis
-
-    if can_use_emoji and len(results.dice) <= 37:
+    can_attach = ctx.channel.permissions_for(ctx.me).attach_files
+    image = None
+
+    if len(results.dice) > MAX_EMOJI_DICE and can_attach:
+        image = await sprites.render(results.dice_emoji_names)
+        if (annotations := emojify_dice([], will, autos).strip()):
+            fields.append(("Dice", annotations, True))
+    elif can_use_emoji and len(results.dice) <= MAX_EMOJI_DICE:
         names = results.dice_emoji_names
-        emojis = __emojify_dice(names, will, autos)
+        emojis = emojify_dice(names, will, autos)
         fields.append(("Dice", emojis, True))
     else:
         fields.append(("Dice", results.formatted_dice, True))
@@ -205,7 +374,7 @@ def __build_embed(
     if specialty:
         fields.append(("Specialty", specialty, True))
 
-    return engine.build_embed(
+    embed = engine.build_embed(
         author=ctx.author,
         title=results.formatted_result,
         header=title,
@@ -214,6 +383,29 @@ def __build_embed(
         footer=comment,
     )
 
+    if image:
+        embed.set_image(url=f"attachment://{image.filename}")
+
+    return Response(Response.POOL, embed=embed, file=image)
+
+
+def success_color(successes: int) -> int:
+    """
+    Determine the embed color for a roll.
+    Args:
+        successes (int): The roll's successes; negative for a botch
+    Returns (int): Gray for failure, red for botch, and brightening greens for success
+    """
+    if successes >= 5:
+        return EXCEPTIONAL_COLOR
+    if successes >= 3:
+        return SUCCESS_COLOR
+    if successes > 0:
+        return MARGINAL_COLOR
+    if successes < 0:
+        return BOTCH_COLOR
+    return FAIL_COLOR
+
 
 def __build_compact(results: str, specialty: str, comment: str) -> str:
     """
@@ -284,7 +476,7 @@ emojidict = {
 }
 
 
-def __emojify_dice(emoji_names: list[str], willpower: bool, autos: int) -> str:
+def emojify_dice(emoji_names: list[str], willpower: bool, autos: int) -> str:
     """
     Convert a roll string to an emoji string.
     Args:
@@ -11,18 +11,20 @@ class Response:
     META_MACRO = 5 # Metamacro response
 
 
-    def __init__(self, response_type, embed=None, content=None):
+    def __init__(self, response_type, embed=None, content=None, file=None):
         """
         Create a basic Response object.
         Args:
             response_type (int): The type of response being created
             embed (Optional[discord.Embed]): The embed to present to the user
             content (Optional[str]): The string to present to the user
+            file (Optional[discord.File]): A file to attach, such as a dice image
         A Response can contain both an embed and content string.
         """
         self.type = response_type
         self.embed = embed
         self.content = content
+        self.file = file
         self.add_reaction = False
         self.ephemeral = False
 
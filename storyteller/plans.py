@@ -0,0 +1,127 @@
+"""plans.py - Checks that the hot database queries can use their indexes.
+
+Each check EXPLAINs one of the bot's frequent queries and verifies that the
+plan reads the index made for it. On a partitioned table, a plan reads the
+index of each partition it touches, which counts as reading the parent index.
+Sequential scans are disabled while planning, as the planner rightly prefers
+them on small tables; a query that still doesn't use its index can't use it
+at all.
+
+The checks run inside a transaction that is rolled back, so they leave the
+database as they found it. They read Postgres plans, so a SQLite database
+isn't checked.
+
+Usage: python -m storyteller.plans
+"""
+
+import json
+import sys
+from collections import namedtuple
+
+from storyteller.databases import RollDB
+
+PlanCheck = namedtuple("PlanCheck", ["description", "query", "args", "index"])
+
+GUILD = 1
+USER = 2
+
+CHECKS = (
+    PlanCheck(
+        "Macro lookup",
+        "SELECT Syntax, Comment FROM SavedRolls "
+        "WHERE Guild=%s AND ID=%s AND lower(Name)=lower(%s);",
+        (GUILD, USER, "attack"),
+        "savedrolls_owner_name_unique",
+    ),
+    PlanCheck(
+        "Macro cache load",
+        "SELECT Name, Syntax, Comment FROM SavedRolls WHERE Guild=%s AND ID=%s;",
+        (GUILD, USER),
+        "savedrolls_owner_name_unique",
+    ),
+    PlanCheck(
+        "Similar macro suggestion",
+        "SELECT Name FROM SavedRolls WHERE Guild=%s AND ID=%s AND SIMILARITY(Name, %s)>0.2;",
+        (GUILD, USER, "atack"),
+        "savedrolls_owner_name_unique",
+    ),
+    PlanCheck(
+        "Metamacro lookup",
+        "SELECT MacroID FROM MetaMacros "
+        "WHERE GuildID=%s AND UserID=%s AND lower(MetaName)=lower(%s);",
+        (GUILD, USER, "combo"),
+        "metamacros_owner_name",
+    ),
+    PlanCheck(
+        "Macro deletion cascade",
+        "SELECT 1 FROM MetaMacros WHERE GuildID=%s AND MacroID=%s;",
+        (GUILD, 1),
+        "metamacros_macro",
+    ),
+    PlanCheck(
+        "Initiative removal",
+        "SELECT 1 FROM Initiative WHERE Channel=%s AND Character=%s;",
+        (3, "Alice"),
+        "initiative_channel_character",
+    ),
+)
+
+
+def check_plans(checks: tuple = CHECKS) -> int:
+    """
+    EXPLAIN every check and report which indexes each plan uses.
+    Returns (int): The number of queries that didn't use their index
+    """
+    failures = 0
+    database = RollDB()
+
+    if database.dialect != "postgres":
+        print(f"Plans: Not checked, as the database is {database.dialect}")
+        return 0
+
+    with database.backend.cursor() as cursor:
+        cursor.execute("BEGIN;")
+        try:
+            cursor.execute("SET LOCAL enable_seqscan = off;")
+            for check in checks:
+                cursor.execute("EXPLAIN (FORMAT JSON) " + check.query, check.args)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+
+                indexes = {__root_index(cursor, index) for index in __indexes(plan[0]["Plan"])}
+                passed = check.index in indexes
+                failures += not passed
+
+                status = "ok" if passed else "FAIL"
+                used = ", ".join(sorted(indexes)) or "no index"
+                print(f"  {check.description:>24}: {used} {status}")
+        finally:
+            cursor.execute("ROLLBACK;")
+
+    print(f"Plans: {failures} queries not using their index")
+    return failures
+
+
+def __indexes(node: dict) -> set:
+    """Returns the names of the indexes read by a plan node and its children."""
+    indexes = {node["Index Name"]} if "Index Name" in node else set()
+    for child in node.get("Plans", []):
+        indexes |= __indexes(child)
+
+    return indexes
+
+
+def __root_index(cursor, index: str) -> str:
+    """Returns the name of the partitioned index a partition's index belongs to."""
+    cursor.execute("SELECT pg_partition_root(%s::regclass)::text;", (index,))
+    return cursor.fetchone()[0] or index
+
+
+def main() -> int:
+    """Run every check and return a process exit code."""
+    return 1 if check_plans() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
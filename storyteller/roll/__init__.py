@@ -2,3 +2,4 @@
 
 from .pool import Pool
 from . import traditional
+from . import vectorized
@@ -1,17 +1,31 @@
 """A class for performing pool-based rolls and determining number of successes."""
 
-from . import traditional
+from . import traditional, vectorized
 
 
 class Pool:
     """Provides facilities for pool-based rolls."""
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, pool, diff, autos, wp, cofd, options):
+    def __init__(self, pool, diff, autos, wp, cofd, options, rolled=None):
+        """
+        Roll a pool and determine its successes.
+        Args:
+            pool (int): The number of dice to roll
+            diff (int): The roll's difficulty
+            autos (int): Automatic successes; negative values are automatic failures
+            wp (bool): Whether Willpower is used
+            cofd (bool): Whether to use Chronicles of Darkness rules
+            options (dict): The roll options (explosions, double tens, etc.)
+            rolled (Optional[vectorized.RolledDice]): Dice already rolled in a
+                                                      batch, if any
+        """
         # pylint: disable=too-many-arguments
         self.difficulty = diff
         self.autos = autos
         self.xpl_target = options["xpl_target"]
+        self.cofd = cofd
+        self.rote = cofd and options.get("rote", False)
 
         if cofd:
             self.will = False
@@ -27,10 +41,17 @@ class Pool:
         self.sort_rolls = not options["unsort_rolls"]
 
         self.explosions = 0
-        self.dice = self.__roll(pool)
+        self.rerolls = 0
+        self.dice = self.__roll(pool, rolled)
         self.successes = self.__calculate_successes()
 
 
+    @property
+    def exceptional(self) -> bool:
+        """True if this is a Chronicles roll with an exceptional success."""
+        return self.cofd and self.successes >= 5
+
+
     @property
     def formatted_result(self):
         """Format the successes to something nice for people to read."""
@@ -40,6 +61,8 @@ class Pool:
             result_str = f"{successes} success"
             if successes > 1:
                 result_str += "es"
+            if self.exceptional:
+                result_str += " (exceptional)"
         elif successes == 0 or self.no_botch:
             result_str = "Failure"
         else:
@@ -137,8 +160,26 @@ class Pool:
         return suxx
 
 
-    def __roll(self, pool) -> list:
+    def __roll(self, pool, rolled) -> list:
         """Roll the dice!"""
+        if self.cofd and not rolled:
+            # Chronicles rolls go through the batched engine, which handles rote actions
+            rolled = vectorized.roll_chronicles(pool, self.difficulty, self.xpl_target, self.rote)
+
+        if rolled:
+            self.explosions = rolled.explosions
+            self.rerolls = rolled.rerolls
+            dice = rolled.dice
+        else:
+            dice = self.__roll_dice(pool)
+
+        if self.sort_rolls:
+            return sorted(dice, reverse=True)
+        return dice
+
+
+    def __roll_dice(self, pool) -> list:
+        """Roll the dice one at a time, exploding as necessary."""
         dice = []
         for _ in range(pool):
             die = traditional.roll(1, 10)[0]
@@ -148,6 +189,4 @@ class Pool:
                 self.explosions += 1
             dice.append(die)
 
-        if self.sort_rolls:
-            return sorted(dice, reverse=True)
         return dice
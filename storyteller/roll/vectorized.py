@@ -0,0 +1,140 @@
+"""vectorized.py - Batched pool rolls that score face counts rather than individual dice."""
+
+import random
+from collections import Counter, namedtuple
+
+
+FACES = range(1, 11)
+
+RolledDice = namedtuple(
+    "RolledDice", ["dice", "explosions", "rerolls"], defaults=(0,), module="roll.vectorized"
+)
+
+
+RollRequest = namedtuple(
+    "RollRequest", ["pool", "xpl_target", "rote_difficulty"], defaults=(0,),
+    module="roll.vectorized"
+)
+
+
+def roll(pool: int, xpl_target: int, rng=random) -> RolledDice:
+    """
+    Roll a pool of d10s in a single batch. Exploding dice are rolled in further
+    batches, one per wave of explosions, rather than one die at a time.
+    Args:
+        pool (int): The number of dice to roll
+        xpl_target (int): The face at or above which dice explode (11 for never)
+        rng: The random number generator to draw from
+    Returns (RolledDice): The dice, in roll order, and the number of explosions
+    """
+    return roll_batch([RollRequest(pool, xpl_target)], rng)[0]
+
+
+def roll_chronicles(
+    pool: int, difficulty: int, xpl_target: int, rote: bool, rng=random
+) -> RolledDice:
+    """
+    Roll a Chronicles of Darkness pool. On a rote action, every die that fails
+    the initial roll is rerolled once, in one batch, before any dice explode.
+    Args:
+        pool (int): The number of dice to roll
+        difficulty (int): The face at or above which dice succeed
+        xpl_target (int): The x-again threshold
+        rote (bool): Whether the roll is a rote action
+        rng: The random number generator to draw from
+    Returns (RolledDice): The dice, explosions, and number of rerolled dice
+    """
+    request = RollRequest(pool, xpl_target, difficulty if rote else 0)
+    return roll_batch([request], rng)[0]
+
+
+def roll_batch(requests: list[RollRequest], rng=random) -> list[RolledDice]:
+    """
+    Roll several pools at once. Every pool's dice come from a single draw, as
+    do all rote rerolls and each wave of explosions across all the pools.
+    Args:
+        requests (list[RollRequest]): The pools to roll. A nonzero rote_difficulty
+                                      rerolls dice below it once, before explosions.
+        rng: The random number generator to draw from
+    Returns (list[RolledDice]): The results, in the same order as the requests
+    """
+    rolls = __split(rng.choices(FACES, k=sum(r.pool for r in requests)), [r.pool for r in requests])
+
+    rerolls = [0] * len(requests)
+    if any(r.rote_difficulty for r in requests):
+        for index, request in enumerate(requests):
+            if request.rote_difficulty:
+                kept = list(filter(request.rote_difficulty.__le__, rolls[index]))
+                rerolls[index] = request.pool - len(kept)
+                rolls[index] = kept
+
+        draws = __split(rng.choices(FACES, k=sum(rerolls)), rerolls)
+        for dice, rerolled in zip(rolls, draws):
+            dice.extend(rerolled)
+
+    # Comparisons are mapped over each batch at once
+    explosions = [0] * len(requests)
+    pending = [sum(map(r.xpl_target.__le__, dice)) for r, dice in zip(requests, rolls)]
+    while any(pending):
+        waves = __split(rng.choices(FACES, k=sum(pending)), pending)
+        for index, wave in enumerate(waves):
+            rolls[index].extend(wave)
+            explosions[index] += pending[index]
+            pending[index] = sum(map(requests[index].xpl_target.__le__, wave))
+
+    return [RolledDice(*result) for result in zip(rolls, explosions, rerolls)]
+
+
+def successes(counts: Counter, difficulty: int, autos: int, will: bool, options: dict) -> int:
+    """
+    Score a roll from its face counts. The rules are identical to those of
+    roll.Pool, but each face is considered once instead of once per die.
+    Args:
+        counts (Counter): The number of dice showing each face
+        difficulty (int): The roll's difficulty
+        autos (int): Automatic successes; negative values are automatic failures
+        will (bool): Whether Willpower was used on the roll
+        options (dict): The double_tens, never_botch, ignore_ones, and
+                        wp_cancelable roll options
+    Returns (int): The number of successes; negative for a botch
+    """
+    no_botch = options["never_botch"]
+
+    suxx = 1 if will else 0
+    fails = 0
+    if autos > 0:
+        suxx += autos
+    elif autos < 0:
+        fails -= autos # Auto-failures are negative
+
+    suxx += __count_at_least(counts, difficulty)
+    if options["double_tens"] and difficulty <= 10:
+        suxx += counts[10]
+    if difficulty > 1 and not (options["ignore_ones"] and no_botch):
+        fails += counts[1]
+
+    # See roll.Pool for the explanation of these rules
+    if not will and fails > 0 and suxx == 0 and not no_botch:  # Botch
+        return -fails
+
+    suxx = max(suxx - fails, 0)
+    if suxx == 0 and will and not options["wp_cancelable"]:
+        suxx += 1
+
+    return suxx
+
+
+def __split(draws: list, sizes: list) -> list:
+    """Split a single draw into consecutive lists of the given sizes."""
+    lists = []
+    start = 0
+    for size in sizes:
+        lists.append(draws[start:start + size])
+        start += size
+
+    return lists
+
+
+def __count_at_least(counts: Counter, face: int) -> int:
+    """Returns the number of dice showing the given face or higher."""
+    return sum(map(counts.__getitem__, range(max(face, 1), 11)))
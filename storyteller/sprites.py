@@ -0,0 +1,107 @@
+"""sprites.py - Renders dice results as PNG images composed from a sprite atlas."""
+
+# Emoji are only legible for small pools, so large pools are drawn as an image
+# instead. The sprites are the same images as the dice emoji (and use the same
+# names; see parse/pool.py). They are loaded once, at import, into a single
+# atlas. Rows of dice are cached by their contents, because large pools have a
+# lot of rows in common (particularly when sorted), and all rendering happens in
+# an executor so that image work never blocks the event loop.
+
+import asyncio
+import io
+import os
+from functools import lru_cache
+
+import discord
+from PIL import Image
+
+SPRITE_SIZE = 32 # Pixels per die
+SPACING = 4 # Pixels between dice
+DICE_PER_ROW = 20
+FILENAME = "dice.png"
+
+# Every face/state combination a die can be displayed as
+SPRITES = (
+    "ss10", "s10", "s9", "s8", "s7", "s6", "s5", "s4", "s3", "s2",
+    "f9", "f8", "f7", "f6", "f5", "f4", "f3", "f2", "f1", "b1",
+)
+
+__SPRITE_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "images", "Dice Emoji")
+
+
+def __load_atlas() -> tuple:
+    """
+    Load every sprite into a single atlas image.
+    Returns (tuple): The atlas and a dictionary of sprite names to atlas boxes
+    """
+    atlas = Image.new("RGBA", (SPRITE_SIZE * len(SPRITES), SPRITE_SIZE))
+    boxes = {}
+
+    for index, name in enumerate(SPRITES):
+        path = os.path.join(__SPRITE_DIRECTORY, f"{name}.png")
+        with Image.open(path) as sprite:
+            sprite = sprite.convert("RGBA").resize((SPRITE_SIZE, SPRITE_SIZE), Image.LANCZOS)
+
+        left = index * SPRITE_SIZE
+        atlas.paste(sprite, (left, 0))
+        boxes[name] = (left, 0, left + SPRITE_SIZE, SPRITE_SIZE)
+
+    return atlas, boxes
+
+
+__atlas, __boxes = __load_atlas()
+
+
+async def render(names: list[str]) -> discord.File:
+    """
+    Render dice as a PNG image without blocking the event loop.
+    Args:
+        names (list[str]): The sprite names of the dice, in display order
+    Returns (discord.File): The image, ready to attach to a message
+    """
+    loop = asyncio.get_running_loop()
+    png = await loop.run_in_executor(None, render_png, tuple(names))
+
+    return discord.File(io.BytesIO(png), filename=FILENAME)
+
+
+def render_png(names: tuple) -> bytes:
+    """
+    Render dice as a PNG image, DICE_PER_ROW dice to a row.
+    Args:
+        names (tuple): The sprite names of the dice, in display order
+    Returns (bytes): The PNG data
+    """
+    rows = [names[start:start + DICE_PER_ROW] for start in range(0, len(names), DICE_PER_ROW)]
+    columns = min(len(names), DICE_PER_ROW)
+
+    image = Image.new("RGBA", (__span(columns), __span(len(rows))))
+    for index, row in enumerate(rows):
+        image.paste(__render_row(row), (0, index * (SPRITE_SIZE + SPACING)))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=512)
+def __render_row(names: tuple) -> Image.Image:
+    """
+    Render a single row of dice. Rows are cached by their contents, so the
+    returned image must not be modified.
+    Args:
+        names (tuple): The sprite names of the dice in the row
+    Returns (Image.Image): The rendered row
+    """
+    row = Image.new("RGBA", (__span(len(names)), SPRITE_SIZE))
+    for index, name in enumerate(names):
+        sprite = __atlas.crop(__boxes[name])
+        row.paste(sprite, (index * (SPRITE_SIZE + SPACING), 0))
+
+    return row
+
+
+def __span(count: int) -> int:
+    """Returns the number of pixels spanned by the given number of dice."""
+    return max(count * (SPRITE_SIZE + SPACING) - SPACING, 1)